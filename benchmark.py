@@ -0,0 +1,98 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Benchmarks the particle generators and writers over a sweep of grid sizes,
+particles per cell, minimum densities and dimensionalities, using the example
+distributions, and saves the results as JSON.
+"""
+import argparse
+import json
+
+from epoch_generate_particles_files.benchmark import (
+    MODES, case_grid, compare, environment, run_isolated)
+
+
+def create_parser():
+    '''Create argparse parser.'''
+    parser = argparse.ArgumentParser(
+        prog='EPOCH Generate Particles Files benchmark',
+        description="Measure particles/second, bytes written/second and peak "
+                    "memory of the generators and writers."
+    )
+    parser.add_argument(
+        '-o', '--output', default='benchmark.json',
+        help="JSON file in which to save the results. Defaults to "
+             "benchmark.json."
+    )
+    parser.add_argument(
+        '-d', '--dimensions', type=int, nargs='+', choices=[1, 2, 3],
+        default=[1, 2, 3], help="Dimensionalities to sweep. Defaults to all."
+    )
+    parser.add_argument(
+        '--cells', type=float, nargs='+', default=[1e4, 1e5],
+        help="Total numbers of cells to sweep. Defaults to 1e4 and 1e5."
+    )
+    parser.add_argument(
+        '--ppc', type=int, nargs='+', default=[8, 32],
+        help="Particles per cell to sweep. Defaults to 8 and 32."
+    )
+    parser.add_argument(
+        '--nmin', type=float, nargs='+', default=[0, 0.1],
+        help="Minimum number densities to sweep, as fractions of the peak "
+             "density of the examples. Defaults to 0 and 0.1."
+    )
+    parser.add_argument(
+        '--modes', nargs='+', choices=MODES, default=list(MODES),
+        help="Generate everything in memory and then save it ('memory'), or "
+             "stream batches to file ('stream'). Defaults to both."
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help="Number of worker processes. Defaults to 1."
+    )
+    parser.add_argument(
+        '--batch', type=int,
+        help="Approximate number of sample points evaluated at once. Defaults "
+             "to the generators' default."
+    )
+    parser.add_argument(
+        '--compare',
+        help="JSON file of an earlier run to compare particles/second with."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    cases = case_grid(args.dimensions, [int(c) for c in args.cells], args.ppc,
+                      args.nmin, args.modes)
+
+    print(f"{'dim':>3} {'cells':>9} {'ppc':>4} {'nmin':>5} {'mode':>6} "
+          f"{'particles':>10} {'part/s':>10} {'MB/s':>8} {'RSS MB':>8}")
+    results = []
+    for case in cases:
+        result = run_isolated(case, batch_size=args.batch,
+                              workers=args.workers)
+        results.append(result)
+        print(f"{result['dim']:>3} {result['cells']:>9} {result['ppc']:>4} "
+              f"{result['n_min']:>5} {result['mode']:>6} "
+              f"{result['particles']:>10} "
+              f"{result['particles_per_second']:>10.3g} "
+              f"{result['bytes_per_second'] / 2 ** 20:>8.1f} "
+              f"{result['peak_rss_mb']:>8.1f}")
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(environment=environment(), results=results), f,
+                  indent=2)
+    print(f"Saved results to {args.output}.")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print("Speed-up relative to", args.compare)
+        for case, ratio in compare(results, baseline):
+            print(f"{case['dim']:>3} {case['cells']:>9} {case['ppc']:>4} "
+                  f"{case['n_min']:>5} {case['mode']:>6} {ratio:>8.2f}")
@@ -0,0 +1,13 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Makes the package and the distributions importable when the tests are run
+with a plain pytest from the repository root.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
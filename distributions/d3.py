@@ -6,6 +6,15 @@ Part of EPOCH Generate Particles Files.
 
 This file should contain a 3-dimensional particle number density distribution as
 a Python function called number_density_3d. 
+
+Optionally, if the distribution is separable, i.e. a product of one factor
+per direction, those factors can also be given as a tuple of functions, e.g.
+
+    factors_3d = (factor_x, factor_y, factor_z)
+
+Particles are then placed by fast per-direction inverse-CDF sampling of the
+factors, and number_density_3d is no longer evaluated, so this cannot be
+combined with --tabulate or --jit.
 """
 import numpy as np
 
@@ -16,4 +25,4 @@ def gaussian(x, x0, w):
 def number_density_3d(x, y, z):
     '''Return particle number density for given x-y-z-coordinate.'''
     return 1e25 * gaussian(x, 0.2e-6, 1e-6) * gaussian(y, -0.1e-6, 0.5e-6) * \
-           gaussian(z, 0.3e-6, 0.7e-6)
\ No newline at end of file
+           gaussian(z, 0.3e-6, 0.7e-6)
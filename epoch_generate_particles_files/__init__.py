@@ -0,0 +1,9 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Importing the package gives access to the in-process interface (see api.py).
+"""
+from epoch_generate_particles_files.api import generate, load_distribution
@@ -0,0 +1,145 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Density-adaptive allocation of the number of particles per cell.
+
+Each cell is given a number of particles proportional to an importance value
+evaluated at its centre (by default the number density itself), clipped to a
+minimum and maximum. The constant of proportionality is fixed either so that
+the densest cell gets the maximum, or so that the whole grid gets roughly a
+given particle budget. Fractional targets are rounded stochastically, using a
+random number owned by the cell, so that the allocation is reproducible.
+
+The weight of each particle is divided by the number of particles in its own
+cell, so the charge in every cell is conserved whatever it is allocated.
+"""
+import numpy as np
+
+
+def cell_centres(bounds, cells, flat):
+    '''Return the coordinates of the centres of the cells with flat indices.'''
+    idx = np.unravel_index(flat, tuple(cells))
+    return [lo + (i + 0.5) * (hi - lo) / n
+            for (lo, hi), n, i in zip(bounds, cells, idx)]
+
+
+def _importance_stats(kwargs):
+    '''Return the sum and maximum of the importance over a range of cells.'''
+    importance = kwargs['importance']
+    runs = kwargs['runs']
+    if runs is None:
+        flat = np.arange(kwargs['first'], kwargs['last'])
+    else:
+        flat = np.concatenate([np.arange(a, b) for a, b in runs]
+                              + [np.empty(0, dtype=np.int64)])
+    if flat.size == 0:
+        return 0.0, 0.0
+    values = np.broadcast_to(
+        np.asarray(importance(*cell_centres(kwargs['bounds'], kwargs['cells'],
+                                             flat)), dtype=np.float64),
+        flat.shape
+    )
+    return float(values.sum()), float(values.max())
+
+
+def allocation_scale(importance, bounds, cells, ppc_min, ppc_max, budget=None,
+                     batches=None, workers=1):
+    '''Return the number of particles per unit of importance.
+
+    Parameters
+    ----------
+    importance : callable
+        Importance function taking one coordinate array per dimension.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    ppc_min, ppc_max : int
+        Minimum and maximum number of particles per cell.
+    budget : int, optional
+        Approximate total number of particles. If not given, the cell with the
+        largest importance gets ppc_max particles.
+    batches : list, optional
+        Batches of cells to visit, as returned by sampling.plan_batches.
+        Defaults to the whole grid in one batch.
+    workers : int, optional
+        Number of processes evaluating the importance. Defaults to 1.
+    '''
+    from epoch_generate_particles_files.sampling import map_batches
+
+    if batches is None:
+        n_cells = int(np.prod(cells, dtype=np.int64))
+        batches = [(0, n_cells, None, n_cells)]
+    tasks = (dict(importance=importance, bounds=bounds, cells=cells,
+                  first=first, last=last, runs=batch_runs)
+             for first, last, batch_runs, _ in batches)
+    total = 0.0
+    largest = 0.0
+    n_active = 0
+    for batch, (batch_sum, batch_max) in zip(
+            batches, map_batches(_importance_stats, tasks, workers)):
+        total += batch_sum
+        largest = max(largest, batch_max)
+        n_active += batch[3]
+    if budget is None:
+        return (ppc_max - ppc_min) / largest if largest > 0 else 0.0
+    # the minimum is spent on every cell whatever its importance
+    remaining = max(0, budget - ppc_min * n_active)
+    return remaining / total if total > 0 else 0.0
+
+
+def adaptive_allocation(importance, bounds, cells, ppc, ppc_min=None,
+                        budget=None, runs=None, batch_size=None, workers=1):
+    '''Return the alloc tuple used by the sampling engine, or None.
+
+    Adaptive allocation is used if either ppc_min or budget is given, in which
+    case ppc is the maximum number of particles per cell and ppc_min defaults
+    to 1. See allocation_scale for a description of the other parameters.
+
+    Raises
+    ------
+    ValueError
+        If ppc_min is not between 1 and ppc. Every cell needs a particle to
+        carry its charge.
+    '''
+    from epoch_generate_particles_files.sampling import (
+        DEFAULT_BATCH_SIZE, plan_batches)
+
+    if ppc_min is None and budget is None:
+        return None
+    if ppc_min is None:
+        ppc_min = 1
+    if not 1 <= ppc_min <= ppc:
+        raise ValueError("ppc_min must be between 1 and ppc.")
+    batches = plan_batches(cells, ppc, batch_size or DEFAULT_BATCH_SIZE, runs)
+    scale = allocation_scale(importance, bounds, cells, ppc_min, ppc, budget,
+                             batches, workers)
+    return (importance, scale, ppc_min, ppc)
+
+
+def cell_ppc(alloc, bounds, cells, flat, rands):
+    '''Return the number of particles allocated to each cell.
+
+    Parameters
+    ----------
+    alloc : tuple
+        (importance, scale, ppc_min, ppc_max), where scale is given by
+        allocation_scale.
+    bounds, cells
+        See allocation_scale.
+    flat : array of int
+        Flat indices of the cells.
+    rands : array
+        One uniform random number per cell, used for stochastic rounding.
+    '''
+    importance, scale, ppc_min, ppc_max = alloc
+    values = np.broadcast_to(
+        np.asarray(importance(*cell_centres(bounds, cells, flat)),
+                   dtype=np.float64),
+        flat.shape
+    )
+    target = ppc_min + scale * values
+    return np.clip(np.floor(target + rands), ppc_min, ppc_max).astype(np.int64)
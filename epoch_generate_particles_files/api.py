@@ -0,0 +1,341 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+In-process Python interface to the particle generators.
+
+generate samples any number density function, in 1, 2 or 3 dimensions, and
+either returns the particles as NumPy arrays or writes them to the binary files
+read by EPOCH, without going through main.py. The distributions package is
+only imported if no density function is given, and matplotlib is never
+imported here.
+"""
+import importlib
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.allocation import adaptive_allocation
+from epoch_generate_particles_files.cache import link_file
+from epoch_generate_particles_files.culling import active_runs
+from epoch_generate_particles_files.jit import JitDensity, jit_density
+from epoch_generate_particles_files.ordering import (
+    ORDERS, morton_bits, order_arrays, remove_offsets, sort_files)
+from epoch_generate_particles_files.profiling import phase
+from epoch_generate_particles_files.sampling import (
+    AXES, DEFAULT_BATCH_SIZE, iter_samples, sample_grid)
+from epoch_generate_particles_files.save_data import (
+    save_checkpointed, save_mapped, save_species, save_stream)
+from epoch_generate_particles_files.separable import SeparableDensity
+from epoch_generate_particles_files.tabulate import (
+    DEFAULT_CACHE_DIR, TabulatedDensity)
+from epoch_generate_particles_files.thermal import MOMENTUM_KEYS
+
+
+def load_distribution(dim, module=None):
+    '''Import the functions defined in distributions/dN.py.
+
+    Parameters
+    ----------
+    dim : int
+        Number of dimensions, 1, 2 or 3.
+    module : str, optional
+        Name of another module defining the same functions (e.g.
+        'distributions.carbon'). Defaults to 'distributions.dN'.
+
+    Returns
+    -------
+    Dictionary with the number density function ('density') and the optional
+    'max_density', 'importance' and 'factors' (None where not defined), which
+    can be passed on to generate, and the optional 'temperature' and 'drift'
+    of the particles (see thermal.ThermalMomentum).
+
+    Raises
+    ------
+    ImportError
+        If the module or its number density function cannot be imported.
+    '''
+    try:
+        module = importlib.import_module(module or f'distributions.d{dim}')
+        density = getattr(module, f'number_density_{dim}d')
+    except (ImportError, AttributeError) as err:
+        raise ImportError(
+            "Failed to import number density distribution function."
+        ) from err
+    return dict(
+        density=density,
+        max_density=getattr(module, f'max_number_density_{dim}d', None),
+        importance=getattr(module, f'importance_{dim}d', None),
+        factors=getattr(module, f'factors_{dim}d', None),
+        temperature=getattr(module, f'temperature_{dim}d', None),
+        drift=getattr(module, f'drift_{dim}d', None),
+    )
+
+
+def check_density_options(factors=None, table=None, jit=False):
+    '''Check that at most one of factors, table and jit is given.
+
+    Separable factors replace the number density function when sampling (see
+    separable.py), and a table is built by calling the function as given, so
+    any other option acting on that function would be ignored.
+
+    Raises
+    ------
+    ValueError
+        If factors are given with table or jit, or table with jit.
+    '''
+    if factors is not None and table is not None:
+        raise ValueError("Separable factors cannot be tabulated; remove the "
+                         "factors or tabulate.")
+    if factors is not None and jit:
+        raise ValueError("Separable factors cannot be compiled; remove the "
+                         "factors or jit.")
+    if table is not None and jit:
+        raise ValueError("A tabulated density cannot be compiled; use either "
+                         "tabulate or jit.")
+
+
+def resolve_density(density, bounds, cells, table=None,
+                    table_cache=DEFAULT_CACHE_DIR, factors=None, jit=False):
+    '''Return the density function to sample.
+
+    This is density itself, unless factors is given, in which case the density
+    is the product of the factors (see separable.py), table is given, in
+    which case the density is tabulated (see tabulate.py), or jit is True, in
+    which case it is compiled with Numba if possible (see jit.py).
+
+    Raises
+    ------
+    ValueError
+        If more than one of factors, table and jit is given (see
+        check_density_options).
+    '''
+    check_density_options(factors, table, jit)
+    if factors is not None:
+        return SeparableDensity(factors, bounds, cells)
+    if table is None:
+        if jit and not isinstance(density, JitDensity):
+            return jit_density(density, bounds)
+        return density
+    if len(table) == 1:
+        table = list(table) * len(bounds)
+    return TabulatedDensity(density, bounds, table, table_cache)
+
+
+def prepare(dim, density, bounds, cells, ppc, n_min=0,
+            batch_size=DEFAULT_BATCH_SIZE, workers=1, cull=0, cull_safety=2.0,
+            table=None, table_cache=DEFAULT_CACHE_DIR, ppc_min=None,
+            budget=None, max_density=None, importance=None, factors=None,
+            jit=False, profile=None, density_hook=None):
+    '''Set up the sampling of a number density function.
+
+    Takes the parameters of generate of the same names. Returns the density
+    function to sample (see resolve_density), the runs of active cells (None
+    unless cull is given) and the adaptive allocation (None unless ppc_min or
+    budget is given).
+    '''
+    if dim not in (1, 2, 3):
+        raise ValueError("dim must be 1, 2 or 3.")
+    if len(bounds) != dim or len(cells) != dim:
+        raise ValueError("Need bounds and cells for each dimension.")
+    if density is None:
+        distribution = load_distribution(dim)
+        density = distribution['density']
+        if max_density is None:
+            max_density = distribution['max_density']
+        if importance is None:
+            importance = distribution['importance']
+        if factors is None:
+            factors = distribution['factors']
+    if (density_hook is None and profile is not None and not jit
+            and not profile.densities):
+        density_hook = profile.wrap
+    if density_hook is not None:
+        density = density_hook(density)
+    with phase(profile, 'density setup'):
+        density = resolve_density(density, bounds, cells, table, table_cache,
+                                  factors, jit)
+
+    runs = None
+    if cull:
+        with phase(profile, 'culling'):
+            runs = active_runs(density, bounds, cells, n_min, cull,
+                               cull_safety, bound=max_density)
+    alloc = None
+    if ppc_min is not None or budget is not None:
+        with phase(profile, 'allocation'):
+            alloc = adaptive_allocation(importance or density, bounds, cells,
+                                        ppc, ppc_min, budget, runs,
+                                        batch_size, workers)
+
+    return density, runs, alloc
+
+
+def generate(dim, density, bounds, cells, ppc, out_dir=None, n_min=0,
+             progress=False, batch_size=DEFAULT_BATCH_SIZE, workers=1,
+             seed=None, two_pass=False, cull=0, cull_safety=2.0, table=None,
+             table_cache=DEFAULT_CACHE_DIR, sampling='random', ppc_min=None,
+             budget=None, max_density=None, importance=None, factors=None,
+             jit=False, profile=None, density_hook=None, checkpoint=None,
+             resume=False, checkpoint_tag=None, species=None, momentum=None,
+             order='cells', nproc=None, offsets=False):
+    '''Generate particles sampling a number density function.
+
+    Parameters
+    ----------
+    dim : int
+        Number of dimensions, 1, 2 or 3.
+    density : callable or None
+        Number density function taking one coordinate array per dimension,
+        e.g. density(x, y) in 2D. If None, the functions in distributions/dN.py
+        are used (see load_distribution). Must be picklable (e.g. a module
+        level function) if workers is greater than one.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    ppc : int
+        Number of particles per cell (the maximum, if ppc_min or budget is
+        given).
+    out_dir : str, optional
+        If given, the particles are written batch by batch to the binary files
+        in this directory instead of being returned. Defaults to None.
+    n_min, progress, batch_size, workers, seed, cull, cull_safety, table,
+    table_cache, sampling, ppc_min, budget, jit
+        See generate_1d.generate_1d.
+    two_pass : bool, optional
+        Only used with out_dir. See generate_1d.stream_1d.
+    max_density : callable, optional
+        Upper bound of the density in a box, used when culling (see
+        culling.active_runs). Defaults to None.
+    importance : callable, optional
+        Function the number of particles per cell is adapted to, if ppc_min or
+        budget is given. Defaults to density.
+    factors : sequence of callable, optional
+        One factor per direction whose product is the density, enabling
+        inverse-CDF sampling (see separable.py). Defaults to None.
+    profile : profiling.Profile, optional
+        If given, the phases of the run are timed and the statistics of the
+        sampled batches are added to it. Unless jit is True or a density was
+        already wrapped by profile.wrap, the density function is then also
+        wrapped by it. Defaults to None.
+    density_hook : callable, optional
+        Function applied to the density function before it is used, returning
+        a replacement, e.g. a wrapper timing or logging its calls. Defaults to
+        None.
+    checkpoint : float, optional
+        Only used with out_dir. If given, a checkpoint is saved in out_dir at
+        most every checkpoint seconds (see save_data.save_checkpointed).
+        Cannot be combined with two_pass. Defaults to None.
+    resume : bool, optional
+        Only used with checkpoint. Whether to continue from the checkpoint in
+        out_dir, if there is one. Defaults to False.
+    checkpoint_tag : str, optional
+        String identifying the run, saved with the checkpoint and checked when
+        resuming. Defaults to None.
+    species : sequence of (str, float), optional
+        If given, the particles are written to each of these output
+        directories instead of out_dir, with the weights multiplied by the
+        paired scale factor (see save_data.save_species). Cannot be combined
+        with two_pass or checkpoint. Defaults to None.
+    momentum : thermal.ThermalMomentum, optional
+        If given, the momenta of the particles are sampled with their
+        positions and returned or written as 'px', 'py' and 'pz'. Its
+        temperature and drift functions must be picklable if workers is
+        greater than one. Defaults to None.
+    order : str, optional
+        Order of the particles: 'cells' (cell by cell, as in nested loops over
+        x, y and z), 'procs' (by rank of the processor grid nproc) or 'morton'
+        (along a Morton curve through the cells). Files are sorted out of core
+        once written (see ordering.sort_files). Defaults to 'cells'.
+    nproc : sequence of int, optional
+        Number of ranks in each direction, for order 'procs'.
+    offsets : bool, optional
+        Only used with out_dir or species. Whether to write a sidecar file with
+        the range of the files holding each rank or block of cells (see
+        ordering.read_offsets). Defaults to False.
+
+    Returns
+    -------
+    If out_dir and species are None, a dictionary of contiguous arrays keyed
+    by coordinate name ('x', 'y', 'z'), 'n' (number density), 'w' (weight)
+    and, with momentum, 'px', 'py' and 'pz' (kg m/s). Otherwise the number of
+    particles written (per species).
+    '''
+    density, runs, alloc = prepare(
+        dim, density, bounds, cells, ppc, n_min, batch_size, workers, cull,
+        cull_safety, table, table_cache, ppc_min, budget, max_density,
+        importance, factors, jit, profile, density_hook
+    )
+
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order '{order}'.")
+    if order == 'procs' and (nproc is None or len(nproc) != dim):
+        raise ValueError("order 'procs' needs nproc for each dimension.")
+    if order == 'morton':
+        # fail before sampling if the cells have no Morton codes
+        morton_bits(cells)
+
+    if out_dir is None and species is None:
+        with phase(profile, 'sampling'):
+            data = sample_grid(density, bounds, cells, ppc, n_min, progress,
+                               batch_size, seed, workers, runs, sampling,
+                               alloc, profile, momentum)
+            data = order_arrays(data, bounds, cells, order, nproc)
+            return {key: np.ascontiguousarray(value)
+                    for key, value in data.items()}
+    keys = AXES[:dim] + ('w',)
+    if momentum is not None:
+        keys += MOMENTUM_KEYS
+    out_dirs = [out_dir]
+    if species is not None:
+        if two_pass or checkpoint is not None:
+            raise ValueError(
+                "species cannot be combined with two_pass or checkpoint."
+            )
+        with phase(profile, 'sampling and writing'):
+            batches = iter_samples(density, bounds, cells, ppc, n_min,
+                                   progress, batch_size, seed, workers, runs,
+                                   sampling, alloc, profile,
+                                   momentum=momentum)
+            n_written = save_species(batches, keys, species)
+        out_dirs = [directory for directory, _ in species]
+    elif checkpoint is not None:
+        if two_pass:
+            raise ValueError("Checkpoints cannot be combined with two_pass.")
+        with phase(profile, 'sampling and writing'):
+            n_written = save_checkpointed(density, bounds, cells, ppc, keys,
+                                          out_dir, n_min, progress,
+                                          batch_size, seed, workers, runs,
+                                          sampling, alloc, profile,
+                                          checkpoint, resume, checkpoint_tag,
+                                          momentum)
+    elif two_pass:
+        n_written = save_mapped(density, bounds, cells, ppc, keys, out_dir,
+                                n_min, progress, batch_size, seed, workers,
+                                runs, sampling, alloc, profile, momentum)
+    else:
+        with phase(profile, 'sampling and writing'):
+            batches = iter_samples(density, bounds, cells, ppc, n_min,
+                                   progress, batch_size, seed, workers, runs,
+                                   sampling, alloc, profile,
+                                   momentum=momentum)
+            n_written = save_stream(batches, keys, out_dir)
+
+    if order == 'cells':
+        for directory in out_dirs:
+            remove_offsets(directory)
+        return n_written
+    with phase(profile, 'sorting'):
+        # the species share the coordinates, so the permutation of the first
+        # is applied to the weights of the others
+        sort_files(out_dirs[0], keys, bounds, cells, order, nproc, offsets,
+                   species=out_dirs[1:])
+        for directory in out_dirs[1:]:
+            for key in keys:
+                if key != 'w':
+                    link_file(os.path.join(out_dirs[0], f'{key}_data.dat'),
+                              os.path.join(directory, f'{key}_data.dat'))
+    return n_written
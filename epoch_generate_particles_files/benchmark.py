@@ -0,0 +1,181 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Benchmarks of the generators and writers, using the example distributions.
+
+Each case is run in a fresh Python process, so that its peak resident set size
+(RSS) is not polluted by earlier cases. Cases either generate every particle in
+memory and then save them with save_1d/2d/3d ('memory' mode), or stream the
+batches straight to file ('stream' mode). Results are plain dictionaries that
+benchmark.py at the top of the repository saves as JSON, together with the
+commit and machine they were measured on, so runs can be compared.
+"""
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# peak number density of the example distributions, which n_min is scaled by
+PEAK_DENSITY = 1e25
+
+BOUNDS = (-3e-6, 3e-6)
+
+MODES = ('memory', 'stream')
+
+# fields identifying a case, used to match results between runs
+CASE_KEYS = ('dim', 'cells', 'ppc', 'n_min', 'mode')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def case_grid(dims, cells, ppcs, n_mins, modes=MODES):
+    '''Return the list of cases sweeping every combination of parameters.
+
+    Parameters
+    ----------
+    dims : sequence of int
+        Dimensionalities.
+    cells : sequence of int
+        Total numbers of cells. The number per side is rounded, so the actual
+        total may differ slightly.
+    ppcs : sequence of int
+        Numbers of particles per cell.
+    n_mins : sequence of float
+        Minimum number densities, as fractions of PEAK_DENSITY.
+    modes : sequence of str, optional
+        Any of MODES. Defaults to both.
+    '''
+    return [dict(dim=dim, cells=n_cells, ppc=ppc, n_min=n_min, mode=mode)
+            for dim, n_cells, ppc, n_min, mode
+            in itertools.product(dims, cells, ppcs, n_mins, modes)]
+
+
+def run_case(case, seed=1, batch_size=None, workers=1):
+    '''Run a benchmark case in this process and return its measurements.
+
+    Returns the case, extended with the number of particles, the time taken to
+    generate them and to write them, the number of bytes written, the derived
+    rates and the peak RSS of the process (and of its workers, if any).
+
+    The number density function of the example distribution is passed
+    explicitly, so that any factors, importance or upper bound defined next
+    to it are ignored and the density-evaluating generators are timed.
+    '''
+    from epoch_generate_particles_files.api import generate, load_distribution
+    from epoch_generate_particles_files.sampling import DEFAULT_BATCH_SIZE
+    from epoch_generate_particles_files import save_data
+
+    dim = case['dim']
+    density = load_distribution(dim)['density']
+    side = max(1, int(round(case['cells'] ** (1 / dim))))
+    options = dict(n_min=case['n_min'] * PEAK_DENSITY, seed=seed,
+                   batch_size=batch_size or DEFAULT_BATCH_SIZE,
+                   workers=workers)
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        if case['mode'] == 'stream':
+            particles = generate(dim, density, [BOUNDS] * dim, [side] * dim,
+                                 case['ppc'], out_dir, **options)
+            generate_time = time.perf_counter() - start
+            write_time = 0.0
+        else:
+            data = generate(dim, density, [BOUNDS] * dim, [side] * dim,
+                            case['ppc'], **options)
+            generate_time = time.perf_counter() - start
+            particles = data['w'].size
+            start = time.perf_counter()
+            save = getattr(save_data, f'save_{dim}d')
+            save(*(data[key] for key in ('x', 'y', 'z')[:dim]), data['w'],
+                 out_dir)
+            write_time = time.perf_counter() - start
+        n_bytes = sum(entry.stat().st_size for entry in os.scandir(out_dir))
+
+    total_time = generate_time + write_time
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return dict(
+        case,
+        cells_per_side=side,
+        particles=int(particles),
+        generate_seconds=generate_time,
+        write_seconds=write_time,
+        bytes_written=n_bytes,
+        particles_per_second=particles / total_time if total_time else 0.0,
+        bytes_per_second=n_bytes / total_time if total_time else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb=peak_rss / 1024,
+    )
+
+
+def run_isolated(case, seed=1, batch_size=None, workers=1):
+    '''Run a benchmark case in a fresh Python process (see run_case).'''
+    task = dict(case=case, seed=seed, batch_size=batch_size, workers=workers)
+    result = subprocess.run(
+        [sys.executable, '-m', 'epoch_generate_particles_files.benchmark',
+         json.dumps(task)],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def environment():
+    '''Return a description of the code and machine the benchmarks ran on.'''
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit,
+        time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        machine=platform.machine(),
+        processor=platform.processor(),
+        cpus=os.cpu_count(),
+    )
+
+
+def compare(results, baseline):
+    '''Return the ratio of particles per second to a baseline, per case.
+
+    Parameters
+    ----------
+    results, baseline : list of dict
+        Results of two runs. Cases that are missing from either are skipped.
+
+    Returns
+    -------
+    List of (case, ratio) pairs, where a ratio above one is a speed-up.
+    '''
+    old = {tuple(r[key] for key in CASE_KEYS): r for r in baseline}
+    ratios = []
+    for result in results:
+        match = old.get(tuple(result[key] for key in CASE_KEYS))
+        if match is None or not match['particles_per_second']:
+            continue
+        ratios.append((
+            {key: result[key] for key in CASE_KEYS},
+            result['particles_per_second'] / match['particles_per_second']
+        ))
+    return ratios
+
+
+if __name__ == "__main__":
+    # run a single case, as requested by run_isolated
+    task = json.loads(sys.argv[1])
+    print(json.dumps(run_case(task['case'], task['seed'], task['batch_size'],
+                              task['workers'])))
@@ -0,0 +1,169 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Binned number density images of the particles written to file.
+
+The particle files are read in chunks through np.memmap and the weights are
+accumulated onto a regular grid of bins with np.bincount, so memory use and
+run time stay modest however many particles there are. Dividing the summed
+weight in a bin by the bin volume recovers the number density. In 3D the
+particles are summed along each axis (giving column densities) and into thin
+slabs through the centre of the domain (giving slices of the density), all in
+a single pass over the files.
+"""
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.sampling import AXES
+
+
+# largest number of bins along each direction
+DEFAULT_MAX_BINS = 500
+
+# number of particles read from the files at a time
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+
+def default_bins(cells, max_bins=DEFAULT_MAX_BINS):
+    '''Return one bin per cell along each direction, up to max_bins.'''
+    return [min(int(n), max_bins) for n in cells]
+
+
+def iter_chunks(out_dir, keys, chunk_size=DEFAULT_CHUNK_SIZE, start=0,
+                stop=None):
+    '''Yield lists of arrays read in chunks from the particle files.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory holding the files 'k_data.dat' for each k in keys.
+    keys : sequence of str
+        Names of the quantities to read.
+    chunk_size : int, optional
+        Number of particles per chunk. Defaults to DEFAULT_CHUNK_SIZE.
+    start, stop : int, optional
+        Range of particles read. Defaults to every particle.
+    '''
+    paths = [os.path.join(out_dir, f'{key}_data.dat') for key in keys]
+    total = os.path.getsize(paths[0]) // 8
+    stop = total if stop is None else min(stop, total)
+    if stop <= start:
+        return
+    files = [np.memmap(path, dtype=np.float64, mode='r', shape=(total,))
+             for path in paths]
+    for first in range(start, stop, chunk_size):
+        last = min(first + chunk_size, stop)
+        yield [np.asarray(f[first:last]) for f in files]
+
+
+def reference_grid(density, bounds, samples):
+    '''Evaluate a number density function on a regular grid for plotting.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function of one or two coordinates.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    samples : sequence of int
+        Number of points in each direction.
+
+    Returns
+    -------
+    Coordinates in each direction, shaped to broadcast against each other
+    (y varying along the first axis in 2D, as expected by pcolormesh), and
+    the number density on the grid.
+    '''
+    if len(bounds) == 1:
+        x = np.linspace(*bounds[0], samples[0])
+        return [x], density(x)
+    x = np.linspace(*bounds[0], samples[0]).reshape((1, samples[0]))
+    y = np.linspace(*bounds[1], samples[1]).reshape((samples[1], 1))
+    return [x, y], density(x, y)
+
+
+def bin_index(coords, lo, hi, bins):
+    '''Return the bin of each coordinate, with bins spanning [lo, hi].'''
+    index = ((coords - lo) * (bins / (hi - lo))).astype(np.int64)
+    return np.clip(index, 0, bins - 1)
+
+
+def density_histogram(out_dir, bounds, bins, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Return the binned number density of 1D or 2D particle files.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory holding the particle files.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    bins : sequence of int
+        Number of bins in each direction.
+    chunk_size : int, optional
+        Number of particles read at a time. Defaults to DEFAULT_CHUNK_SIZE.
+
+    Returns
+    -------
+    List of bin edges in each direction and the array of number densities,
+    of shape bins.
+    '''
+    ndim = len(bounds)
+    edges = [np.linspace(lo, hi, n + 1) for (lo, hi), n in zip(bounds, bins)]
+    volume = np.prod([(hi - lo) / n for (lo, hi), n in zip(bounds, bins)])
+    total = np.zeros(int(np.prod(bins)))
+    for chunk in iter_chunks(out_dir, AXES[:ndim] + ('w',), chunk_size):
+        index = np.zeros(chunk[0].shape, dtype=np.int64)
+        for d in range(ndim):
+            index = index * bins[d] + bin_index(chunk[d], *bounds[d], bins[d])
+        total += np.bincount(index, weights=chunk[-1], minlength=total.size)
+    return edges, total.reshape(bins) / volume
+
+
+def density_views(out_dir, bounds, bins, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Return projections and central slices of 3D particle files.
+
+    Parameters
+    ----------
+    out_dir, bounds, bins, chunk_size
+        See density_histogram.
+
+    Returns
+    -------
+    List of bin edges in each direction, and two dictionaries keyed by the
+    plane of the view ('xy', 'xz' and 'yz'). The first holds the column
+    density, i.e. the number density integrated along the third direction.
+    The second holds the position along the third direction of the slab of
+    bins through the centre of the domain, and the number density in that
+    slab. Arrays are indexed by the bins of the first and then the second
+    direction of the plane.
+    '''
+    edges = [np.linspace(lo, hi, n + 1) for (lo, hi), n in zip(bounds, bins)]
+    sizes = [(hi - lo) / n for (lo, hi), n in zip(bounds, bins)]
+    planes = {'xy': (0, 1, 2), 'xz': (0, 2, 1), 'yz': (1, 2, 0)}
+    centre = [n // 2 for n in bins]
+    projections = {p: np.zeros(bins[a] * bins[b])
+                   for p, (a, b, _) in planes.items()}
+    slices = {p: np.zeros(bins[a] * bins[b])
+              for p, (a, b, _) in planes.items()}
+    for chunk in iter_chunks(out_dir, AXES + ('w',), chunk_size):
+        index = [bin_index(chunk[d], *bounds[d], bins[d]) for d in range(3)]
+        w = chunk[3]
+        for plane, (a, b, c) in planes.items():
+            flat = index[a] * bins[b] + index[b]
+            projections[plane] += np.bincount(flat, weights=w,
+                                              minlength=bins[a] * bins[b])
+            inside = index[c] == centre[c]
+            slices[plane] += np.bincount(flat[inside], weights=w[inside],
+                                         minlength=bins[a] * bins[b])
+    for plane, (a, b, c) in planes.items():
+        area = sizes[a] * sizes[b]
+        shape = (bins[a], bins[b])
+        projections[plane] = projections[plane].reshape(shape) / area
+        position = 0.5 * (edges[c][centre[c]] + edges[c][centre[c] + 1])
+        slices[plane] = (position,
+                         slices[plane].reshape(shape) / (area * sizes[c]))
+    return edges, projections, slices
@@ -0,0 +1,232 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Content-addressed cache of generated particle files.
+
+A run is identified by a key hashing the source code of the distribution
+module, the command line arguments that change the particles and the seed.
+The key is written, with a description of the files, to a manifest next to
+the particle files. A later run with the same key can then reuse the files in
+the output directory, or hard-link them from a shared cache directory, instead
+of sampling the distribution again. The shared cache is limited in size by
+evicting the least recently used results.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from epoch_generate_particles_files.tabulate import (
+    DEFAULT_CACHE_DIR, source_hash)
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# changing this invalidates all existing manifests
+CACHE_VERSION = 1
+
+DEFAULT_PARTICLE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'particles')
+
+# default size limit of the shared cache in bytes
+DEFAULT_CACHE_SIZE = 10 * 2 ** 30
+
+# arguments of main.py that do not change the particles written
+IGNORED_ARGS = frozenset((
+    'outdir', 'plot', 'visx', 'visy', 'bins', 'progress', 'batch', 'workers',
+    'two_pass', 'table_cache', 'profile', 'stats', 'cache', 'cache_dir',
+    'cache_size', 'force', 'checkpoint', 'resume', 'dry_run', 'validate',
+))
+
+
+def run_arguments(args):
+    '''Return the arguments that change the particles written, as a dict.'''
+    return {name: value for name, value in sorted(args.items())
+            if name not in IGNORED_ARGS}
+
+
+def run_key(density, args):
+    '''Return the key identifying the particles generated by a run.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function of the run. The source code of its whole
+        module is hashed (see tabulate.source_hash).
+    args : dict
+        Arguments of the run, as parsed by parse_args.create_parser and
+        including the seed. Arguments in IGNORED_ARGS are left out.
+    '''
+    return hashlib.sha256(json.dumps([
+        CACHE_VERSION, source_hash(density), density.__qualname__,
+        run_arguments(args)
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def read_manifest(directory):
+    '''Return the manifest in directory, or None if there is none.'''
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(directory, key, args, particles, keys, extra=()):
+    '''Write the manifest describing the particle files in directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the particle files.
+    key : str
+        Key of the run (see run_key).
+    args : dict
+        Arguments of the run.
+    particles : int
+        Number of particles in the files.
+    keys : sequence of str
+        Names of the quantities saved, one file 'k_data.dat' per name.
+    extra : sequence of str, optional
+        Names of other files in directory belonging to the result, such as
+        the offsets sidecar (see ordering.sort_files). Defaults to none.
+    '''
+    manifest = dict(
+        version=CACHE_VERSION,
+        key=key,
+        created=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        particles=int(particles),
+        arguments=run_arguments(args),
+        files={f'{k}_data.dat':
+               os.path.getsize(os.path.join(directory, f'{k}_data.dat'))
+               for k in keys},
+    )
+    for name in extra:
+        manifest['files'][name] = os.path.getsize(
+            os.path.join(directory, name))
+    tmp_path = os.path.join(directory, f'{MANIFEST_NAME}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+    return manifest
+
+
+def remove_manifest(directory):
+    '''Remove the manifest in directory, before its files are rewritten.'''
+    path = os.path.join(directory, MANIFEST_NAME)
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def is_complete(directory, key):
+    '''Return the manifest of directory if it holds the files of key.'''
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get('key') != key:
+        return None
+    for name, size in manifest['files'].items():
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return None
+    return manifest
+
+
+def link_file(source, target):
+    '''Hard-link source to target, copying it if linking is not possible.'''
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def entry_dir(cache_dir, key):
+    '''Return the directory of a result in the shared cache.'''
+    return os.path.join(cache_dir, key[:32])
+
+
+def find_result(key, out_dir, cache_dir=None):
+    '''Make the cached particle files of a run available in out_dir.
+
+    Parameters
+    ----------
+    key : str
+        Key of the run (see run_key).
+    out_dir : str
+        Output directory of the run.
+    cache_dir : str, optional
+        Shared cache directory, searched if out_dir does not already hold the
+        files. Defaults to None (only out_dir is searched).
+
+    Returns
+    -------
+    Manifest of the result and the directory it was found in, or (None, None)
+    if there is no complete result with this key.
+    '''
+    manifest = is_complete(out_dir, key)
+    if manifest is not None:
+        return manifest, out_dir
+    if cache_dir is None:
+        return None, None
+    entry = entry_dir(cache_dir, key)
+    manifest = is_complete(entry, key)
+    if manifest is None:
+        return None, None
+    for name in manifest['files']:
+        link_file(os.path.join(entry, name), os.path.join(out_dir, name))
+    link_file(os.path.join(entry, MANIFEST_NAME),
+              os.path.join(out_dir, MANIFEST_NAME))
+    # mark the entry as recently used
+    os.utime(os.path.join(entry, MANIFEST_NAME))
+    return manifest, entry
+
+
+def store_result(out_dir, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+    '''Hard-link the particle files in out_dir into the shared cache.
+
+    The manifest written by write_manifest names the files and their key.
+    Least recently used results are then evicted until the cache holds at
+    most max_size bytes.
+    '''
+    manifest = read_manifest(out_dir)
+    entry = entry_dir(cache_dir, manifest['key'])
+    if is_complete(entry, manifest['key']) is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = f'{entry}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in list(manifest['files']) + [MANIFEST_NAME]:
+            link_file(os.path.join(out_dir, name),
+                      os.path.join(tmp_dir, name))
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another process stored the same result first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    '''Remove least recently used results until the cache fits in max_size.
+
+    Returns the number of bytes removed.
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        manifest_path = os.path.join(entry.path, MANIFEST_NAME)
+        if not entry.is_dir() or not os.path.isfile(manifest_path):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+        entries.append((os.path.getmtime(manifest_path), size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total - removed <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        removed += size
+    return removed
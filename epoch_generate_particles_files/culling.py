@@ -0,0 +1,160 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Skips regions of the domain where the number density cannot reach n_min.
+
+The domain is divided into cubic blocks of cells and the number density is
+probed on a coarse lattice in each block (or bounded by a user-supplied
+function). Blocks whose density cannot exceed n_min are dropped and the
+remaining cells are returned as a sparse list of runs of consecutive flat cell
+indices, which the sampling engine visits instead of the full grid.
+"""
+import itertools
+
+import numpy as np
+
+
+def active_runs(density, bounds, cells, n_min, block=8, safety=2.0, probe=3,
+                bound=None):
+    '''Find the cells in blocks where the number density may exceed n_min.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function taking one coordinate array per dimension.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    n_min : float
+        Minimum number density value.
+    block : int, optional
+        Size of the blocks in cells along each direction. Defaults to 8.
+    safety : float, optional
+        Safety factor applied to the probed density. A block is skipped only
+        if safety times the largest probed value is below n_min. Defaults to
+        2.
+    probe : int, optional
+        Number of probe points along each direction of a block, including its
+        edges. Defaults to 3.
+    bound : callable, optional
+        Function returning an upper bound of the number density in a box. It
+        is passed the lower and then the upper corner coordinates of the
+        blocks, one array per dimension each, e.g. bound(xlo, ylo, xhi, yhi).
+        If given, the density is not probed and safety is not applied.
+
+    Returns
+    -------
+    Integer array of shape (k, 2) of sorted, non-overlapping [first, last)
+    ranges of flat cell indices, or None if nothing can be skipped because
+    n_min is not positive.
+    '''
+    if n_min <= 0:
+        return None
+    ndim = len(cells)
+    n_blocks = tuple(-(-n // block) for n in cells)
+    sizes = tuple((hi - lo) / n for (lo, hi), n in zip(bounds, cells))
+
+    # lower and upper edge of every block along each direction
+    lo_edges = []
+    hi_edges = []
+    for d in range(ndim):
+        idx = np.arange(n_blocks[d])
+        lo_edges.append(bounds[d][0] + idx * block * sizes[d])
+        hi_edges.append(bounds[d][0]
+                        + np.minimum((idx + 1) * block, cells[d]) * sizes[d])
+
+    if bound is not None:
+        lo = np.meshgrid(*lo_edges, indexing='ij', sparse=True)
+        hi = np.meshgrid(*hi_edges, indexing='ij', sparse=True)
+        active = np.asarray(bound(*lo, *hi)) >= n_min
+        active = np.broadcast_to(active, n_blocks)
+    else:
+        active = np.empty(n_blocks, dtype=bool)
+        frac = np.linspace(0, 1, probe)
+        points = [(lo[:, np.newaxis] + (hi - lo)[:, np.newaxis] * frac).ravel()
+                  for lo, hi in zip(lo_edges, hi_edges)]
+        # probe one x-slab of blocks at a time to bound the memory use
+        for bx in range(n_blocks[0]):
+            coords = [points[0][bx * probe:(bx + 1) * probe]] + points[1:]
+            grids = np.meshgrid(*coords, indexing='ij', sparse=True)
+            n_probe = np.broadcast_to(
+                np.asarray(density(*grids), dtype=np.float64),
+                tuple(len(c) for c in coords)
+            )
+            n_probe = n_probe.reshape(
+                (1, probe) + sum(((n, probe) for n in n_blocks[1:]), ())
+            )
+            block_max = n_probe.max(axis=tuple(range(1, 2 * ndim, 2)))
+            active[bx] = safety * block_max >= n_min
+    return _blocks_to_runs(active, cells, block)
+
+
+def _blocks_to_runs(active, cells, block):
+    '''Convert a mask of active blocks into runs of flat cell indices.'''
+    ndim = len(cells)
+
+    # runs of consecutive active blocks along the last direction
+    mask = np.pad(active.reshape(-1, active.shape[-1]).astype(np.int8),
+                  ((0, 0), (1, 1)))
+    steps = np.diff(mask, axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    stops = np.nonzero(steps == -1)[1]
+    if rows.size == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    lead_blocks = np.unravel_index(rows, active.shape[:-1]) if ndim > 1 else ()
+    z_first = starts * block
+    z_last = np.minimum(stops * block, cells[-1])
+
+    # repeat each run for every row of cells in its blocks
+    firsts = []
+    lasts = []
+    for offset in itertools.product(range(block), repeat=ndim - 1):
+        lead = [b * block + o for b, o in zip(lead_blocks, offset)]
+        valid = np.ones(rows.size, dtype=bool)
+        for d, idx in enumerate(lead):
+            valid &= idx < cells[d]
+        lead = [idx[valid] for idx in lead]
+        first = np.ravel_multi_index(lead + [z_first[valid]], tuple(cells))
+        firsts.append(first)
+        lasts.append(first + (z_last - z_first)[valid])
+    firsts = np.concatenate(firsts)
+    lasts = np.concatenate(lasts)
+    order = np.argsort(firsts, kind='stable')
+    firsts = firsts[order]
+    lasts = lasts[order]
+
+    # merge runs that touch, e.g. neighbouring rows that are fully active
+    new_run = np.ones(firsts.size, dtype=bool)
+    new_run[1:] = firsts[1:] != lasts[:-1]
+    return np.stack([firsts[new_run],
+                     lasts[np.append(new_run[1:], True)]], axis=1)
+
+
+def clip_runs(runs, first, last):
+    '''Return the part of the runs that lies within [first, last).'''
+    i0 = np.searchsorted(runs[:, 1], first, side='right')
+    i1 = np.searchsorted(runs[:, 0], last, side='left')
+    return np.clip(runs[i0:i1], first, last)
+
+
+def iter_run_batches(runs, ppc, batch_size):
+    '''Yield (first, last) ranges of flat cell indices covering the runs.
+
+    Each range holds roughly batch_size sample points in active cells, however
+    many inactive cells lie between them.
+    '''
+    if runs.shape[0] == 0:
+        return
+    ends = np.cumsum(runs[:, 1] - runs[:, 0])
+    step = max(1, batch_size // ppc)
+    first = int(runs[0, 0])
+    for count in range(step, int(ends[-1]), step):
+        j = np.searchsorted(ends, count)
+        last = int(runs[j, 1] - (ends[j] - count))
+        yield first, last
+        first = last
+    yield first, int(runs[-1, 1])
@@ -0,0 +1,285 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Dry-run estimates of the size and cost of a run.
+
+A random subsample of the (active) cells is sampled exactly as the full run
+would sample it, with the same seed, so the particles kept in those cells are
+the ones the run would write. The number of particles in the whole grid is
+estimated from their mean count per cell, with a normal confidence interval
+corrected for sampling without replacement. The time and the memory taken per
+sample evaluated are measured on the way and scaled to the batches of the full
+run. Nothing is written.
+
+Features narrower than the spacing of the subsampled cells may be missed
+entirely, in which case the interval is too narrow. Sampling more cells makes
+this less likely.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+
+from epoch_generate_particles_files.api import prepare
+from epoch_generate_particles_files.culling import clip_runs
+from epoch_generate_particles_files.profiling import peak_memory_mb
+from epoch_generate_particles_files.sampling import (
+    AXES, DEFAULT_BATCH_SIZE, cell_counts, plan_batches, random_seed,
+    sample_cells)
+from epoch_generate_particles_files.tabulate import DEFAULT_CACHE_DIR
+from epoch_generate_particles_files.thermal import MOMENTUM_KEYS
+
+
+DEFAULT_SAMPLE_CELLS = 1000
+
+# quantile of the normal distribution giving 95% confidence intervals
+CONFIDENCE_Z = 1.96
+
+# number of samples timed in consecutive cells, enough to make the overhead
+# of a call to the sampling engine negligible
+TIMED_SAMPLES = 2 ** 16
+
+# batches of particles held by the writer at once (see save_data.save_stream)
+_QUEUED_BATCHES = 3
+
+# entries of the sampling statistics that are not times
+_COUNTS = ('evaluated', 'accepted', 'memory')
+
+
+def random_cells(cells, runs, samples, seed):
+    '''Return a random subsample of the active cells.
+
+    Parameters
+    ----------
+    cells : sequence of int
+        Number of cells in each direction.
+    runs : array or None
+        Runs of active cells (see culling.active_runs), or None if every cell
+        is active.
+    samples : int
+        Number of cells to draw, without replacement.
+    seed : int
+        Seed of the random choice.
+
+    Returns
+    -------
+    Sorted flat indices of the cells drawn and the number of active cells.
+    '''
+    if runs is None:
+        n_active = int(np.prod(cells, dtype=np.int64))
+    else:
+        lengths = runs[:, 1] - runs[:, 0]
+        n_active = int(np.sum(lengths))
+    rng = np.random.default_rng(seed)
+    picked = np.sort(rng.choice(n_active, size=min(samples, n_active),
+                                replace=False))
+    if runs is not None:
+        # map the rank of each cell among the active cells to its flat index
+        ends = np.cumsum(lengths)
+        i = np.searchsorted(ends, picked, side='right')
+        picked = runs[i, 0] + picked - (ends[i] - lengths[i])
+    return picked.astype(np.int64), n_active
+
+
+def interval(values, population, largest):
+    '''Return the estimated total of a quantity over a population of cells.
+
+    Parameters
+    ----------
+    values : array
+        Values of the quantity in a simple random sample of the cells.
+    population : int
+        Number of cells.
+    largest : float
+        Largest possible value in a cell.
+
+    Returns
+    -------
+    Estimated total and the lower and upper bounds of its confidence interval.
+    '''
+    m = values.size
+    if m == 0:
+        return 0.0, 0.0, 0.0
+    total = population * float(np.mean(values))
+    spread = 0.0
+    if 1 < m < population:
+        spread = (CONFIDENCE_Z * population * float(np.std(values, ddof=1))
+                  * np.sqrt((1 - m / population) / m))
+    return (total, max(0.0, total - spread),
+            min(population * largest, total + spread))
+
+
+def estimate(dim, density, bounds, cells, ppc, n_min=0,
+             batch_size=DEFAULT_BATCH_SIZE, workers=1, seed=None, cull=0,
+             cull_safety=2.0, table=None, table_cache=DEFAULT_CACHE_DIR,
+             sampling='random', ppc_min=None, budget=None, max_density=None,
+             importance=None, factors=None, jit=False, momentum=None,
+             samples=DEFAULT_SAMPLE_CELLS):
+    '''Estimate the particles, output size, memory and time of a run.
+
+    Parameters
+    ----------
+    dim, density, bounds, cells, ppc, n_min, batch_size, workers, seed, cull,
+    cull_safety, table, table_cache, sampling, ppc_min, budget, max_density,
+    importance, factors, jit, momentum
+        See api.generate. The density is set up, culled and allocated as for
+        the run itself.
+    samples : int, optional
+        Number of active cells sampled. Defaults to DEFAULT_SAMPLE_CELLS.
+
+    Returns
+    -------
+    Dictionary with the seed, the number of 'cells', 'active_cells' and
+    'sampled_cells', the 'particles' and the size in bytes of each file (in
+    'files') as (estimate, lower, upper) tuples, the projected 'memory_mb'
+    (summed over the worker processes), the 'setup_seconds' actually spent
+    setting up the density and the projected 'sampling_seconds' and
+    'wall_seconds', not counting the time taken to write the files.
+    '''
+    if seed is None:
+        seed = random_seed()
+    clock = time.perf_counter()
+    density, runs, alloc = prepare(
+        dim, density, bounds, cells, ppc, n_min, batch_size, workers, cull,
+        cull_safety, table, table_cache, ppc_min, budget, max_density,
+        importance, factors, jit
+    )
+    setup = time.perf_counter() - clock
+    picked, n_active = random_cells(cells, runs, samples, seed)
+    baseline = (peak_memory_mb() or 0.0) * 2 ** 20
+
+    # the first call may compile the density or fill lazy tables
+    if picked.size:
+        cell_counts(density, bounds, cells, ppc, picked[0], picked[0] + 1,
+                    n_min, seed, sampling=sampling, alloc=alloc)
+
+    # count the particles kept in the chosen cells, at most a batch at a time
+    counts = [np.empty(0, dtype=np.int64)]
+    timings = {'evaluated': 0}
+    step = max(1, batch_size // ppc)
+    for i in range(0, picked.size, step):
+        chunk = picked[i:i + step]
+        counts.append(cell_counts(
+            density, bounds, cells, ppc, chunk[0], chunk[-1] + 1, n_min, seed,
+            np.stack([chunk, chunk + 1], axis=1), sampling, alloc, timings
+        ))
+    counts = np.concatenate(counts)
+    particles = interval(counts, n_active, ppc)
+    evaluated = n_active * timings['evaluated'] / max(picked.size, 1)
+
+    # time a block of consecutive cells, sampled as in a batch of the run
+    batches = plan_batches(cells, ppc, batch_size, runs)
+    block = _timed_block(density, bounds, cells, ppc, n_min, seed, sampling,
+                         alloc, momentum, batches, picked)
+    sampling_seconds = 0.0
+    if block['evaluated']:
+        sampling_seconds = evaluated * (
+            sum(t for k, t in block.items() if k not in _COUNTS + ('momenta',))
+            / block['evaluated']
+        )
+    if block['accepted']:
+        sampling_seconds += (particles[0] * block.get('momenta', 0.0)
+                             / block['accepted'])
+    keys = AXES[:dim] + ('w',)
+    if momentum is not None:
+        keys += MOMENTUM_KEYS
+
+    # memory of the largest batch, while it is sampled and once it is queued
+    largest = ppc * max((b[3] for b in batches), default=0)
+    work = block['memory'] / max(block['evaluated'], 1) * largest
+    accepted = particles[0] / evaluated if evaluated else 0.0
+    # the coordinates, densities, weights and momenta of the kept particles
+    out = 8 * (len(keys) + 1) * accepted * largest
+    if workers <= 1:
+        memory = baseline + work + _QUEUED_BATCHES * out
+    else:
+        memory = (baseline + (2 * workers + _QUEUED_BATCHES) * out
+                  + workers * (baseline + work))
+
+    return dict(
+        seed=seed,
+        cells=int(np.prod(cells, dtype=np.int64)),
+        active_cells=n_active,
+        sampled_cells=int(picked.size),
+        particles=particles,
+        files={f'{key}_data.dat': tuple(8 * p for p in particles)
+               for key in keys},
+        memory_mb=memory / 2 ** 20,
+        setup_seconds=setup,
+        sampling_seconds=sampling_seconds,
+        wall_seconds=setup + sampling_seconds / workers,
+        workers=workers,
+    )
+
+
+def _timed_block(density, bounds, cells, ppc, n_min, seed, sampling, alloc,
+                 momentum, batches, picked):
+    '''Sample up to TIMED_SAMPLES samples in consecutive cells.
+
+    The block starts at the first chosen cell, within its batch. Returns the
+    seconds spent in each phase (see sampling.sample_cells), the numbers of
+    samples 'evaluated' and 'accepted' and the peak 'memory' allocated, in
+    bytes.
+    '''
+    stats = {'evaluated': 0, 'accepted': 0, 'memory': 0}
+    if not picked.size:
+        return stats
+    first, last, runs, _ = next(b for b in batches if b[1] > picked[0])
+    first = int(picked[0])
+    size = max(1, TIMED_SAMPLES // ppc)
+    if runs is None:
+        last = min(last, first + size)
+    else:
+        # keep the first size active cells from the first chosen one on
+        runs = clip_runs(runs, first, last)
+        ends = np.cumsum(runs[:, 1] - runs[:, 0])
+        if ends[-1] > size:
+            i = np.searchsorted(ends, size)
+            last = int(runs[i, 1] - (ends[i] - size))
+            runs = clip_runs(runs, first, last)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = sample_cells(density, bounds, cells, ppc, first, last, n_min, seed,
+                        runs, sampling, alloc, stats=True, momentum=momentum)
+    stats.update(data['stats'])
+    stats['memory'] = tracemalloc.get_traced_memory()[1] - before
+    if not tracing:
+        tracemalloc.stop()
+    return stats
+
+
+def _format_bytes(size):
+    '''Return a size in bytes with a binary unit prefix.'''
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_estimate(result):
+    '''Return a human readable report of the result of estimate.'''
+    particles, low, high = result['particles']
+    files = result['files']
+    size = next(iter(files.values()))
+    lines = [
+        f"Dry run with seed {result['seed']}: sampled "
+        f"{result['sampled_cells']} of {result['active_cells']} active cells "
+        f"({result['cells']} in total).",
+        f"Particles: {particles:.4g} (95% interval {low:.4g} to {high:.4g})",
+        f"Files: {', '.join(files)}",
+        f"  {_format_bytes(size[0])} each (95% interval "
+        f"{_format_bytes(size[1])} to {_format_bytes(size[2])}), "
+        f"{_format_bytes(len(files) * size[0])} in total",
+        f"Peak memory: about {result['memory_mb']:.0f} MB"
+        + (" (all processes)" if result['workers'] > 1 else ""),
+        f"Time: about {result['wall_seconds']:.3g} s (setup "
+        f"{result['setup_seconds']:.3g} s, sampling "
+        f"{result['sampling_seconds']:.3g} s of CPU time over "
+        f"{result['workers']} worker(s)), not counting writing the files",
+    ]
+    return '\n'.join(lines)
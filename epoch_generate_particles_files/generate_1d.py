@@ -9,14 +9,17 @@ distribution.
 """
 import numpy as np
 
-try:
-    from distributions.d1 import number_density_1d
-except ImportError:
-    raise SystemExit("Failed to import number density distribution function.")
+from epoch_generate_particles_files.api import (
+    generate, load_distribution, resolve_density)
+from epoch_generate_particles_files.profiling import phase
+from epoch_generate_particles_files.sampling import DEFAULT_BATCH_SIZE
+from epoch_generate_particles_files.tabulate import DEFAULT_CACHE_DIR
 
-
-
-def generate_1d(xmin, xmax, nx, ppc, progress=False, n_min=0, vis_samples=1000):
+def generate_1d(xmin, xmax, nx, ppc, progress=False, n_min=0, vis_samples=1000,
+                batch_size=DEFAULT_BATCH_SIZE, workers=1, seed=None, cull=0,
+                cull_safety=2.0, table=None, table_cache=DEFAULT_CACHE_DIR,
+                sampling='random', ppc_min=None, budget=None,
+                jit=False, profile=None):
     '''Generate particles in 1D space.
     
     Parameters
@@ -37,49 +40,101 @@ def generate_1d(xmin, xmax, nx, ppc, progress=False, n_min=0, vis_samples=1000):
     vis_samples : int, optional
         How many data points to use to plot the number density distribution.
         Defaults to 1000.
+    batch_size : int, optional
+        Approximate number of sample points evaluated at once. Defaults to
+        DEFAULT_BATCH_SIZE.
+    workers : int, optional
+        Number of processes sampling slabs of cells in parallel. Defaults to 1.
+    seed : int, optional
+        Seed of the random numbers. Runs with the same seed and parameters give
+        identical particles. Defaults to a fresh random seed.
+    cull : int, optional
+        If positive and n_min is positive, skip blocks of cull cells per side
+        in which the number density cannot reach n_min (see culling.py).
+        Defaults to 0 (no culling).
+    cull_safety : float, optional
+        Safety factor applied to the probed density when culling. Defaults
+        to 2.
+    table : sequence of int, optional
+        If given, tabulate the number density once on a lattice with this many
+        points in each direction (a single value applies to all directions)
+        and interpolate from the table (see tabulate.py). Defaults to None.
+    table_cache : str, optional
+        Directory in which tables are cached. Defaults to DEFAULT_CACHE_DIR.
+    sampling : str, optional
+        How particles are placed within a cell: 'random', 'jittered' (one per
+        stratum), 'sobol' (randomly shifted Sobol points) or 'regular' (centres
+        of the strata). Defaults to 'random'.
+    ppc_min : int, optional
+        If given, the number of particles per cell is adapted to the density
+        (or to importance_Nd, if defined in the distributions file) between
+        ppc_min and ppc (see allocation.py). Defaults to None.
+    budget : int, optional
+        If given, adapt the number of particles per cell so that roughly this
+        many particles are generated in total, with at most ppc and at least
+        ppc_min (default 1) per cell. Defaults to None.
+    jit : bool, optional
+        Whether to compile the number density function with Numba, if
+        installed, and fuse it with the sampling loop (see jit.py). Defaults
+        to False.
+    profile : profiling.Profile, optional
+        If given, the phases of the run are timed and added to it. Defaults to
+        None.
     '''
+    bounds = [(xmin, xmax)]
+    cells = [nx]
+    distribution = load_distribution(1)
+    density = distribution['density']
+    if profile is not None and not jit:
+        density = profile.wrap(density)
+    with phase(profile, 'density setup'):
+        density = resolve_density(density, bounds, cells, table, table_cache,
+                                  distribution['factors'], jit)
+
     # generate visualisation
-    x_vis = np.linspace(xmin, xmax, vis_samples)
-    n_vis = number_density_1d(x_vis)
+    with phase(profile, 'visualisation'):
+        x_vis = np.linspace(xmin, xmax, vis_samples)
+        n_vis = density(x_vis)
     
-    cell_size_x = (xmax - xmin) / nx
-    cell_vol = cell_size_x
+    data = generate(1, density, bounds, cells, ppc, n_min=n_min,
+                    progress=progress, batch_size=batch_size, workers=workers,
+                    seed=seed, cull=cull, cull_safety=cull_safety,
+                    sampling=sampling, ppc_min=ppc_min, budget=budget,
+                    max_density=distribution['max_density'],
+                    importance=distribution['importance'], profile=profile)
+
+    return x_vis, n_vis, data['x'], data['n'], data['w']
 
-    # initialise lists to be populated
-    x_list = []  # x-positions
-    n_list = []  # number density values
-    w_list = []  # weights
-    
-    # start at the lower boundary
-    x_current = xmin
-    
-    # sample the cells
-    if progress:
-        try: 
-            from tqdm import tqdm
-        except ImportError:
-            print("No tqdm found.")
-            progress = False
-    if progress:
-        pbar = tqdm(total=np.ceil((xmax-xmin)/cell_size_x))
-    while x_current < xmax:
-        # randomly sample cell space
-        x_rands = np.random.uniform(0, cell_size_x, ppc)
-        x_rands += x_current
-        
-        # get number density values
-        n_samp = number_density_1d(x_rands)
-        
-        # add particles to list if they exceed the minimum n
-        for i in range(ppc):
-            if n_samp[i] >= n_min:
-                x_list.append(x_rands[i])
-                n_list.append(n_samp[i])
-                w_list.append(n_samp[i] * cell_vol / ppc)
-        
-        x_current += cell_size_x
-        
-        if progress:
-            pbar.update(1)
 
-    return x_vis, n_vis, x_list, n_list, w_list
\ No newline at end of file
+def stream_1d(xmin, xmax, nx, ppc, out_dir, progress=False, n_min=0,
+              batch_size=DEFAULT_BATCH_SIZE, workers=1, seed=None,
+              two_pass=False, cull=0, cull_safety=2.0, table=None,
+              table_cache=DEFAULT_CACHE_DIR, sampling='random',
+              ppc_min=None, budget=None, jit=False, profile=None,
+              checkpoint=None, resume=False, checkpoint_tag=None,
+              momentum=None, order='cells', nproc=None, offsets=False,
+              density=None):
+    '''Generate particles in 1D space and save them batch by batch.
+
+    Takes the same parameters as generate_1d, plus the output directory
+    out_dir. Memory use is bounded by batch_size. If two_pass is True, the
+    particles are counted first and then written in place to preallocated
+    files (see save_data.save_mapped). If checkpoint is given, progress is
+    saved in out_dir at most every checkpoint seconds, and with resume a run
+    continues from the saved checkpoint (see save_data.save_checkpointed).
+    If momentum is given, the momenta of the particles are written too (see
+    thermal.ThermalMomentum). The files are then sorted for order, with an
+    offsets sidecar if offsets is True (see api.generate). The density
+    defaults to the functions of distributions/d1.py; another number density
+    function (e.g. a gridded.GridDensity) can be given instead. Returns the
+    number of particles written.
+    '''
+    bounds = [(xmin, xmax)]
+    cells = [nx]
+    return generate(1, density, bounds, cells, ppc, out_dir, n_min, progress,
+                    batch_size, workers, seed, two_pass, cull, cull_safety,
+                    table, table_cache, sampling, ppc_min, budget,
+                    jit=jit, profile=profile, checkpoint=checkpoint,
+                    resume=resume, checkpoint_tag=checkpoint_tag,
+                    momentum=momentum, order=order, nproc=nproc,
+                    offsets=offsets)
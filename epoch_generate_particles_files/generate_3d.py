@@ -7,15 +7,16 @@ Part of EPOCH Generate Particles Files.
 This generates particle data by sampling a 3-dimensional number density
 distribution.
 """
-import numpy as np
-
-try:
-    from distributions.d3 import number_density_3d
-except ImportError:
-    raise SystemExit("Failed to import number density distribution funciton.")
+from epoch_generate_particles_files.api import generate
+from epoch_generate_particles_files.sampling import DEFAULT_BATCH_SIZE
+from epoch_generate_particles_files.tabulate import DEFAULT_CACHE_DIR
 
 def generate_3d(xmin, xmax, ymin, ymax, zmin, zmax, nx, ny, nz, ppc,
-                progress=False, n_min=0):
+                progress=False, n_min=0, batch_size=DEFAULT_BATCH_SIZE,
+                workers=1, seed=None, cull=0, cull_safety=2.0, table=None,
+                table_cache=DEFAULT_CACHE_DIR,
+                sampling='random', ppc_min=None, budget=None,
+                jit=False, profile=None):
     '''Generate particles in 3D space.
     
     Parameters
@@ -37,63 +38,89 @@ def generate_3d(xmin, xmax, ymin, ymax, zmin, zmax, nx, ny, nz, ppc,
         density at the sample point is lower than this threshold. Defaults to
         zero (i.e. particles are created at all sample positions; even ones
         with zero weight).
+    batch_size : int, optional
+        Approximate number of sample points evaluated at once. Defaults to
+        DEFAULT_BATCH_SIZE.
+    workers : int, optional
+        Number of processes sampling slabs of cells in parallel. Defaults to 1.
+    seed : int, optional
+        Seed of the random numbers. Runs with the same seed and parameters give
+        identical particles. Defaults to a fresh random seed.
+    cull : int, optional
+        If positive and n_min is positive, skip blocks of cull cells per side
+        in which the number density cannot reach n_min (see culling.py).
+        Defaults to 0 (no culling).
+    cull_safety : float, optional
+        Safety factor applied to the probed density when culling. Defaults
+        to 2.
+    table : sequence of int, optional
+        If given, tabulate the number density once on a lattice with this many
+        points in each direction (a single value applies to all directions)
+        and interpolate from the table (see tabulate.py). Defaults to None.
+    table_cache : str, optional
+        Directory in which tables are cached. Defaults to DEFAULT_CACHE_DIR.
+    sampling : str, optional
+        How particles are placed within a cell: 'random', 'jittered' (one per
+        stratum), 'sobol' (randomly shifted Sobol points) or 'regular' (centres
+        of the strata). Defaults to 'random'.
+    ppc_min : int, optional
+        If given, the number of particles per cell is adapted to the density
+        (or to importance_Nd, if defined in the distributions file) between
+        ppc_min and ppc (see allocation.py). Defaults to None.
+    budget : int, optional
+        If given, adapt the number of particles per cell so that roughly this
+        many particles are generated in total, with at most ppc and at least
+        ppc_min (default 1) per cell. Defaults to None.
+    jit : bool, optional
+        Whether to compile the number density function with Numba, if
+        installed, and fuse it with the sampling loop (see jit.py). Defaults
+        to False.
+    profile : profiling.Profile, optional
+        If given, the phases of the run are timed and added to it. Defaults to
+        None.
     '''
-    cell_size_x = (xmax - xmin) / nx
-    cell_size_y = (ymax - ymin) / ny
-    cell_size_z = (zmax - zmin) / nz
-    cell_vol = cell_size_x * cell_size_y * cell_size_z
+    bounds = [(xmin, xmax), (ymin, ymax), (zmin, zmax)]
+    cells = [nx, ny, nz]
+    data = generate(3, None, bounds, cells, ppc, n_min=n_min,
+                    progress=progress, batch_size=batch_size, workers=workers,
+                    seed=seed, cull=cull, cull_safety=cull_safety, table=table,
+                    table_cache=table_cache, sampling=sampling,
+                    ppc_min=ppc_min, budget=budget, jit=jit,
+                    profile=profile)
 
-    # initialise lists to be populated
-    x_list = []
-    y_list = []
-    z_list = []
-    n_list = []
-    w_list = []
-    
-    # start at lower boundary
-    x_current = xmin
-    y_current = ymin
-    z_current = zmin    
-    
-    # sample the cells
-    if progress:
-        try: 
-            from tqdm import tqdm
-        except ImportError:
-            print("No tqdm found.")
-            progress = False
-    if progress:
-        pbar = tqdm(total=np.ceil((xmax-xmin)/cell_size_x))
-    while x_current < xmax:
-        while y_current < ymax:
-            while z_current < zmax:
-                # randomly sample cell space
-                x_rands = np.random.uniform(0, cell_size_x, ppc)
-                x_rands += x_current
-                y_rands = np.random.uniform(0, cell_size_y, ppc)
-                y_rands += y_current
-                z_rands = np.random.uniform(0, cell_size_z, ppc)
-                z_rands += z_current
+    return data['x'], data['y'], data['z'], data['n'], data['w']
 
-                # get number density values
-                n_samp = number_density_3d(x_rands, y_rands, z_rands)
-                
-                # add particles to list if they exceed the minimum n
-                for i in range(ppc):
-                    if n_samp[i] >= n_min:
-                        x_list.append(x_rands[i])
-                        y_list.append(y_rands[i])
-                        z_list.append(z_rands[i])
-                        n_list.append(n_samp[i])
-                        w_list.append(n_samp[i] * cell_vol / ppc)
-                        
-                z_current += cell_size_y
-            z_current = zmin
-            y_current += cell_size_y
-        y_current = ymin
-        x_current += cell_size_x
 
-        if progress:
-            pbar.update(1)
-    
-    return x_list, y_list, z_list, n_list, w_list
\ No newline at end of file
+def stream_3d(xmin, xmax, ymin, ymax, zmin, zmax, nx, ny, nz, ppc, out_dir,
+              progress=False, n_min=0, batch_size=DEFAULT_BATCH_SIZE,
+              workers=1, seed=None, two_pass=False, cull=0,
+              cull_safety=2.0, table=None,
+              table_cache=DEFAULT_CACHE_DIR, sampling='random',
+              ppc_min=None, budget=None, jit=False, profile=None,
+              checkpoint=None, resume=False, checkpoint_tag=None,
+              momentum=None, order='cells', nproc=None, offsets=False,
+              density=None):
+    '''Generate particles in 3D space and save them batch by batch.
+
+    Takes the same parameters as generate_3d, plus the output directory
+    out_dir. Memory use is bounded by batch_size. If two_pass is True, the
+    particles are counted first and then written in place to preallocated
+    files (see save_data.save_mapped). If checkpoint is given, progress is
+    saved in out_dir at most every checkpoint seconds, and with resume a run
+    continues from the saved checkpoint (see save_data.save_checkpointed).
+    If momentum is given, the momenta of the particles are written too (see
+    thermal.ThermalMomentum). The files are then sorted for order, with an
+    offsets sidecar if offsets is True (see api.generate). The density
+    defaults to the functions of distributions/d3.py; another number density
+    function (e.g. a gridded.GridDensity) can be given instead. Returns the
+    number of particles written.
+    '''
+    bounds = [(xmin, xmax), (ymin, ymax), (zmin, zmax)]
+    cells = [nx, ny, nz]
+    return generate(3, density, bounds, cells, ppc, out_dir, n_min, progress,
+                    batch_size, workers, seed, two_pass, cull, cull_safety,
+                    table, table_cache, sampling, ppc_min, budget,
+                    jit=jit, profile=profile, checkpoint=checkpoint,
+                    resume=resume, checkpoint_tag=checkpoint_tag,
+                    momentum=momentum, order=order, nproc=nproc,
+                    offsets=offsets)
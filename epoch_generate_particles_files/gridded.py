@@ -0,0 +1,226 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Number densities given on a grid, e.g. by a hydrodynamics simulation.
+
+The grid is read from a .npy file or a raw binary file through np.memmap, so
+it is never loaded whole, and the density is multilinearly interpolated
+between its points (see tabulate.interpolate). The generator visits the cells
+slab by slab along x, and the points of a call are interpolated from windows
+of consecutive planes of the grid along its slowest axis, read one at a time,
+so only the part of the grid a batch needs (at most DEFAULT_WINDOW_BYTES) is
+resident at once. Arrays in C order, with x slowest, match the slabs of the
+generator; Fortran-ordered arrays work but every batch reads across the whole
+file.
+
+A GridDensity can be used like any number density function, e.g. in
+distributions/d3.py:
+
+    number_density_3d = GridDensity('rho.npy', [x_centres, y_centres,
+                                                z_centres])
+
+or with the --grid options of main.py.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.tabulate import interpolate
+
+
+# largest number of bytes of the grid read at a time
+DEFAULT_WINDOW_BYTES = 2 ** 27
+
+GRID_ORDERS = ('C', 'F')
+
+
+def load_axis(path):
+    '''Return grid coordinates stored in a .npy or text file.'''
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path)
+
+
+class GridDensity:
+    '''Number density function interpolated from a grid stored on disk.
+
+    Instances are called like a number density function, with one coordinate
+    array per dimension. Only the description of the grid is pickled, so they
+    can be passed cheaply to worker processes, which memory-map the grid on
+    first use.
+
+    Parameters
+    ----------
+    path : str
+        A .npy file, or a raw binary file of shape values of type dtype.
+    axes : sequence
+        Coordinates of the grid points along each direction, as an increasing
+        array with one value per point, or as the (first, last) coordinates
+        of evenly spaced points. Points outside the grid take the value at
+        its edge.
+    shape : sequence of int, optional
+        Number of points in each direction of a raw file.
+    dtype : str, optional
+        Type of the values of a raw file. Defaults to 'float64'.
+    order : str, optional
+        'C' (x slowest) or 'F' (x fastest) memory layout of a raw file.
+        Defaults to 'C'.
+    offset : int, optional
+        Bytes to skip at the start of a raw file (e.g. a header). Defaults to
+        0.
+    scale : float, optional
+        Factor the values are multiplied by, e.g. to convert them to m^-3.
+        Defaults to 1.
+    max_bytes : int, optional
+        Largest number of bytes of the grid read at a time. Defaults to
+        DEFAULT_WINDOW_BYTES.
+
+    Raises
+    ------
+    ValueError
+        If the grid and axes do not match, the axes are not increasing or a
+        direction has fewer than two points.
+    '''
+
+    def __init__(self, path, axes, shape=None, dtype='float64', order='C',
+                 offset=0, scale=1.0, max_bytes=DEFAULT_WINDOW_BYTES):
+        if order not in GRID_ORDERS:
+            raise ValueError(f"Unknown grid order '{order}'.")
+        self.path = os.path.abspath(path)
+        self.raw = None
+        if not path.endswith('.npy'):
+            if shape is None:
+                raise ValueError("A raw grid needs its shape.")
+            self.raw = dict(dtype=np.dtype(dtype).str, order=order,
+                            offset=int(offset),
+                            shape=tuple(int(n) for n in shape))
+        self._table = None
+        table = self.table()
+        if len(axes) != table.ndim:
+            raise ValueError("Need the axes of each direction of the grid.")
+        if min(table.shape) < 2:
+            raise ValueError("The grid needs two points in each direction.")
+        self.axes = []
+        self.uniform = []
+        for axis, n in zip(axes, table.shape):
+            axis = np.asarray(axis, dtype=np.float64)
+            if axis.size == 2 and n != 2:
+                axis = np.linspace(axis[0], axis[1], n)
+            if axis.size != n:
+                raise ValueError(
+                    f"An axis has {axis.size} coordinates for {n} points."
+                )
+            steps = np.diff(axis)
+            if np.any(steps <= 0):
+                raise ValueError("Grid coordinates must be increasing.")
+            self.axes.append(axis)
+            self.uniform.append(bool(np.allclose(steps, steps[0],
+                                                 rtol=1e-9, atol=0)))
+        self.scale = float(scale)
+        self.max_bytes = int(max_bytes)
+        # the slowest axis, along which windows are contiguous on disk
+        fortran = table.flags.f_contiguous and not table.flags.c_contiguous
+        self.window_axis = table.ndim - 1 if fortran else 0
+        # read by tabulate.source_hash and cache.run_key
+        self.__qualname__ = f'{type(self).__qualname__}({self.path})'
+
+    def table(self):
+        '''Return the memory-mapped grid.'''
+        if self._table is None:
+            if self.raw is None:
+                self._table = np.load(self.path, mmap_mode='r')
+            else:
+                self._table = np.memmap(self.path, mode='r', **self.raw)
+        return self._table
+
+    def fingerprint(self):
+        '''Return a hash identifying the grid, its file and axes.'''
+        stat = os.stat(self.path)
+        digest = hashlib.sha256(repr((
+            self.path, stat.st_size, stat.st_mtime_ns, self.raw, self.scale
+        )).encode())
+        for axis in self.axes:
+            digest.update(axis.tobytes())
+        return digest.hexdigest()
+
+    def index_coords(self, coords):
+        '''Return the coordinates in units of grid points, from 0 to n - 1
+        along each direction.
+        '''
+        result = []
+        for axis, uniform, c in zip(self.axes, self.uniform, coords):
+            n = axis.size
+            if uniform:
+                u = (c - axis[0]) / (axis[-1] - axis[0]) * (n - 1)
+            else:
+                i = np.clip(np.searchsorted(axis, c, side='right') - 1, 0,
+                            n - 2)
+                u = i + np.clip((c - axis[i]) / (axis[i + 1] - axis[i]), 0, 1)
+            result.append(np.clip(u, 0, n - 1))
+        return result
+
+    def __call__(self, *coords):
+        coords = np.broadcast_arrays(*coords)
+        shape = coords[0].shape
+        u = self.index_coords([np.ravel(c) for c in coords])
+        table = self.table()
+        a = self.window_axis
+        n = table.shape[a]
+        plane = table.itemsize * table.size // n
+        # planes per window, overlapping by one so every point finds both
+        # of its neighbouring planes in a single window
+        window = max(2, self.max_bytes // plane)
+        first = np.clip(np.floor(u[a]).astype(np.intp), 0, n - 2)
+        group = first // (window - 1)
+        result = np.empty(first.size)
+        extents = [(0, m - 1) for m in table.shape]
+        groups = np.unique(group)
+        for g in groups:
+            select = (slice(None) if groups.size == 1
+                      else np.flatnonzero(group == g))
+            # only the planes between the points of the window are read
+            start = int(first[select].min())
+            stop = int(first[select].max()) + 2
+            index = (slice(None),) * a + (slice(start, stop),)
+            slab = np.asarray(table[index], dtype=np.float64)
+            extents[a] = (start, stop - 1)
+            result[select] = interpolate(slab, extents,
+                                         *(v[select] for v in u))
+        return self.scale * result.reshape(shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = None
+        return state
+
+
+def grid_distribution(args):
+    '''Return the distribution of the --grid options, if given.
+
+    The result has the keys of api.load_distribution, with a GridDensity as
+    the density and no other function. Without --grid-axes the grid points
+    span the domain, from its lower to its upper boundary.
+
+    Raises
+    ------
+    OSError
+        If a file cannot be read.
+    ValueError
+        If the grid and axes do not match.
+    '''
+    if args.grid is None:
+        return None
+    dim = args.dimensions
+    if args.grid_axes is not None:
+        axes = [load_axis(path) for path in args.grid_axes]
+    else:
+        axes = [(args.xmin, args.xmax), (args.ymin, args.ymax),
+                (args.zmin, args.zmax)][:dim]
+    density = GridDensity(args.grid, axes, args.grid_shape, args.grid_dtype,
+                          args.grid_order, args.grid_offset, args.grid_scale)
+    return dict(density=density, max_density=None, importance=None,
+                factors=None, temperature=None, drift=None)
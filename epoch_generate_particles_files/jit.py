@@ -0,0 +1,202 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Optional Numba compilation of number density functions.
+
+The density function is compiled for scalar arguments, so it can be written
+with plain if/else branches (ramps, plateaus, foil edges) rather than chains of
+np.where, and it is fused with the placement of the particles, the n_min cut
+and the weights into a single loop over the particles of a batch, without any
+temporary arrays. Plain Python helper functions it calls through the globals
+of its module are compiled along with it, so the distribution files need not
+import numba.
+
+Numba is imported only when compilation is requested. If it is not installed,
+or the function cannot be compiled, the NumPy path is used instead.
+"""
+import types
+
+import numpy as np
+
+
+def _import_numba():
+    '''Return the numba module, or None if it is not installed.'''
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+def jit_density(density, bounds):
+    '''Return a JitDensity compiled from density, or density if that fails.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function taking one scalar coordinate per dimension.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction. The function is compiled
+        by evaluating it at the lower corner.
+    '''
+    if _import_numba() is None:
+        print("No numba found, using NumPy.")
+        return density
+    jitted = JitDensity(density, len(bounds))
+    try:
+        jitted(*(np.array([lo], dtype=np.float64) for lo, _ in bounds))
+    except Exception as err:
+        # numba reports typing and lowering failures with many exception types
+        print(f"Failed to compile the density function ({type(err).__name__})"
+              ", using NumPy.")
+        return density
+    return jitted
+
+
+class JitDensity:
+    '''Number density function compiled with Numba.
+
+    Instances are called like the function they replace, with one coordinate
+    array per dimension. The sampling engine also uses sample to generate a
+    batch of particles in a single fused loop. Only the original function is
+    pickled, so worker processes compile their own copy on first use.
+    '''
+
+    def __init__(self, density, ndim):
+        self.density = density
+        self.ndim = ndim
+        self._kernels = None
+
+    def __call__(self, *coords):
+        evaluate, _ = self._compile()
+        coords = np.broadcast_arrays(*coords)
+        shape = coords[0].shape
+        points = np.stack([np.ravel(c).astype(np.float64) for c in coords])
+        out = np.empty(points.shape[1])
+        evaluate(points, out)
+        return out.reshape(shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_kernels'] = None
+        return state
+
+    def sample(self, origins, sizes, frac, counts, n_min):
+        '''Place, evaluate, cut and weight the particles of a batch of cells.
+
+        Parameters
+        ----------
+        origins : array
+            Lower corner of every cell, of shape (ndim, n_cells).
+        sizes : sequence of float
+            Cell size in each direction.
+        frac : array
+            Positions of the particles within their cells, as fractions of the
+            cell size, of shape (ndim, n_cells, ppc).
+        counts : array of int
+            Number of particles used in each cell, taken from the start of
+            frac.
+        n_min : float
+            Minimum number density value.
+
+        Returns
+        -------
+        Coordinates (one array per dimension), number densities, weights and
+        slots (index of the cell times ppc plus index within the cell) of the
+        particles kept, in cell order.
+        '''
+        _, sample = self._compile()
+        total = int(np.sum(counts))
+        out_coords = np.empty((self.ndim, total))
+        out_n = np.empty(total)
+        out_w = np.empty(total)
+        out_slot = np.empty(total, dtype=np.int64)
+        kept = sample(np.ascontiguousarray(origins, dtype=np.float64),
+                      np.array(sizes, dtype=np.float64),
+                      np.ascontiguousarray(frac, dtype=np.float64),
+                      np.ascontiguousarray(counts, dtype=np.int64),
+                      float(n_min), float(np.prod(sizes)),
+                      out_coords, out_n, out_w, out_slot)
+        return (list(out_coords[:, :kept]), out_n[:kept], out_w[:kept],
+                out_slot[:kept])
+
+    def _compile(self):
+        '''Return the compiled evaluation and sampling kernels.'''
+        if self._kernels is None:
+            self._kernels = _make_kernels(_import_numba(), self.density,
+                                          self.ndim)
+        return self._kernels
+
+
+def _with_compiled_helpers(numba, function, done=None):
+    '''Return a copy of function calling compiled copies of the plain Python
+    functions among its globals, themselves treated the same way.
+    '''
+    if done is None:
+        done = {}
+    if function in done:
+        return done[function]
+    namespace = dict(function.__globals__)
+    copy = types.FunctionType(function.__code__, namespace, function.__name__,
+                              function.__defaults__, function.__closure__)
+    copy.__kwdefaults__ = function.__kwdefaults__
+    done[function] = copy
+    for name in function.__code__.co_names:
+        helper = namespace.get(name)
+        if isinstance(helper, types.FunctionType):
+            namespace[name] = numba.njit(
+                _with_compiled_helpers(numba, helper, done))
+    return copy
+
+
+def _make_kernels(numba, density, ndim):
+    '''Compile density and the loops that call it.'''
+    if isinstance(density, types.FunctionType):
+        density = _with_compiled_helpers(numba, density)
+    scalar = numba.njit(density)
+
+    # unpack a position into the arguments of the density function
+    if ndim == 1:
+        @numba.njit
+        def call(pos):
+            return scalar(pos[0])
+    elif ndim == 2:
+        @numba.njit
+        def call(pos):
+            return scalar(pos[0], pos[1])
+    else:
+        @numba.njit
+        def call(pos):
+            return scalar(pos[0], pos[1], pos[2])
+
+    @numba.njit
+    def evaluate(points, out):
+        pos = np.empty(ndim)
+        for i in range(out.size):
+            for d in range(ndim):
+                pos[d] = points[d, i]
+            out[i] = call(pos)
+
+    @numba.njit
+    def sample(origins, sizes, frac, counts, n_min, volume, out_coords, out_n,
+               out_w, out_slot):
+        pos = np.empty(ndim)
+        kept = 0
+        for c in range(counts.size):
+            for p in range(counts[c]):
+                for d in range(ndim):
+                    pos[d] = origins[d, c] + frac[d, c, p] * sizes[d]
+                n = call(pos)
+                if n >= n_min:
+                    for d in range(ndim):
+                        out_coords[d, kept] = pos[d]
+                    out_n[kept] = n
+                    out_w[kept] = n * volume / counts[c]
+                    out_slot[kept] = c * frac.shape[2] + p
+                    kept += 1
+        return kept
+
+    return evaluate, sample
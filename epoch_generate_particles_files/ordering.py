@@ -0,0 +1,361 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Spatial ordering of the particles in the output files.
+
+The generators write the particles cell by cell, in the order of nested loops
+over x, y and z. The particles can instead be ordered by the subdomain of a
+processor grid they fall in, so that the particles of every MPI rank form a
+contiguous range of the files, or along a Morton (Z-order) curve through the
+cells, which keeps particles that are close in space close in the files.
+
+Files are sorted out of core. A first pass counts the particles of every
+bucket (a rank, or a block of cells along the Morton curve), the second
+scatters each chunk of particles to its buckets' ranges of new files through
+np.memmap, keeping the order of the particles within a bucket. Morton buckets
+are then sorted in memory, a few at a time. Memory use is therefore bounded by
+the chunk size, whatever the size of the files. Optionally a sidecar file
+records the range of the files holding each rank or block.
+"""
+import json
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.binning import (
+    DEFAULT_CHUNK_SIZE, bin_index, iter_chunks)
+from epoch_generate_particles_files.sampling import AXES
+
+
+ORDERS = ('cells', 'procs', 'morton')
+
+OFFSETS_NAME = 'offsets.json'
+
+# fewest buckets the Morton curve is split into when sorting files
+_MIN_MORTON_BUCKETS = 2 ** 16
+
+
+def rank_starts(n, nproc):
+    '''Return the first cell of each of nproc ranks sharing n cells,
+    followed by n.
+
+    The numbers of cells of the ranks differ by at most one. Cell i belongs
+    to rank i * nproc // n.
+    '''
+    return -(-np.arange(nproc + 1) * n // nproc)
+
+
+def cell_indices(coords, bounds, cells):
+    '''Return the cell index of each particle in each direction.'''
+    return [bin_index(c, lo, hi, n)
+            for c, (lo, hi), n in zip(coords, bounds, cells)]
+
+
+def rank_of(index, cells, nproc):
+    '''Return the flat index of the rank (in C order) of each particle.
+
+    Parameters
+    ----------
+    index : list of array
+        Cell index of the particles in each direction (see cell_indices).
+    cells : sequence of int
+        Number of cells in each direction.
+    nproc : sequence of int
+        Number of ranks in each direction.
+    '''
+    rank = np.zeros(index[0].shape, dtype=np.int64)
+    for i, n, p in zip(index, cells, nproc):
+        rank = rank * p + i * p // n
+    return rank
+
+
+def morton_bits(cells):
+    '''Return the number of bits of the cell index in each direction.
+
+    Raises
+    ------
+    ValueError
+        If the Morton codes of the cells do not fit in 63 bits.
+    '''
+    bits = max(int(n - 1).bit_length() for n in cells)
+    if bits * len(cells) > 63:
+        raise ValueError("Too many cells for Morton ordering.")
+    return bits
+
+
+def morton_code(index, bits):
+    '''Return the Morton code of cells, interleaving the bits of their index.
+
+    Parameters
+    ----------
+    index : list of array
+        Cell index in each direction (see cell_indices). The bits of the
+        first direction are the most significant.
+    bits : int
+        Number of bits of each index (see morton_bits).
+    '''
+    code = np.zeros(index[0].shape, dtype=np.int64)
+    for b in range(bits - 1, -1, -1):
+        for i in index:
+            code = (code << 1) | ((i >> b) & 1)
+    return code
+
+
+def morton_decode(code, bits, ndim):
+    '''Return the cell index in each direction of Morton codes (the inverse
+    of morton_code).
+    '''
+    code = np.asarray(code, dtype=np.int64)
+    index = [np.zeros(code.shape, dtype=np.int64) for _ in range(ndim)]
+    for b in range(bits):
+        for d in range(ndim):
+            index[d] |= ((code >> (b * ndim + ndim - 1 - d)) & 1) << b
+    return index
+
+
+def sort_keys(coords, bounds, cells, order, nproc=None):
+    '''Return the key particles are sorted by (stably) for an order.
+
+    Parameters
+    ----------
+    coords : list of array
+        Coordinates of the particles in each direction.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    order : str
+        'procs' (the rank of the processor grid nproc) or 'morton'.
+    nproc : sequence of int, optional
+        Number of ranks in each direction, for order 'procs'.
+    '''
+    index = cell_indices(coords, bounds, cells)
+    if order == 'procs':
+        return rank_of(index, cells, nproc)
+    return morton_code(index, morton_bits(cells))
+
+
+def order_arrays(data, bounds, cells, order, nproc=None):
+    '''Return a dictionary of particle arrays sorted for an order.'''
+    if order == 'cells':
+        return data
+    coords = [data[axis] for axis in AXES[:len(cells)]]
+    perm = np.argsort(sort_keys(coords, bounds, cells, order, nproc),
+                      kind='stable')
+    return {key: values[perm] for key, values in data.items()}
+
+
+def _iter_sources(directory, keys, species, chunk_size):
+    '''Yield chunks of the particle files of directory, followed by the
+    weights of each of the species directories.
+    '''
+    chunks = [iter_chunks(directory, keys, chunk_size)]
+    chunks += [iter_chunks(other, ['w'], chunk_size) for other in species]
+    for parts in zip(*chunks):
+        yield [values for part in parts for values in part]
+
+
+def _scatter(directory, keys, species, paths, bucket_of, n_buckets,
+             chunk_size):
+    '''Counting sort of the particle files into new files at paths.
+
+    The files are those of keys in directory, followed by the weights of the
+    species directories. bucket_of returns the bucket of each particle of a
+    chunk, from its coordinates. Returns the number of particles in each
+    bucket.
+    '''
+    ndim = sum(key in AXES for key in keys)
+    counts = np.zeros(n_buckets, dtype=np.int64)
+    for chunk in iter_chunks(directory, AXES[:ndim], chunk_size):
+        counts += np.bincount(bucket_of(chunk), minlength=n_buckets)
+    total = int(counts.sum())
+    for path in paths:
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, 'wb') as f:
+            f.truncate(total * 8)
+    if total == 0:
+        return counts
+
+    outputs = [np.memmap(path, dtype=np.float64, mode='r+', shape=(total,))
+               for path in paths]
+    cursor = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    for chunk in _iter_sources(directory, keys, species, chunk_size):
+        bucket = bucket_of(chunk[:ndim])
+        perm = np.argsort(bucket, kind='stable')
+        bucket = bucket[perm]
+        starts = np.flatnonzero(np.diff(bucket, prepend=-1))
+        sizes = np.diff(np.append(starts, bucket.size))
+        dest = (np.repeat(cursor[bucket[starts]] - starts, sizes)
+                + np.arange(bucket.size))
+        for out, values in zip(outputs, chunk):
+            out[dest] = values[perm]
+        cursor[bucket[starts]] += sizes
+    for out in outputs:
+        out.flush()
+    return counts
+
+
+def _sort_groups(paths, keys, counts, key_of, chunk_size):
+    '''Sort runs of consecutive buckets of the files in memory.
+
+    Buckets are gathered into groups of at most chunk_size particles (or a
+    single larger bucket), and each group is sorted by key_of, a function of
+    the coordinates of its particles.
+    '''
+    ndim = sum(key in AXES for key in keys)
+    ends = np.cumsum(counts)
+    first = 0
+    while first < ends[-1]:
+        # the furthest bucket end within chunk_size of first
+        i = np.searchsorted(ends, first + chunk_size, side='right') - 1
+        if i < 0 or ends[i] <= first:
+            # a single bucket larger than chunk_size
+            i = np.searchsorted(ends, first, side='right')
+        last = int(ends[i])
+        files = [np.memmap(path, dtype=np.float64, mode='r+',
+                           offset=first * 8, shape=(last - first,))
+                 for path in paths]
+        perm = np.argsort(key_of([np.asarray(f) for f in files[:ndim]]),
+                          kind='stable')
+        for f in files:
+            f[:] = np.asarray(f)[perm]
+            f.flush()
+        del files
+        first = last
+
+
+def sort_files(directory, keys, bounds, cells, order, nproc=None,
+               offsets=False, chunk_size=DEFAULT_CHUNK_SIZE, species=()):
+    '''Sort the particle files in directory for an order, out of core.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the file 'k_data.dat' for each k in keys.
+    keys : sequence of str
+        Names of the quantities of the particles, starting with the
+        coordinates.
+    bounds, cells, order, nproc
+        See sort_keys. Nothing is done for order 'cells'.
+    offsets : bool, optional
+        Whether to write the sidecar OFFSETS_NAME (see read_offsets). Defaults
+        to False.
+    chunk_size : int, optional
+        Number of particles held in memory at a time. Defaults to
+        DEFAULT_CHUNK_SIZE.
+    species : sequence of str, optional
+        Directories of other species sharing the particles of directory,
+        whose weight files 'w_data.dat' are permuted like the files of
+        directory (and get the same sidecar). Their other files are left
+        alone. Defaults to none.
+
+    Returns
+    -------
+    The content of the sidecar, or None if offsets is False.
+    '''
+    for other in (directory,) + tuple(species):
+        remove_offsets(other)
+    if order == 'cells':
+        return None
+    paths = [os.path.join(directory, f'{key}_data.dat') for key in keys]
+    paths += [os.path.join(other, 'w_data.dat') for other in species]
+    tmp_paths = [f'{path}.{os.getpid()}.tmp' for path in paths]
+    total = os.path.getsize(paths[0]) // 8
+    if order == 'procs':
+        n_buckets = int(np.prod(nproc))
+        shift = 0
+
+        def bucket_of(coords):
+            return sort_keys(coords, bounds, cells, 'procs', nproc)
+    else:
+        bits = len(cells) * morton_bits(cells)
+        wanted = max(_MIN_MORTON_BUCKETS, 4 * total // chunk_size)
+        shift = max(0, bits - int(wanted - 1).bit_length())
+        n_buckets = 1 << (bits - shift)
+
+        def bucket_of(coords):
+            return sort_keys(coords, bounds, cells, 'morton') >> shift
+
+    try:
+        counts = _scatter(directory, keys, species, tmp_paths, bucket_of,
+                          n_buckets, chunk_size)
+        if order == 'morton' and total:
+            _sort_groups(tmp_paths, keys, counts,
+                         lambda coords: sort_keys(coords, bounds, cells,
+                                                  'morton'),
+                         chunk_size)
+        for tmp_path, path in zip(tmp_paths, paths):
+            os.replace(tmp_path, path)
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    if not offsets:
+        return None
+    sidecar = _offsets(order, bounds, cells, nproc, shift, counts)
+    for other in (directory,) + tuple(species):
+        with open(os.path.join(other, OFFSETS_NAME), 'w') as f:
+            json.dump(sidecar, f)
+    return sidecar
+
+
+def _offsets(order, bounds, cells, nproc, shift, counts):
+    '''Return the content of the offsets sidecar of sorted files.'''
+    firsts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sidecar = dict(order=order, bounds=[list(b) for b in bounds],
+                   cells=[int(n) for n in cells], particles=int(counts.sum()),
+                   bytes_per_particle=8)
+    if order == 'procs':
+        sidecar['nproc'] = [int(p) for p in nproc]
+        starts = [rank_starts(n, p) for n, p in zip(cells, nproc)]
+        sizes = [(hi - lo) / n for (lo, hi), n in zip(bounds, cells)]
+        ranks = []
+        for rank, index in enumerate(np.ndindex(*nproc)):
+            cell_range = [[int(s[i]), int(s[i + 1])]
+                          for s, i in zip(starts, index)]
+            ranks.append(dict(
+                index=list(index), cells=cell_range,
+                bounds=[[lo + a * size, lo + b * size]
+                        for (lo, _), (a, b), size
+                        in zip(bounds, cell_range, sizes)],
+                first=int(firsts[rank]), count=int(counts[rank]),
+            ))
+        sidecar['ranks'] = ranks
+    else:
+        # non-empty blocks of 2**shift consecutive cells along the curve
+        sidecar['shift'] = shift
+        used = np.flatnonzero(counts)
+        sidecar['blocks'] = [[int(b), int(firsts[b]), int(counts[b])]
+                             for b in used]
+    return sidecar
+
+
+def remove_offsets(directory):
+    '''Remove the offsets sidecar of directory, if any.'''
+    path = os.path.join(directory, OFFSETS_NAME)
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def read_offsets(directory):
+    '''Return the offsets sidecar of directory, or None if there is none.
+
+    The sidecar holds the 'order' of the files, the 'bounds' and 'cells' of
+    the grid and the number of 'particles'. For order 'procs' it also holds
+    'nproc' and a list of 'ranks', each with its 'index' in the processor
+    grid, its range of 'cells' and 'bounds' in each direction and the 'first'
+    particle and 'count' of particles it holds. For order 'morton' it holds
+    the 'shift' and a list of 'blocks' [code, first, count]: the particles
+    from first to first + count are those of the cells whose Morton codes
+    (see morton_code) shifted right by shift are code.
+    '''
+    try:
+        with open(os.path.join(directory, OFFSETS_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
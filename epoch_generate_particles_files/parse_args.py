@@ -9,6 +9,20 @@ Contains a function to parse arguments passed to the executable.
 import argparse
 import os
 
+from epoch_generate_particles_files.binning import DEFAULT_MAX_BINS
+from epoch_generate_particles_files.cache import DEFAULT_PARTICLE_CACHE_DIR
+from epoch_generate_particles_files.estimate import DEFAULT_SAMPLE_CELLS
+from epoch_generate_particles_files.gridded import GRID_ORDERS
+from epoch_generate_particles_files.ordering import ORDERS
+from epoch_generate_particles_files.placement import SAMPLING_MODES
+from epoch_generate_particles_files.sampling import (
+    DEFAULT_BATCH_SIZE, SEED_LIMIT)
+from epoch_generate_particles_files.save_data import (
+    DEFAULT_CHECKPOINT_INTERVAL)
+from epoch_generate_particles_files.tabulate import DEFAULT_CACHE_DIR
+from epoch_generate_particles_files.thermal import (
+    SPEED_OF_LIGHT, THERMAL_MODES)
+
 def create_parser():
     '''Create argparse parser.'''
     parser = argparse.ArgumentParser(
@@ -82,11 +96,232 @@ def create_parser():
         '--visy', type=int, default=1000,
         help="Points to plot in y."
     )
+    parser.add_argument(
+        '--bins', type=int, default=DEFAULT_MAX_BINS,
+        help="Largest number of bins in each direction when plotting the "
+             "particles, which are binned by cell. Defaults to "
+             f"{DEFAULT_MAX_BINS}."
+    )
     parser.add_argument(
         '-P', '--progress', dest='progress', action='store_true',
         help="Print a progress bar. Requires tqdm."
     )
-    parser.set_defaults(plot=False, progress=False)
+    parser.add_argument(
+        '--batch', type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of sample points generated and written at a time. Bounds "
+             "the memory use when not plotting. Defaults to "
+             f"{DEFAULT_BATCH_SIZE}."
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help="Number of processes generating slabs of cells in parallel. "
+             "Defaults to 1."
+    )
+    parser.add_argument(
+        '--seed', type=int,
+        help="Seed of the random numbers. Runs with the same seed and "
+             "arguments write identical files, whatever the batch size or "
+             "number of workers. Defaults to a fresh random seed."
+    )
+    parser.add_argument(
+        '--two-pass', dest='two_pass', action='store_true',
+        help="Count the particles first, then write them in place to files "
+             "preallocated with their final size. Lets workers write without "
+             "coordination, at the cost of evaluating the density twice."
+    )
+    parser.add_argument(
+        '--cull', type=int, default=0,
+        help="Probe the density on blocks of this many cells per side and "
+             "skip blocks where it cannot reach nmin. Only used if nmin is "
+             "positive. Defaults to 0 (no culling)."
+    )
+    parser.add_argument(
+        '--cull-safety', dest='cull_safety', type=float, default=2.0,
+        help="Safety factor on the probed density when culling. Defaults to 2."
+    )
+    parser.add_argument(
+        '--tabulate', type=int, nargs='+', metavar='N',
+        help="Evaluate the density once on a lattice of N points per "
+             "direction (one value, or one per dimension), cache it on disk "
+             "and interpolate from it. Useful for expensive density "
+             "functions."
+    )
+    parser.add_argument(
+        '--table-cache', dest='table_cache', default=DEFAULT_CACHE_DIR,
+        help="Directory in which density tables are cached. Defaults to "
+             f"{DEFAULT_CACHE_DIR}."
+    )
+    parser.add_argument(
+        '--sampling', choices=SAMPLING_MODES, default='random',
+        help="How particles are placed within each cell. 'jittered' draws one "
+             "particle per stratum of the cell, 'sobol' uses randomly shifted "
+             "low-discrepancy points and 'regular' places particles at the "
+             "centres of the strata. Stratified and low-discrepancy placement "
+             "reduce the density noise for a given ppc. Defaults to 'random'."
+    )
+    parser.add_argument(
+        '--ppc-min', dest='ppc_min', type=int,
+        help="Adapt the number of particles per cell to the density, from "
+             "ppc_min in the most dilute cells up to ppc in the densest. "
+             "Weights are adjusted so the charge in each cell is unchanged. "
+             "Needs 'random' or 'sobol' sampling."
+    )
+    parser.add_argument(
+        '--budget', type=int,
+        help="Adapt the number of particles per cell to the density so that "
+             "roughly this many particles are generated in total, with at "
+             "most ppc and at least ppc_min (default 1) per cell."
+    )
+    parser.add_argument(
+        '--jit', action='store_true',
+        help="Compile the density function with numba, if installed, fused "
+             "with the sampling loop. Lets the density be written with plain "
+             "if/else branches on scalar coordinates."
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help="Time each phase of the run and print a summary with the "
+             "samples evaluated and accepted, particles/s, peak memory and "
+             "output size."
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="As --profile, and also save the summary as stats.json next to "
+             "the particle files."
+    )
+    parser.add_argument(
+        '--cache', action='store_true',
+        help="Also keep the particle files in a shared cache directory (see "
+             "--cache-dir) and hard-link them from there when a later run has "
+             "the same distribution file, arguments and seed. A matching "
+             "result already in the output directory is always reused."
+    )
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', default=DEFAULT_PARTICLE_CACHE_DIR,
+        help="Shared directory in which particle files are cached with "
+             f"--cache. Defaults to {DEFAULT_PARTICLE_CACHE_DIR}."
+    )
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=float, default=10,
+        help="Size of the shared cache in GiB, beyond which the least "
+             "recently used results are removed. Defaults to 10."
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help="Generate the particles even if a matching result is cached."
+    )
+    parser.add_argument(
+        '--checkpoint', type=float, metavar='SECONDS',
+        help="Save a checkpoint in the output directory at most every SECONDS "
+             "seconds, so that an interrupted run can be resumed. Defaults to "
+             "no checkpoints."
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Continue an interrupted run from the checkpoint in the output "
+             "directory, writing the same files as an uninterrupted run. The "
+             "seed defaults to the seed of the checkpoint. Implies "
+             f"--checkpoint {DEFAULT_CHECKPOINT_INTERVAL:g} unless given."
+    )
+    parser.add_argument(
+        '--thermal', choices=THERMAL_MODES,
+        help="Also generate the momenta of the particles, written to "
+             "px_data.dat, py_data.dat and pz_data.dat, from a drifting "
+             "Maxwellian or (relativistic) Maxwell-Juttner distribution. "
+             "Defaults to no momenta."
+    )
+    parser.add_argument(
+        '--mass', type=float, default=1.0,
+        help="Particle mass in electron masses, used with --thermal. "
+             "Defaults to 1."
+    )
+    parser.add_argument(
+        '--temperature', type=float,
+        help="Temperature in K, used with --thermal unless the distribution "
+             "file defines a temperature_Nd function."
+    )
+    parser.add_argument(
+        '--drift', type=float, nargs=3, default=[0.0, 0.0, 0.0],
+        metavar=('VX', 'VY', 'VZ'),
+        help="Drift velocity in m/s, used with --thermal unless the "
+             "distribution file defines a drift_Nd function. Defaults to 0 0 "
+             "0."
+    )
+    parser.add_argument(
+        '--dry-run', dest='dry_run', type=int, nargs='?',
+        const=DEFAULT_SAMPLE_CELLS, metavar='CELLS',
+        help="Do not generate the particles, but sample CELLS random cells "
+             f"(default {DEFAULT_SAMPLE_CELLS}) and estimate the number of "
+             "particles, the size of each file, the peak memory and the run "
+             "time, with 95%% confidence intervals. Writes nothing."
+    )
+    parser.add_argument(
+        '--grid',
+        help="Read the number density from a grid in a .npy or raw binary "
+             "file, memory-mapped and interpolated, instead of "
+             "distributions/dX.py. The grid is indexed [x, y, z]."
+    )
+    parser.add_argument(
+        '--grid-axes', dest='grid_axes', nargs='+', metavar='FILE',
+        help="Files (.npy or text) holding the coordinates of the grid "
+             "points along each direction. Defaults to points evenly spaced "
+             "from the lower to the upper boundary of the domain."
+    )
+    parser.add_argument(
+        '--grid-shape', dest='grid_shape', type=int, nargs='+',
+        metavar='N', help="Number of points in each direction of a raw grid."
+    )
+    parser.add_argument(
+        '--grid-dtype', dest='grid_dtype', default='float64',
+        help="Type of the values of a raw grid, e.g. float32. Defaults to "
+             "float64."
+    )
+    parser.add_argument(
+        '--grid-order', dest='grid_order', choices=GRID_ORDERS, default='C',
+        help="Memory layout of a raw grid: 'C' (x slowest, read slab by slab "
+             "like the cells are generated) or 'F' (x fastest). Defaults to "
+             "'C'."
+    )
+    parser.add_argument(
+        '--grid-offset', dest='grid_offset', type=int, default=0,
+        help="Bytes to skip at the start of a raw grid. Defaults to 0."
+    )
+    parser.add_argument(
+        '--grid-scale', dest='grid_scale', type=float, default=1.0,
+        help="Factor the grid values are multiplied by to give the number "
+             "density in m^-3. Defaults to 1."
+    )
+    parser.add_argument(
+        '--validate', action='store_true',
+        help="After generating (or reusing) the particles, deposit their "
+             "weights onto the cells in one pass over the files and compare "
+             "them with the integral of the number density over each cell, "
+             "reporting the total error, per-cell deviations and the part "
+             "lost to --nmin."
+    )
+    parser.add_argument(
+        '--order', choices=ORDERS, default='cells',
+        help="Order of the particles in the files: cell by cell ('cells'), "
+             "grouped by the MPI rank of the processor grid given by --nproc "
+             "('procs'), or along a Morton curve through the cells "
+             "('morton'). The files are sorted out of core once written. "
+             "Defaults to 'cells'."
+    )
+    parser.add_argument(
+        '--nproc', type=int, nargs='+', metavar=('NX', 'NY'),
+        help="Number of MPI ranks in each direction, used with --order procs. "
+             "Should match the processor grid EPOCH decomposes the domain "
+             "into."
+    )
+    parser.add_argument(
+        '--offsets', action='store_true',
+        help="With --order procs or morton, also write offsets.json, giving "
+             "the range of particles in the files held by each rank or block "
+             "of cells."
+    )
+    parser.set_defaults(plot=False, progress=False, two_pass=False, jit=False,
+                        profile=False, stats=False, cache=False, force=False,
+                        resume=False, offsets=False, validate=False)
     
     return parser
 
@@ -108,6 +343,64 @@ def check_valid_args(args):
         return (False, "2D but missing ny.")
     elif args.dimensions == 3 and (not args.ny or not args.nz):
         return (False, "3D but missing ny or nz.")
+    elif args.batch < 1:
+        return (False, "batch must be positive.")
+    elif args.workers < 1:
+        return (False, "workers must be positive.")
+    elif args.seed is not None and not 0 <= args.seed < SEED_LIMIT:
+        return (False, "seed must be between 0 and 2**64 - 1.")
+    elif args.cull < 0:
+        return (False, "cull must not be negative.")
+    elif args.tabulate and len(args.tabulate) not in (1, args.dimensions):
+        return (False, "tabulate needs one value or one per dimension.")
+    elif args.tabulate and min(args.tabulate) < 2:
+        return (False, "tabulate needs at least 2 points per direction.")
+    elif args.ppc_min is not None and not 1 <= args.ppc_min <= args.ppc:
+        return (False, "ppc_min must be between 1 and ppc.")
+    elif args.budget is not None and args.budget < 1:
+        return (False, "budget must be positive.")
+    elif ((args.ppc_min is not None or args.budget is not None)
+          and args.sampling not in ('random', 'sobol')):
+        return (False, "Adaptive ppc needs 'random' or 'sobol' sampling.")
+    elif args.bins < 1:
+        return (False, "bins must be positive.")
+    elif args.cache_size < 0:
+        return (False, "cache_size must not be negative.")
+    elif args.checkpoint is not None and args.checkpoint < 0:
+        return (False, "checkpoint must not be negative.")
+    elif args.two_pass and (args.checkpoint is not None or args.resume):
+        return (False, "Checkpoints cannot be combined with two-pass.")
+    elif args.dry_run is not None and args.dry_run < 1:
+        return (False, "dry-run needs at least one cell.")
+    elif args.mass <= 0:
+        return (False, "mass must be positive.")
+    elif args.temperature is not None and args.temperature < 0:
+        return (False, "temperature must not be negative.")
+    elif (args.thermal == 'juttner'
+          and sum(v ** 2 for v in args.drift) >= SPEED_OF_LIGHT ** 2):
+        return (False, "drift must be below the speed of light.")
+    elif args.order == 'procs' and (args.nproc is None
+                                    or len(args.nproc) != args.dimensions):
+        return (False, "order procs needs nproc for each dimension.")
+    elif args.nproc is not None and args.order != 'procs':
+        return (False, "nproc is only used with order procs.")
+    elif args.nproc is not None and any(
+            not 1 <= p <= n for p, n
+            in zip(args.nproc, [args.nx, args.ny, args.nz])):
+        return (False, "nproc must be between 1 and the number of cells.")
+    elif args.offsets and args.order == 'cells':
+        return (False, "offsets needs order procs or morton.")
+    elif args.grid is not None and not os.path.isfile(args.grid):
+        return (False, f"Grid file '{args.grid}' does not exist.")
+    elif (args.grid is not None and not args.grid.endswith('.npy')
+          and (args.grid_shape is None
+               or len(args.grid_shape) != args.dimensions)):
+        return (False, "A raw grid needs grid-shape for each dimension.")
+    elif (args.grid_axes is not None
+          and len(args.grid_axes) != args.dimensions):
+        return (False, "grid-axes needs one file per dimension.")
+    elif args.grid_offset < 0:
+        return (False, "grid-offset must not be negative.")
     elif not os.path.isdir(args.outdir):
         return(
             False,
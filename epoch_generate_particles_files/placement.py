@@ -0,0 +1,124 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Placement of the particles within a cell.
+
+Positions are returned as fractions of the cell size, which the sampling
+engine scales and offsets to each cell's origin. The available schemes are:
+
+random
+    Independent uniform positions.
+jittered
+    The cell is split into ppc equal strata and one uniform position is drawn
+    in each.
+sobol
+    The first ppc points of a Sobol sequence, randomly shifted (modulo one) in
+    each cell. Works best when ppc is a power of two.
+regular
+    The centres of the ppc strata used by jittered; no randomness at all.
+
+Stratified and low-discrepancy placement reduce the sampling noise of the
+density seen by EPOCH, giving the same noise level with fewer particles.
+"""
+import numpy as np
+
+
+SAMPLING_MODES = ('random', 'jittered', 'sobol', 'regular')
+
+# Sobol direction numbers m_k (see Bratley and Fox, 1988) for dimensions two
+# and three, from the primitive polynomials x + 1 and x^2 + x + 1
+_SOBOL_POLYNOMIALS = ((1, 0, (1,)), (2, 1, (1, 3)))
+
+
+def strata_shape(ppc, ndim):
+    '''Split ppc into ndim integer factors that are as equal as possible.'''
+    shape = []
+    remaining = ppc
+    for d in range(ndim - 1, 0, -1):
+        target = round(remaining ** (1 / (d + 1)))
+        factor = max(f for f in range(1, target + 1) if remaining % f == 0)
+        shape.append(factor)
+        remaining //= factor
+    shape.append(remaining)
+    return tuple(shape)
+
+
+def sobol_points(n, ndim, bits=32):
+    '''Return the first n points of the ndim-dimensional Sobol sequence.
+
+    Points are in natural rather than Gray code order, which gives the same
+    set of points whenever n is a power of two. Supports up to three
+    dimensions. The result has shape (ndim, n).
+    '''
+    index = np.arange(n, dtype=np.uint64)
+    points = np.zeros((ndim, n), dtype=np.uint64)
+    for d in range(ndim):
+        if d == 0:
+            m = [1] * bits
+        else:
+            degree, a, m = _SOBOL_POLYNOMIALS[d - 1]
+            m = list(m)
+            for k in range(degree, bits):
+                new = m[k - degree] ^ (m[k - degree] << degree)
+                for j in range(1, degree):
+                    if (a >> (degree - 1 - j)) & 1:
+                        new ^= m[k - j] << j
+                m.append(new)
+        for k in range(bits):
+            direction = np.uint64(m[k] << (bits - 1 - k))
+            bit = (index >> np.uint64(k)) & np.uint64(1)
+            points[d] ^= bit * direction
+    return points / float(2 ** bits)
+
+
+def uniforms_per_cell(sampling, ppc, ndim):
+    '''Return how many random numbers a cell needs for a placement scheme.'''
+    if sampling in ('random', 'jittered'):
+        return ndim * ppc
+    if sampling == 'sobol':
+        return ndim
+    if sampling == 'regular':
+        return 0
+    raise ValueError(f"Unknown sampling mode '{sampling}'.")
+
+
+def cell_fractions(sampling, ppc, ndim, rands):
+    '''Return the positions of the particles within their cells.
+
+    Parameters
+    ----------
+    sampling : str
+        Placement scheme, one of SAMPLING_MODES.
+    ppc : int
+        Number of particles per cell.
+    ndim : int
+        Number of dimensions.
+    rands : array
+        Uniform random numbers of shape (n_cells, k), where k is given by
+        uniforms_per_cell.
+
+    Returns
+    -------
+    Array of shape (ndim, n_cells, ppc) of fractions of the cell size in
+    [0, 1).
+    '''
+    n_cells = rands.shape[0]
+    if sampling == 'random':
+        return rands.reshape(n_cells, ndim, ppc).transpose(1, 0, 2)
+    if sampling == 'sobol':
+        shift = rands.T[:, :, np.newaxis]
+        return (sobol_points(ppc, ndim)[:, np.newaxis, :] + shift) % 1.0
+
+    # index of the stratum of each particle along each direction
+    shape = strata_shape(ppc, ndim)
+    strata = np.indices(shape).reshape(ndim, 1, ppc)
+    if sampling == 'jittered':
+        jitter = rands.reshape(n_cells, ndim, ppc).transpose(1, 0, 2)
+    elif sampling == 'regular':
+        jitter = np.full((ndim, n_cells, ppc), 0.5)
+    else:
+        raise ValueError(f"Unknown sampling mode '{sampling}'.")
+    return (strata + jitter) / np.array(shape).reshape(ndim, 1, 1)
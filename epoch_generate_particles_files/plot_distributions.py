@@ -5,31 +5,40 @@
 Part of EPOCH Generate Particles Files.
 
 Functions to plot distributions and samples.
+
+Rather than drawing every particle, the particles are binned by their weight
+(see binning.py) and drawn as rasterized images, so the plots take the same
+time and file size however many particles there are.
 """
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import os
 
+from epoch_generate_particles_files.binning import (
+    DEFAULT_MAX_BINS, default_bins, density_histogram, density_views,
+    reference_grid)
+
+
+def plot_1d(x_vis, n_vis, x_edges, n_binned, out_dir):
+    '''Plot the distribution and the binned number density of the samples.
 
-def plot_1d(x_vis, n_vis, x_list, n_list, out_dir):
-    '''Plot the distribution and sampled number density values.
-    
     Parameters
     ----------
     x_vis : list
         List of x-coordinate values for the distribution.
     n_vis : list
         List of number density values corresponding to x_vis.
-    x_list : list
-        List of sampled x-coordinate values.
-    n_list : list
-        List of number density values corresponding to x_list.
+    x_edges : array
+        Edges of the bins in x.
+    n_binned : array
+        Number density of the samples in each bin.
     out_dir : str
         Path to output directory.
     '''
     fig, ax = plt.subplots()
     ax.plot(x_vis, n_vis, '-', label='Distribution')
-    ax.plot(x_list, n_list, 'o', alpha=0.5, label='Samples')
+    ax.step(0.5 * (x_edges[1:] + x_edges[:-1]), n_binned, where='mid',
+            alpha=0.7, label='Samples')
     ax.legend()
     ax.grid()
     ax.set_xlabel('$x$ (m)')
@@ -38,47 +47,123 @@ def plot_1d(x_vis, n_vis, x_list, n_list, out_dir):
     fig.tight_layout()
     fig.savefig(os.path.join(out_dir, 'dist-1D.png'))
     plt.close('all')
-    
-    
-def plot_2d(x_vis, y_vis, n_vis, x_list, y_list, n_list, out_dir):
-    '''Plot the distribution and sampled number density values.
-    
+
+
+def _image(fig, ax, x_edges, y_edges, values, label):
+    '''Draw a rasterized image of values[i, j] on the bins of x and y.'''
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes('right', size='5%', pad=0.06)
+    im = ax.pcolormesh(x_edges, y_edges, values.T, rasterized=True)
+    cbar = fig.colorbar(im, cax=cax, orientation='vertical')
+    cbar.set_label(label)
+    ax.ticklabel_format(axis='both', style='sci', scilimits=(0, 0))
+    return im
+
+
+def plot_2d(x_vis, y_vis, n_vis, x_edges, y_edges, n_binned, out_dir):
+    '''Plot the distribution and the binned number density of the samples.
+
     Parameters
     ----------
     x_vis, y_vis : list
         List of x- and y-coordinate values for the distribution.
     n_vis : list
         List of number density values corresponding to x_vis and y_vis.
-    x_list, y_list : list
-        List of sample x- and y-coordinate values.
-    n_list : list
-        List of number density values corresponding to x_list and y_list.
+    x_edges, y_edges : array
+        Edges of the bins in x and y.
+    n_binned : array
+        Number density of the samples in each bin, indexed by the bins in x
+        and then y.
     out_dir : str
         Path to output directory.
     '''
     fig, (ax1, ax2) = plt.subplots(1, 2)
     divider = make_axes_locatable(ax1)
     cax1 = divider.append_axes('right', size='5%', pad=0.06)
-    divider = make_axes_locatable(ax2)
-    cax2 = divider.append_axes('right', size='5%', pad=0.06)
-    
-    im = ax1.pcolormesh(x_vis, y_vis, n_vis)
+
+    im = ax1.pcolormesh(x_vis, y_vis, n_vis, rasterized=True)
     ax1.set_xlabel('$x$ (m)')
     ax1.set_ylabel('$y$ (m)')
     cbar1 = fig.colorbar(im, cax=cax1, orientation='vertical')
     cbar1.set_label('$n$ (m$^{-3}$)')
-    
-    sc = ax2.scatter(x_list, y_list, c=n_list)
+    ax1.ticklabel_format(axis='both', style='sci', scilimits=(0, 0))
+
+    _image(fig, ax2, x_edges, y_edges, n_binned, '$n$ (m$^{-3}$)')
     ax2.set_xlim(ax1.get_xlim())
     ax2.set_ylim(ax1.get_ylim())
     ax2.set_xlabel('$x$ (m)')
     ax2.set_ylabel('$y$ (m)')
-    cbar2 = fig.colorbar(sc, cax=cax2, orientation='vertical')
-    cbar2.set_label('$n$ (m$^{-3}$)')
-    
-    ax1.ticklabel_format(axis='both', style='sci', scilimits=(0, 0))
-    ax2.ticklabel_format(axis='both', style='sci', scilimits=(0, 0))
-    
+
     fig.tight_layout()
     fig.savefig(os.path.join(out_dir, 'dist-2D.png'))
-    plt.close('all')
\ No newline at end of file
+    plt.close('all')
+
+
+def plot_3d(edges, projections, slices, out_dir):
+    '''Plot projections and central slices of the sampled number density.
+
+    Parameters
+    ----------
+    edges : list of array
+        Edges of the bins in x, y and z.
+    projections, slices : dict
+        Column densities and slices of the number density of the samples, as
+        returned by binning.density_views.
+    out_dir : str
+        Path to output directory.
+    '''
+    fig, axes = plt.subplots(2, 3, figsize=(14, 8))
+    planes = {'xy': (0, 1, 2), 'xz': (0, 2, 1), 'yz': (1, 2, 0)}
+    for (plane, (a, b, c)), top, bottom in zip(planes.items(), *axes):
+        _image(fig, top, edges[a], edges[b], projections[plane],
+               r'$\int n \, d' + 'xyz'[c] + '$ (m$^{-2}$)')
+        top.set_title(f'Projected along ${"xyz"[c]}$')
+        position, values = slices[plane]
+        _image(fig, bottom, edges[a], edges[b], values, '$n$ (m$^{-3}$)')
+        bottom.set_title(f'Slice at ${"xyz"[c]}$ = {position:.3g} m')
+        for ax in (top, bottom):
+            ax.set_xlabel(f'${"xyz"[a]}$ (m)')
+            ax.set_ylabel(f'${"xyz"[b]}$ (m)')
+
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, 'dist-3D.png'))
+    plt.close('all')
+
+
+def plot_files(density, bounds, cells, out_dir, vis_samples=(1000, 1000),
+               max_bins=DEFAULT_MAX_BINS):
+    '''Plot the particles written to the binary files in out_dir.
+
+    The files are read in chunks, so the particles never need to fit in
+    memory. In 1D and 2D, density is also evaluated on a grid of vis_samples
+    points for reference; in 3D, projections and slices of the particles are
+    plotted instead.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function the particles were sampled from.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction. The particles are binned by cell,
+        with at most max_bins bins in each direction.
+    out_dir : str
+        Path to the directory holding the files, where plots are also saved.
+    vis_samples : sequence of int, optional
+        Number of points in x and y at which density is plotted. Defaults to
+        1000 in each direction.
+    max_bins : int, optional
+        Largest number of bins in each direction. Defaults to
+        DEFAULT_MAX_BINS.
+    '''
+    bins = default_bins(cells, max_bins)
+    if len(bounds) == 3:
+        plot_3d(*density_views(out_dir, bounds, bins), out_dir)
+        return
+    vis, n_vis = reference_grid(density, bounds, vis_samples)
+    edges, n_binned = density_histogram(out_dir, bounds, bins)
+    if len(bounds) == 1:
+        plot_1d(*vis, n_vis, *edges, n_binned, out_dir)
+    else:
+        plot_2d(*vis, n_vis, *edges, n_binned, out_dir)
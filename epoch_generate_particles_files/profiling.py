@@ -0,0 +1,174 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Per-phase timing and throughput statistics of a run.
+
+A Profile records the wall-clock time of the phases of a run (setting up the
+density, culling, allocation, sampling, writing, plotting), and adds up the
+statistics returned by the sampling engine for every batch: the time spent
+drawing random numbers, placing particles, evaluating the density and
+selecting and weighting the samples, and the numbers of samples evaluated and
+accepted. Batch statistics are measured in whichever process sampled the
+batch, so with several workers they add up to more than the wall-clock time.
+
+The user's density function can also be wrapped (see Profile.wrap) so that the
+time spent inside it is reported separately.
+"""
+import contextlib
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def phase(profile, name):
+    '''Return a context manager timing a phase of profile, if not None.'''
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
+
+
+def peak_memory_mb():
+    '''Return the peak RSS of this process and its children in MB, if known.'''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class TimedDensity:
+    '''Number density function that records the time spent inside it.
+
+    Only the calls made in this process are counted; copies sent to worker
+    processes count their own calls, which are not reported back.
+    '''
+
+    def __init__(self, density):
+        self.density = density
+        self.__wrapped__ = density
+        self.seconds = 0.0
+        self.calls = 0
+        self.points = 0
+
+    def __call__(self, *coords):
+        start = time.perf_counter()
+        result = self.density(*coords)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        self.points += int(max((getattr(c, 'size', 1) for c in coords),
+                               default=0))
+        return result
+
+
+class Profile:
+    '''Timings and counters of a run.'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.sampling = {}
+        self.evaluated = 0
+        self.accepted = 0
+        self.densities = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Context manager adding the time spent in its body to a phase.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0)
+                                 + time.perf_counter() - start)
+
+    def add_batch(self, stats):
+        '''Add the statistics returned by sampling.sample_cells for a batch.'''
+        stats = dict(stats)
+        self.evaluated += stats.pop('evaluated')
+        self.accepted += stats.pop('accepted')
+        for name, seconds in stats.items():
+            self.sampling[name] = self.sampling.get(name, 0.0) + seconds
+
+    def wrap(self, density):
+        '''Return density wrapped in a TimedDensity reported by summary.'''
+        timed = TimedDensity(density)
+        self.densities.append(timed)
+        return timed
+
+    def summary(self, out_dir=None):
+        '''Return the statistics of the run as a dictionary.
+
+        If out_dir is given, the size of the particle files in it is included.
+        '''
+        total = time.perf_counter() - self.start
+        result = dict(
+            total_seconds=total,
+            phases=dict(self.phases),
+            sampling=dict(self.sampling),
+            evaluated=self.evaluated,
+            accepted=self.accepted,
+            acceptance=(self.accepted / self.evaluated
+                        if self.evaluated else None),
+            particles_per_second=self.accepted / total if total else None,
+            peak_rss_mb=peak_memory_mb(),
+        )
+        if self.densities:
+            result['density_function'] = dict(
+                seconds=sum(d.seconds for d in self.densities),
+                calls=sum(d.calls for d in self.densities),
+                points=sum(d.points for d in self.densities),
+            )
+        if out_dir is not None:
+            result['output_bytes'] = sum(
+                entry.stat().st_size for entry in os.scandir(out_dir)
+                if entry.name.endswith('_data.dat')
+            )
+            result['output_bytes_per_second'] = result['output_bytes'] / total
+        return result
+
+
+def format_summary(summary):
+    '''Return a human readable report of a Profile summary.'''
+    total = summary['total_seconds']
+    lines = [f"Total time: {total:.3f} s"]
+    for name, seconds in summary['phases'].items():
+        share = 100 * seconds / total
+        lines.append(f"  {name:<24}{seconds:10.3f} s {share:6.1f}%")
+    if summary['sampling']:
+        lines.append("Sampling (summed over batches):")
+        for name, seconds in summary['sampling'].items():
+            lines.append(f"  {name:<24}{seconds:10.3f} s")
+    if 'density_function' in summary:
+        density = summary['density_function']
+        lines.append(
+            f"Density function: {density['seconds']:.3f} s in "
+            f"{density['calls']} calls ({density['points']} points, this "
+            "process only)"
+        )
+    lines.append(f"Samples evaluated: {summary['evaluated']}, "
+                 f"accepted: {summary['accepted']}")
+    if summary['particles_per_second'] is not None:
+        lines.append(
+            f"Particles/s: {summary['particles_per_second']:.3g}")
+    if summary['peak_rss_mb'] is not None:
+        lines.append(f"Peak memory: {summary['peak_rss_mb']:.1f} MB")
+    if 'output_bytes' in summary:
+        lines.append(
+            f"Output: {summary['output_bytes']} bytes "
+            f"({summary['output_bytes_per_second'] / 2 ** 20:.1f} MB/s)"
+        )
+    return '\n'.join(lines)
+
+
+def save_summary(summary, path):
+    '''Save a Profile summary as JSON.'''
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
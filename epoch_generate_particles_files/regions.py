@@ -0,0 +1,307 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Inspection, cropping and merging of existing particle files.
+
+The files are opened through np.memmap and read in chunks, so memory use is
+bounded by the chunk size however large they are. If the particles are sorted
+into blocks of cells with an offsets sidecar (see ordering.sort_files), the
+sidecar serves as a spatial index: a query on a box only reads the ranges of
+the files holding the blocks that overlap the box. Files in any other order
+are scanned in full. index_files sorts existing files into blocks and writes
+the sidecar.
+"""
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.binning import (
+    DEFAULT_CHUNK_SIZE, iter_chunks)
+from epoch_generate_particles_files.cache import read_manifest, write_manifest
+from epoch_generate_particles_files.ordering import (
+    OFFSETS_NAME, morton_bits, morton_decode, read_offsets, sort_files)
+from epoch_generate_particles_files.sampling import AXES
+from epoch_generate_particles_files.save_data import save_stream
+from epoch_generate_particles_files.thinning import merge_grid, particle_keys
+
+
+# fraction of a cell by which the boxes of blocks are widened, so that
+# particles rounded into a neighbouring cell are still found
+_BLOCK_MARGIN = 1e-6
+
+
+def dimensions(keys):
+    '''Return the number of coordinates among the particle keys.'''
+    return sum(key in AXES for key in keys)
+
+
+def count_particles(directory):
+    '''Return the number of particles in the files in directory.'''
+    return os.path.getsize(os.path.join(directory, 'x_data.dat')) // 8
+
+
+def block_boxes(sidecar):
+    '''Return the blocks of an offsets sidecar and the box of each.
+
+    Returns
+    -------
+    List of (first, count, box) of every block, where box holds the lower
+    and upper boundary of the block in each direction. Boxes of the blocks at
+    the edges of the grid extend to infinity, since the particles outside the
+    grid are counted in its edge cells.
+    '''
+    bounds = sidecar['bounds']
+    cells = sidecar['cells']
+    sizes = [(hi - lo) / n for (lo, hi), n in zip(bounds, cells)]
+
+    def box(cell_range):
+        return [(-np.inf if a == 0 else lo + (a - _BLOCK_MARGIN) * size,
+                 np.inf if b == n else lo + (b + _BLOCK_MARGIN) * size)
+                for (lo, _), (a, b), n, size
+                in zip(bounds, cell_range, cells, sizes)]
+
+    if sidecar['order'] == 'procs':
+        return [(rank['first'], rank['count'], box(rank['cells']))
+                for rank in sidecar['ranks']]
+    # a block of Morton codes sharing their high bits spans an aligned box
+    blocks = np.array(sidecar['blocks'], dtype=np.int64).reshape(-1, 3)
+    shift = sidecar['shift']
+    bits = morton_bits(cells)
+    low = morton_decode(blocks[:, 0] << shift, bits, len(cells))
+    high = morton_decode((blocks[:, 0] << shift) | ((1 << shift) - 1), bits,
+                         len(cells))
+    return [(int(first), int(count),
+             box([(int(a[i]), min(int(b[i]) + 1, n))
+                  for a, b, n in zip(low, high, cells)]))
+            for i, (_, first, count) in enumerate(blocks)]
+
+
+def region_ranges(directory, box=None):
+    '''Return the ranges of the files that may hold particles in a box.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the particle files.
+    box : sequence of (float, float), optional
+        Lower and upper boundary of the region in each direction. Defaults to
+        the whole domain.
+
+    Returns
+    -------
+    Sorted list of disjoint (start, stop) ranges of particles. Without an
+    offsets sidecar the range is the whole of the files.
+
+    Raises
+    ------
+    ValueError
+        If the box does not have two bounds per dimension of the files.
+    '''
+    if box is not None and len(box) != dimensions(particle_keys(directory)):
+        raise ValueError("The box needs a lower and upper bound per "
+                         "dimension.")
+    total = count_particles(directory)
+    sidecar = read_offsets(directory)
+    if box is None or sidecar is None or sidecar['particles'] != total:
+        return [(0, total)] if total else []
+    ranges = []
+    for first, count, block in block_boxes(sidecar):
+        if count and all(lo < q_hi and q_lo <= hi
+                         for (lo, hi), (q_lo, q_hi) in zip(block, box)):
+            ranges.append((first, first + count))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def iter_region(directory, keys, box=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yield chunks of the particles in a box, as dictionaries of arrays.
+
+    Parameters
+    ----------
+    directory, box
+        See region_ranges. A particle is in the box if lo <= c < hi for each
+        of its coordinates c.
+    keys : sequence of str
+        Names of the quantities read, starting with the coordinates.
+    chunk_size : int, optional
+        Number of particles read at a time. Defaults to DEFAULT_CHUNK_SIZE.
+    '''
+    ndim = dimensions(keys)
+    for start, stop in region_ranges(directory, box):
+        for chunk in iter_chunks(directory, keys, chunk_size, start, stop):
+            if box is not None:
+                inside = np.ones(chunk[0].shape, dtype=bool)
+                for c, (lo, hi) in zip(chunk[:ndim], box):
+                    inside &= (c >= lo) & (c < hi)
+                chunk = [values[inside] for values in chunk]
+            yield dict(zip(keys, chunk))
+
+
+def file_info(directory, box=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Return a summary of the particle files in directory.
+
+    Parameters
+    ----------
+    directory, box, chunk_size
+        See iter_region. Only the particles in the box are summarised.
+
+    Returns
+    -------
+    Dictionary with the 'keys' of the files, the number of 'particles' in the
+    files and in the box ('selected'), the particles 'read', the total
+    weight ('weight'), the 'range' (min, max) of each quantity and the
+    'order' of the files ('cells' unless recorded by a sidecar).
+
+    Raises
+    ------
+    ValueError
+        If there are no particle files in directory.
+    '''
+    keys = particle_keys(directory)
+    sidecar = read_offsets(directory)
+    info = dict(keys=keys, particles=count_particles(directory), selected=0,
+                read=0, weight=0.0, range={},
+                order='cells' if sidecar is None else sidecar['order'])
+    low = np.full(len(keys), np.inf)
+    high = np.full(len(keys), -np.inf)
+    for start, stop in region_ranges(directory, box):
+        info['read'] += stop - start
+    for data in iter_region(directory, keys, box, chunk_size):
+        n = data['w'].size
+        if n == 0:
+            continue
+        info['selected'] += n
+        info['weight'] += float(np.sum(data['w']))
+        low = np.minimum(low, [np.min(data[k]) for k in keys])
+        high = np.maximum(high, [np.max(data[k]) for k in keys])
+    if info['selected']:
+        info['range'] = {k: (float(a), float(b))
+                         for k, a, b in zip(keys, low, high)}
+    return info
+
+
+def format_info(info):
+    '''Return a human readable report of the result of file_info.'''
+    lines = [
+        f"Particles: {info['selected']} of {info['particles']} "
+        f"({info['read']} read), order '{info['order']}'",
+        f"Total weight: {info['weight']:.6g}",
+    ]
+    for key, (low, high) in info['range'].items():
+        lines.append(f"  {key}: {low:.6g} to {high:.6g}")
+    return '\n'.join(lines)
+
+
+def crop_files(directory, box, out_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Write the particles of directory in a box to new files in out_dir.
+
+    Returns the number of particles written.
+
+    Raises
+    ------
+    ValueError
+        If there are no particle files, the box does not have two bounds per
+        dimension or out_dir is directory itself.
+    '''
+    keys = particle_keys(directory)
+    if len(box) != dimensions(keys):
+        raise ValueError("The box needs a lower and upper bound per "
+                         "dimension.")
+    if os.path.realpath(out_dir) == os.path.realpath(directory):
+        raise ValueError("The cropped files cannot replace the originals.")
+    os.makedirs(out_dir, exist_ok=True)
+    return save_stream(iter_region(directory, keys, box, chunk_size), keys,
+                       out_dir)
+
+
+def merge_files(directories, out_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Concatenate the particle files of several directories into out_dir.
+
+    Meant for outputs generated separately for adjacent regions. The files
+    are written in the order of directories; sort them afterwards with
+    index_files if needed. Returns the number of particles written.
+
+    Raises
+    ------
+    ValueError
+        If the directories do not hold the same quantities or out_dir is one
+        of them.
+    '''
+    keys = particle_keys(directories[0])
+    for directory in directories[1:]:
+        if particle_keys(directory) != keys:
+            raise ValueError(
+                f"'{directory}' does not hold the same quantities as "
+                f"'{directories[0]}'."
+            )
+    out = os.path.realpath(out_dir)
+    if any(os.path.realpath(d) == out for d in directories):
+        raise ValueError("The merged files cannot replace the originals.")
+    os.makedirs(out_dir, exist_ok=True)
+    chunks = (dict(zip(keys, chunk)) for directory in directories
+              for chunk in iter_chunks(directory, keys, chunk_size))
+    return save_stream(chunks, keys, out_dir)
+
+
+def index_files(directory, blocks, cells=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Sort the particle files in directory into blocks and index them.
+
+    The grid is that of the run recorded in the manifest, or else cells
+    spanning the range of the coordinates (see thinning.merge_grid). The
+    files are sorted in place (see ordering.sort_files, order 'procs') and an
+    offsets sidecar is written. A manifest is rewritten to record the new
+    order, with no key so that it no longer matches any run in the cache.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the particle files.
+    blocks : sequence of int
+        Number of blocks in each direction.
+    cells : sequence of int, optional
+        Number of cells of the grid, if there is no manifest. Defaults to
+        blocks.
+    chunk_size : int, optional
+        Number of particles held in memory at a time. Defaults to
+        DEFAULT_CHUNK_SIZE.
+
+    Returns
+    -------
+    The content of the sidecar.
+
+    Raises
+    ------
+    ValueError
+        If there are no particle files or the blocks do not fit the grid.
+    '''
+    keys = particle_keys(directory)
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        cells = None
+    elif cells is None:
+        cells = blocks
+    bounds, cells = merge_grid(directory, keys, cells, chunk_size)
+    if len(blocks) != len(cells):
+        raise ValueError("Need a number of blocks per dimension.")
+    if any(not 1 <= b <= n for b, n in zip(blocks, cells)):
+        raise ValueError(
+            "blocks must be between 1 and the number of cells of the grid."
+        )
+    sidecar = sort_files(directory, keys, bounds, cells, 'procs', blocks,
+                         offsets=True, chunk_size=chunk_size)
+    if manifest is not None:
+        args = dict(manifest['arguments'], order='procs',
+                    nproc=[int(b) for b in blocks], offsets=True)
+        write_manifest(directory, None, args, manifest['particles'], keys,
+                       (OFFSETS_NAME,))
+    return sidecar
+
@@ -0,0 +1,473 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Batched sampling engine shared by the 1D, 2D and 3D generators.
+
+The domain is processed in batches of cells, normally whole x-slabs. For each
+batch the cell origins are built from integer cell indices, all of the random
+positions are drawn at once and the number density function is called a single
+time, so the cost per particle is dominated by NumPy rather than the Python
+interpreter. Batches can be consumed one at a time, which keeps the memory
+footprint bounded by the batch size rather than by the number of particles.
+
+Batches are independent of each other, so they can also be sampled by a pool
+of worker processes. Results are always returned in batch order, so the output
+layout does not depend on the number of workers.
+
+Random numbers come from a counter-based Philox generator keyed by the seed.
+Every cell owns a fixed block of the counter space, located by its flat index,
+so the particles in a cell are identical however the grid is batched, which
+workers sample it and whether the rest of the grid is sampled at all.
+
+Optionally only a sparse set of active cells is sampled, given as runs of
+consecutive flat cell indices (see culling.py). Separable densities are
+sampled by inverse-CDF lookup instead of uniformly within cells (see
+separable.py).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import time
+
+import numpy as np
+
+from epoch_generate_particles_files.allocation import cell_ppc
+from epoch_generate_particles_files.culling import clip_runs, iter_run_batches
+from epoch_generate_particles_files.jit import JitDensity
+from epoch_generate_particles_files.placement import (
+    cell_fractions, uniforms_per_cell)
+from epoch_generate_particles_files.separable import SeparableDensity
+from epoch_generate_particles_files.thermal import (
+    MOMENTUM_KEYS, MOMENTUM_STREAM, MOMENTUM_UNIFORMS)
+
+
+AXES = ('x', 'y', 'z')
+
+# approximate number of sample points evaluated per batch
+DEFAULT_BATCH_SIZE = 2 ** 20
+
+# seeds are below this, so that the streams of the positions, momenta
+# (MOMENTUM_STREAM) and thinning (thinning.THINNING_STREAM) never overlap
+SEED_LIMIT = 2 ** 64
+
+
+def cell_sizes(bounds, cells):
+    '''Return the cell size in each direction.
+
+    Parameters
+    ----------
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    '''
+    return tuple((hi - lo) / n for (lo, hi), n in zip(bounds, cells))
+
+
+def progress_bar(total, progress=True):
+    '''Return a tqdm progress bar, or None if unavailable or not requested.'''
+    if not progress:
+        return None
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        print("No tqdm found.")
+        return None
+    return tqdm(total=total)
+
+
+def random_seed():
+    '''Return a fresh random seed suitable for cell_uniforms.'''
+    return np.random.SeedSequence().entropy % SEED_LIMIT
+
+
+def cell_uniforms(seed, first, last, n_per_cell):
+    '''Return uniform random numbers in [0, 1) for a range of cells.
+
+    Parameters
+    ----------
+    seed : int
+        Seed used as the Philox key.
+    first, last : int
+        Range of flat indices of the cells.
+    n_per_cell : int
+        Number of random numbers needed by each cell.
+
+    Returns
+    -------
+    Array of shape (last - first, n_per_cell). Row i depends only on seed,
+    n_per_cell and the cell index first + i.
+    '''
+    # Philox produces four 64-bit values, i.e. four doubles, per counter step
+    blocks = -(-n_per_cell // 4)
+    bit_generator = np.random.Philox(key=seed, counter=first * blocks)
+    rands = np.random.Generator(bit_generator).random(
+        (last - first) * blocks * 4)
+    return rands.reshape(last - first, blocks * 4)[:, :n_per_cell]
+
+
+def iter_batches(cells, ppc, batch_size=DEFAULT_BATCH_SIZE):
+    '''Yield (first, last) ranges of flat cell indices that split the domain.
+
+    Cells are numbered in C order, so that the x-index varies slowest. Each
+    batch holds roughly batch_size sample points. Batches are made of whole
+    x-slabs of cells where possible; slabs that are too large are split.
+    '''
+    n_cells = int(np.prod(cells, dtype=np.int64))
+    cells_per_slab = n_cells // cells[0]
+    step = max(1, batch_size // ppc)
+    if step >= cells_per_slab:
+        step -= step % cells_per_slab
+    for first in range(0, n_cells, step):
+        yield first, min(first + step, n_cells)
+
+
+def plan_batches(cells, ppc, batch_size=DEFAULT_BATCH_SIZE, runs=None,
+                 start=0):
+    '''Return the list of batches to sample.
+
+    Each batch is a tuple (first, last, batch_runs, n_cells) of the range of
+    flat cell indices it covers, the active runs within that range (None if
+    every cell is active) and the number of active cells. Cells with a flat
+    index below start are left out.
+    '''
+    if runs is None:
+        return [(max(first, start), last, None, last - max(first, start))
+                for first, last in iter_batches(cells, ppc, batch_size)
+                if last > start]
+    batches = []
+    for first, last in iter_run_batches(runs, ppc, batch_size):
+        if last <= start:
+            continue
+        first = max(first, start)
+        batch_runs = clip_runs(runs, first, last)
+        n_cells = int(np.sum(batch_runs[:, 1] - batch_runs[:, 0]))
+        batches.append((first, last, batch_runs, n_cells))
+    return batches
+
+
+def sample_cells(density, bounds, cells, ppc, first, last, n_min=0, seed=None,
+                 runs=None, sampling='random', alloc=None, stats=False,
+                 momentum=None):
+    '''Sample all cells with a flat index in the range [first, last).
+
+    Parameters
+    ----------
+    density : callable
+        Number density function taking one coordinate array per dimension.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+    ppc : int
+        Number of particles per cell.
+    first, last : int
+        Range of flat (C order) indices of the cells to sample.
+    n_min : float, optional
+        Minimum number density value. Samples below it are discarded.
+        Defaults to zero.
+    seed : int, optional
+        Seed of the random numbers. Defaults to a fresh random seed.
+    runs : array of int, optional
+        Runs of active cells, as [first, last) pairs of flat indices. Only the
+        cells in these runs are sampled. Defaults to None (all cells).
+    sampling : str, optional
+        How particles are placed within a cell, one of
+        placement.SAMPLING_MODES. Defaults to 'random'.
+    alloc : tuple, optional
+        (importance, scale, ppc_min, ppc_max) for a density-adaptive number of
+        particles per cell (see allocation.py), in which case ppc must equal
+        ppc_max. Defaults to None (ppc particles in every cell).
+    stats : bool, optional
+        Whether to time the phases of the sampling (see profiling.py).
+        Defaults to False.
+    momentum : thermal.ThermalMomentum, optional
+        If given, the particles are also given momenta drawn from this
+        distribution. Defaults to None (no momenta).
+
+    Returns
+    -------
+    Dictionary of arrays keyed by coordinate name ('x', 'y', 'z'), 'n' (number
+    density), 'w' (weight) and, with momentum, 'px', 'py' and 'pz'. Particles
+    are ordered by cell, with the last axis varying fastest, exactly as in a
+    nested loop over x, y and z. If stats is True, it also holds 'stats', a
+    dictionary of the seconds spent in each phase and the numbers of samples
+    'evaluated' and 'accepted'.
+    '''
+    if seed is None:
+        seed = random_seed()
+    timings = {'evaluated': 0} if stats else None
+    coords, n_samp, w_samp, slots = _sample_points(
+        density, bounds, cells, ppc, first, last, seed, runs, sampling, alloc,
+        n_min, timings
+    )
+    clock = time.perf_counter()
+    keep = n_samp >= n_min
+
+    data = {AXES[d]: coords[d][keep] for d in range(len(cells))}
+    data['n'] = n_samp[keep]
+    data['w'] = w_samp[keep]
+    clock = _lap(timings, 'selection', clock)
+    if momentum is not None:
+        # the random numbers of a particle depend on its cell and slot only
+        _, rands = _batch_uniforms(seed + MOMENTUM_STREAM, first, last, runs,
+                                   ppc * MOMENTUM_UNIFORMS)
+        rands = rands.reshape(-1, MOMENTUM_UNIFORMS)[slots[keep]]
+        data.update(momentum([data[a] for a in AXES[:len(cells)]], rands))
+        _lap(timings, 'momenta', clock)
+    if stats:
+        timings['accepted'] = data['w'].size
+        data['stats'] = timings
+    return data
+
+
+def count_cells(density, bounds, cells, ppc, first, last, n_min=0, seed=None,
+                runs=None, sampling='random', alloc=None):
+    '''Return how many particles sample_cells would keep, without storing them.
+
+    Takes the same parameters as sample_cells. A seed must be given for the
+    count to match a later call to sample_cells.
+    '''
+    coords, n_samp, _, _ = _sample_points(
+        density, bounds, cells, ppc, first, last, seed, runs, sampling, alloc,
+        n_min
+    )
+    return int(np.count_nonzero(n_samp >= n_min))
+
+
+def cell_counts(density, bounds, cells, ppc, first, last, n_min=0, seed=None,
+                runs=None, sampling='random', alloc=None, timings=None):
+    '''Return how many particles sample_cells would keep in each cell.
+
+    Takes the same parameters as sample_cells, plus an optional dictionary of
+    timings (see _sample_points). Returns one count per active cell of the
+    range, in flat index order.
+    '''
+    _, n_samp, _, slots = _sample_points(
+        density, bounds, cells, ppc, first, last, seed, runs, sampling, alloc,
+        n_min, timings
+    )
+    if runs is None:
+        n_active = last - first
+    else:
+        runs = clip_runs(runs, first, last)
+        n_active = int(np.sum(runs[:, 1] - runs[:, 0]))
+    return np.bincount(slots[n_samp >= n_min] // ppc, minlength=n_active)
+
+
+def _sample_points(density, bounds, cells, ppc, first, last, seed, runs=None,
+                   sampling='random', alloc=None, n_min=None, timings=None):
+    '''Return sample positions, number densities and weights for a range of
+    cells.
+
+    Also returns the slot of every sample, i.e. the index of its cell within
+    the batch times ppc plus its index within the cell. If density is a
+    SeparableDensity, particles are placed by inverse-CDF lookup and weighted
+    by the mean density of their cell, rather than by the density at their own
+    position. If density is a JitDensity, the samples below n_min are already
+    discarded by its fused kernel.
+
+    If timings is a dictionary, the seconds spent in each phase and the number
+    of samples evaluated are added to it.
+    '''
+    ndim = len(cells)
+    sizes = cell_sizes(bounds, cells)
+    idx, frac, counts = _cell_layout(bounds, cells, ppc, first, last, seed,
+                                     runs, sampling, alloc, timings)
+    if idx[0].size == 0:
+        return ([np.empty(0)] * ndim, np.empty(0), np.empty(0),
+                np.empty(0, dtype=np.int64))
+    clock = time.perf_counter()
+    if isinstance(density, JitDensity):
+        origins = np.array([bounds[d][0] + idx[d] * sizes[d]
+                            for d in range(ndim)]).reshape(ndim, -1)
+        if counts is None:
+            counts = np.full(idx[0].shape, ppc)
+        result = density.sample(origins, sizes, frac, counts, n_min or 0)
+        if timings is not None:
+            _lap(timings, 'fused kernel', clock)
+            timings['evaluated'] += int(np.sum(counts))
+        return result
+    separable = isinstance(density, SeparableDensity)
+
+    # place the particles in every cell at once
+    coords = []
+    for d in range(ndim):
+        if separable:
+            coords.append(density.place(d, idx[d], frac[d]))
+        else:
+            origin = bounds[d][0] + idx[d] * sizes[d]
+            coords.append(origin[:, np.newaxis] + frac[d] * sizes[d])
+
+    # keep only the first few particles of cells allocated fewer than ppc
+    if counts is None:
+        coords = [c.ravel() for c in coords]
+        counts = ppc_samp = ppc
+        slots = np.arange(coords[0].size)
+    else:
+        used = np.arange(ppc) < counts[:, np.newaxis]
+        coords = [c[used] for c in coords]
+        ppc_samp = np.repeat(counts, counts)
+        slots = np.flatnonzero(used)
+    clock = _lap(timings, 'placement', clock)
+
+    # get number density values
+    n_samp = np.broadcast_to(
+        np.asarray(density(*coords), dtype=np.float64), coords[0].shape
+    )
+    clock = _lap(timings, 'density', clock)
+    if timings is not None:
+        timings['evaluated'] += n_samp.size
+    if separable:
+        n_weight = np.repeat(density.cell_mean(idx), counts)
+    else:
+        n_weight = n_samp
+    w_samp = n_weight * np.prod(sizes) / ppc_samp
+    _lap(timings, 'selection', clock)
+    return coords, n_samp, w_samp, slots
+
+
+def _cell_layout(bounds, cells, ppc, first, last, seed, runs=None,
+                 sampling='random', alloc=None, timings=None):
+    '''Return the cells of a batch and the placement of their particles.
+
+    Returns the integer indices of the cells in each direction, the positions
+    of ppc particles within each cell as fractions of the cell size (see
+    placement.cell_fractions) and the number of particles used in each cell,
+    or None if all ppc are used.
+    '''
+    if seed is None:
+        seed = random_seed()
+    if alloc is not None and sampling not in ('random', 'sobol'):
+        # a prefix of the strata does not cover the cell evenly
+        raise ValueError(f"Adaptive ppc is not supported by '{sampling}' "
+                         "sampling.")
+    ndim = len(cells)
+    n_place = uniforms_per_cell(sampling, ppc, ndim)
+    n_rands = n_place + (alloc is not None)
+    clock = time.perf_counter()
+
+    # integer cell indices of every cell in the batch, and their random numbers
+    flat, rands = _batch_uniforms(seed, first, last, runs, n_rands)
+    clock = _lap(timings, 'random numbers', clock)
+    idx = np.unravel_index(flat, tuple(cells))
+    frac = cell_fractions(sampling, ppc, ndim, rands[:, :n_place])
+    counts = None
+    if alloc is not None:
+        counts = cell_ppc(alloc, bounds, cells, flat, rands[:, n_place])
+    _lap(timings, 'placement', clock)
+    return idx, frac, counts
+
+
+def _batch_uniforms(seed, first, last, runs, n_per_cell):
+    '''Return the flat indices of the active cells in [first, last) and
+    their uniform random numbers (see cell_uniforms).
+    '''
+    if runs is None:
+        return np.arange(first, last), cell_uniforms(seed, first, last,
+                                                     n_per_cell)
+    runs = clip_runs(runs, first, last)
+    flat = np.concatenate(
+        [np.arange(a, b) for a, b in runs] + [np.empty(0, dtype=np.int64)]
+    )
+    rands = np.concatenate(
+        [cell_uniforms(seed, a, b, n_per_cell) for a, b in runs]
+        + [np.empty((0, n_per_cell))]
+    )
+    return flat, rands
+
+
+def _lap(timings, phase, start):
+    '''Add the time since start to a phase of timings, if not None.
+
+    Returns the current time, to start the next phase.
+    '''
+    now = time.perf_counter()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + now - start
+    return now
+
+
+def _sample_batch(kwargs):
+    '''Unpack arguments for sample_cells in a worker process.'''
+    return sample_cells(**kwargs)
+
+
+def map_batches(function, tasks, workers=1):
+    '''Apply function to every task, yielding the results in order.
+
+    If workers is greater than one, the tasks are run by a pool of that many
+    processes, so function and tasks must be picklable. At most two tasks per
+    worker are in flight at a time, so memory use stays bounded when the
+    consumer is slower than the workers.
+    '''
+    if workers <= 1:
+        yield from map(function, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(function, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_samples(density, bounds, cells, ppc, n_min=0, progress=False,
+                 batch_size=DEFAULT_BATCH_SIZE, seed=None, workers=1,
+                 runs=None, sampling='random', alloc=None, profile=None,
+                 start=0, momentum=None):
+    '''Sample the whole grid, yielding one dictionary of arrays per batch.
+
+    See sample_cells for a description of the parameters and the yielded
+    dictionaries, which follow the batches of plan_batches. Only the cells
+    with a flat index of at least start are sampled. If progress is True, a
+    tqdm progress bar counting cells is printed. If workers is greater than
+    one, batches are sampled in parallel by that many processes; density must
+    then be picklable (e.g. a module level function). The output for a given
+    seed does not depend on batch_size or workers. If runs is given, only the
+    active cells in the runs are sampled and batches are sized by the number
+    of active cells. If a profiling.Profile is given, the statistics of every
+    batch are added to it.
+    '''
+    if seed is None:
+        seed = random_seed()
+    batches = plan_batches(cells, ppc, batch_size, runs, start)
+    common = dict(density=density, bounds=bounds, cells=cells, ppc=ppc,
+                  n_min=n_min, seed=seed, sampling=sampling, alloc=alloc,
+                  stats=profile is not None, momentum=momentum)
+    tasks = (dict(common, first=first, last=last, runs=batch_runs)
+             for first, last, batch_runs, _ in batches)
+    results = map_batches(_sample_batch, tasks, workers)
+    pbar = progress_bar(sum(b[3] for b in batches), progress)
+    for batch, data in zip(batches, results):
+        if profile is not None:
+            profile.add_batch(data.pop('stats'))
+        yield data
+        if pbar is not None:
+            pbar.update(batch[3])
+    if pbar is not None:
+        pbar.close()
+
+
+def sample_grid(density, bounds, cells, ppc, n_min=0, progress=False,
+                batch_size=DEFAULT_BATCH_SIZE, seed=None, workers=1,
+                runs=None, sampling='random', alloc=None, profile=None,
+                momentum=None):
+    '''Sample the whole grid and return a single dictionary of arrays.
+
+    See iter_samples and sample_cells for a description of the parameters and
+    the returned dictionary.
+    '''
+    batches = list(iter_samples(density, bounds, cells, ppc, n_min, progress,
+                                batch_size, seed, workers, runs, sampling,
+                                alloc, profile, momentum=momentum))
+    keys = AXES[:len(cells)] + ('n', 'w')
+    if momentum is not None:
+        keys += MOMENTUM_KEYS
+    if not batches:
+        return {key: np.empty(0) for key in keys}
+    return {key: np.concatenate([b[key] for b in batches]) for key in keys}
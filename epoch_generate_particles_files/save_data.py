@@ -6,8 +6,33 @@ Part of EPOCH Generate Particles Files.
 
 Functions to save the generated data.
 """
+import json
 import numpy as np
 import os
+import queue
+import threading
+import time
+
+from epoch_generate_particles_files.cache import link_file
+from epoch_generate_particles_files.profiling import phase
+from epoch_generate_particles_files.sampling import (
+    DEFAULT_BATCH_SIZE, count_cells, iter_samples, map_batches, plan_batches,
+    progress_bar, random_seed, sample_cells)
+
+CHECKPOINT_NAME = 'checkpoint.json'
+
+# default minimum number of seconds between checkpoints
+DEFAULT_CHECKPOINT_INTERVAL = 600.0
+
+def _open_new(path):
+    '''Open a file for writing, replacing rather than truncating any old one.
+
+    Hard links to the old file (see cache.py) are therefore left intact.
+    '''
+    if os.path.lexists(path):
+        os.remove(path)
+    return open(path, 'wb')
+
 
 def save_1d(x_list, w_list, out_dir):
     '''Save 1D particle data.
@@ -21,9 +46,9 @@ def save_1d(x_list, w_list, out_dir):
     out_dir : str
         Path to output directory.
     '''
-    with open(os.path.join(out_dir, 'x_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'x_data.dat')) as f:
         f.write(np.array(x_list).tobytes())
-    with open(os.path.join(out_dir, 'w_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'w_data.dat')) as f:
         f.write(np.array(w_list).tobytes())
         
         
@@ -41,11 +66,11 @@ def save_2d(x_list, y_list, w_list, out_dir):
     out_dir : str
         Path to output directory.
     '''
-    with open(os.path.join(out_dir, 'x_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'x_data.dat')) as f:
         f.write(np.array(x_list).tobytes())
-    with open(os.path.join(out_dir, 'y_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'y_data.dat')) as f:
         f.write(np.array(y_list).tobytes())
-    with open(os.path.join(out_dir, 'w_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'w_data.dat')) as f:
         f.write(np.array(w_list).tobytes())
 
 
@@ -65,11 +90,351 @@ def save_3d(x_list, y_list, z_list, w_list, out_dir):
     out_dir : str
         Path to output directory.
     '''
-    with open(os.path.join(out_dir, 'x_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'x_data.dat')) as f:
         f.write(np.array(x_list).tobytes())
-    with open(os.path.join(out_dir, 'y_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'y_data.dat')) as f:
         f.write(np.array(y_list).tobytes())
-    with open(os.path.join(out_dir, 'z_data.dat'), 'wb') as f:
+    with _open_new(os.path.join(out_dir, 'z_data.dat')) as f:
         f.write(np.array(z_list).tobytes())
-    with open(os.path.join(out_dir, 'w_data.dat'), 'wb') as f:
-        f.write(np.array(w_list).tobytes())
\ No newline at end of file
+    with _open_new(os.path.join(out_dir, 'w_data.dat')) as f:
+        f.write(np.array(w_list).tobytes())
+
+
+def _stream_outputs(batches, outputs, queue_size=2):
+    '''Write batches to files by a background thread (see save_stream).
+
+    outputs is a list of (path, key, scale) triples: batch[key], multiplied by
+    scale unless it is None, is appended to the file at path. Returns the
+    number of particles written.
+    '''
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def write():
+        files = []
+        try:
+            for path, _, _ in outputs:
+                files.append(_open_new(path))
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    break
+                for (_, key, scale), f in zip(outputs, files):
+                    values = batch[key]
+                    if scale is not None:
+                        values = values * scale
+                    f.write(np.ascontiguousarray(values, dtype=np.float64))
+        except Exception as err:
+            errors.append(err)
+            # keep draining so that the generating thread is never blocked
+            while pending.get() is not None:
+                pass
+        finally:
+            for f in files:
+                f.close()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    n_written = 0
+    try:
+        for batch in batches:
+            if errors:
+                break
+            pending.put(batch)
+            n_written += len(batch[outputs[0][1]])
+    finally:
+        pending.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return n_written
+
+
+def save_stream(batches, keys, out_dir, queue_size=2):
+    '''Save batches of particle data to file as they are generated.
+
+    Each batch is appended to the open output files straight away, so that
+    peak memory is bounded by the batch size rather than by the total number
+    of particles. Writing is done by a background thread, overlapping disk
+    access with the generation of the next batch.
+
+    Parameters
+    ----------
+    batches : iterable of dict
+        Batches of particle data, each a dictionary of arrays keyed by name.
+    keys : sequence of str
+        Names of the quantities to save. Quantity 'k' is written to the file
+        'k_data.dat'.
+    out_dir : str
+        Path to output directory.
+    queue_size : int, optional
+        Maximum number of batches waiting to be written. Defaults to 2.
+
+    Returns
+    -------
+    Number of particles written.
+    '''
+    outputs = [(os.path.join(out_dir, f'{key}_data.dat'), key, None)
+               for key in keys]
+    return _stream_outputs(batches, outputs, queue_size)
+
+
+def save_species(batches, keys, species, queue_size=2):
+    '''Save batches of particle data for several species sharing positions.
+
+    Every species gets the same particles, with the weights ('w') multiplied
+    by the species' scale factor, so the number density is only evaluated
+    once. The coordinate files are written once, to the directory of the
+    first species, and hard-linked into the others (see cache.link_file).
+
+    Parameters
+    ----------
+    batches, queue_size
+        See save_stream.
+    keys : sequence of str
+        Names of the quantities to save, including 'w'.
+    species : sequence of (str, float)
+        Output directory and scale factor of the weights of each species.
+
+    Returns
+    -------
+    Number of particles written per species.
+    '''
+    first_dir = species[0][0]
+    coords = [key for key in keys if key != 'w']
+    outputs = [(os.path.join(first_dir, f'{key}_data.dat'), key, None)
+               for key in coords]
+    outputs += [(os.path.join(out_dir, 'w_data.dat'), 'w', scale)
+                for out_dir, scale in species]
+    n_written = _stream_outputs(batches, outputs, queue_size)
+    for out_dir, _ in species[1:]:
+        for key in coords:
+            link_file(os.path.join(first_dir, f'{key}_data.dat'),
+                      os.path.join(out_dir, f'{key}_data.dat'))
+    return n_written
+
+
+def read_checkpoint(out_dir):
+    '''Return the checkpoint saved in out_dir, or None if there is none.'''
+    try:
+        with open(os.path.join(out_dir, CHECKPOINT_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(out_dir, state):
+    '''Atomically replace the checkpoint saved in out_dir.'''
+    path = os.path.join(out_dir, CHECKPOINT_NAME)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_checkpointed(density, bounds, cells, ppc, keys, out_dir, n_min=0,
+                      progress=False, batch_size=DEFAULT_BATCH_SIZE, seed=None,
+                      workers=1, runs=None, sampling='random', alloc=None,
+                      profile=None, interval=DEFAULT_CHECKPOINT_INTERVAL,
+                      resume=False, tag=None, momentum=None):
+    '''Generate particle data and save it batch by batch, with checkpoints.
+
+    Every interval seconds, once the current batch is written, the files are
+    flushed to disk and a checkpoint is saved in out_dir. It records the first
+    cell not yet written (and the x-index of its slab), the seed (the random
+    numbers of a cell only depend on the seed and the cell's index, so this is
+    the whole state of the generator) and the size of each file. If resume is
+    True and a checkpoint exists, the files are truncated to the recorded
+    sizes and sampling continues from the recorded cell, giving files
+    identical to those of an uninterrupted run. The checkpoint is removed once
+    every particle is written.
+
+    Parameters
+    ----------
+    density, bounds, cells, ppc, n_min, progress, batch_size, seed, workers,
+    runs, sampling, alloc, profile, momentum
+        See sampling.iter_samples. When resuming, seed defaults to the seed of
+        the checkpoint.
+    keys : sequence of str
+        Names of the quantities to save. Quantity 'k' is written to the file
+        'k_data.dat'.
+    out_dir : str
+        Path to output directory.
+    interval : float, optional
+        Minimum number of seconds between checkpoints. Defaults to
+        DEFAULT_CHECKPOINT_INTERVAL.
+    resume : bool, optional
+        Whether to continue from the checkpoint in out_dir, if there is one.
+        Defaults to False.
+    tag : str, optional
+        String identifying the run, e.g. cache.run_key, saved with the
+        checkpoint. Defaults to None.
+
+    Returns
+    -------
+    Number of particles written.
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint was saved by a run with a different tag, seed, grid,
+        number of particles per cell or quantities.
+    '''
+    state = read_checkpoint(out_dir) if resume else None
+    if state is not None:
+        if seed is None:
+            seed = state['seed']
+        if (state['tag'] != tag or state['seed'] != seed
+                or state['cells'] != [int(n) for n in cells]
+                or state['ppc'] != ppc or state['keys'] != list(keys)):
+            raise ValueError(
+                f"Checkpoint in '{out_dir}' was saved by a different run."
+            )
+    elif seed is None:
+        seed = random_seed()
+    paths = [os.path.join(out_dir, f'{key}_data.dat') for key in keys]
+    if state is not None:
+        start = state['next_cell']
+        n_written = state['particles']
+        files = []
+        for key, path in zip(keys, paths):
+            f = open(path, 'r+b')
+            f.truncate(state['offsets'][key])
+            f.seek(state['offsets'][key])
+            files.append(f)
+    else:
+        start = 0
+        n_written = 0
+        files = [_open_new(path) for path in paths]
+
+    cells_per_slab = int(np.prod(cells[1:], dtype=np.int64))
+    batches = plan_batches(cells, ppc, batch_size, runs, start)
+    samples = iter_samples(density, bounds, cells, ppc, n_min, progress,
+                           batch_size, seed, workers, runs, sampling, alloc,
+                           profile, start, momentum)
+    saved = time.monotonic()
+    try:
+        for (_, last, _, _), data in zip(batches, samples):
+            for key, f in zip(keys, files):
+                f.write(np.ascontiguousarray(data[key], dtype=np.float64))
+            n_written += len(data[keys[0]])
+            if time.monotonic() - saved < interval:
+                continue
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+            _write_checkpoint(out_dir, dict(
+                tag=tag, seed=int(seed), cells=[int(n) for n in cells],
+                ppc=ppc, keys=list(keys), next_cell=int(last),
+                x_index=int(last) // cells_per_slab, particles=n_written,
+                offsets={key: f.tell() for key, f in zip(keys, files)},
+            ))
+            saved = time.monotonic()
+    finally:
+        for f in files:
+            f.close()
+    path = os.path.join(out_dir, CHECKPOINT_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+    return n_written
+
+
+def _count_batch(kwargs):
+    '''Unpack arguments for count_cells in a worker process.'''
+    return count_cells(**kwargs)
+
+
+def _fill_batch(kwargs):
+    '''Sample a batch of cells and write it into its range of the files.'''
+    kwargs = dict(kwargs)
+    keys = kwargs.pop('keys')
+    paths = kwargs.pop('paths')
+    offset = kwargs.pop('offset')
+    count = kwargs.pop('count')
+    if count == 0:
+        return None
+    data = sample_cells(**kwargs)
+    for key, path in zip(keys, paths):
+        out = np.memmap(path, dtype=np.float64, mode='r+',
+                        offset=offset * 8, shape=(count,))
+        out[:] = data[key]
+        out.flush()
+        del out
+    return data.get('stats')
+
+
+def save_mapped(density, bounds, cells, ppc, keys, out_dir, n_min=0,
+                progress=False, batch_size=DEFAULT_BATCH_SIZE, seed=None,
+                workers=1, runs=None, sampling='random', alloc=None,
+                profile=None, momentum=None):
+    '''Generate particle data and save it to preallocated files in two passes.
+
+    The first pass only counts the particles kept in every batch. The output
+    files are then created with their final size and the second pass
+    regenerates each batch and writes it in place, through np.memmap, into its
+    own disjoint range of the files. Workers therefore write without any
+    coordination and no intermediate copies are concatenated, at the price of
+    evaluating the number density twice.
+
+    Parameters
+    ----------
+    density, bounds, cells, ppc, n_min, batch_size, seed, workers, runs,
+    sampling, alloc, profile, momentum
+        See sampling.iter_samples. Only the second pass adds batch statistics
+        to the profile and samples the momenta.
+    keys : sequence of str
+        Names of the quantities to save. Quantity 'k' is written to the file
+        'k_data.dat'.
+    out_dir : str
+        Path to output directory.
+    progress : bool, optional
+        Whether or not to print a progress bar with tqdm. Defaults to False.
+
+    Returns
+    -------
+    Number of particles written.
+    '''
+    if seed is None:
+        seed = random_seed()
+    batches = plan_batches(cells, ppc, batch_size, runs)
+    pbar = progress_bar(2 * sum(b[3] for b in batches), progress)
+
+    # first pass: count the particles in each batch
+    common = dict(density=density, bounds=bounds, cells=cells, ppc=ppc,
+                  n_min=n_min, seed=seed, sampling=sampling, alloc=alloc)
+    tasks = (dict(common, first=first, last=last, runs=batch_runs)
+             for first, last, batch_runs, _ in batches)
+    counts = []
+    with phase(profile, 'counting'):
+        for batch, count in zip(batches,
+                                map_batches(_count_batch, tasks, workers)):
+            counts.append(count)
+            if pbar is not None:
+                pbar.update(batch[3])
+    offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    total = int(offsets[-1])
+
+    # preallocate the files with their final size
+    paths = [os.path.join(out_dir, f'{key}_data.dat') for key in keys]
+    for path in paths:
+        with _open_new(path) as f:
+            f.truncate(total * 8)
+
+    # second pass: fill each batch's range of the files in place
+    tasks = (dict(common, first=first, last=last, runs=batch_runs, keys=keys,
+                  paths=paths, offset=int(offset), count=count,
+                  stats=profile is not None, momentum=momentum)
+             for (first, last, batch_runs, _), offset, count
+             in zip(batches, offsets, counts))
+    with phase(profile, 'filling'):
+        for batch, stats in zip(batches,
+                                map_batches(_fill_batch, tasks, workers)):
+            if stats is not None:
+                profile.add_batch(stats)
+            if pbar is not None:
+                pbar.update(batch[3])
+    if pbar is not None:
+        pbar.close()
+    return total
@@ -0,0 +1,261 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Generation of several species from one configuration file.
+
+The configuration (JSON, or TOML with Python 3.11+ or tomli) holds options of
+main.py shared by every species, plus a list of species. Each species has a
+name and may set its own output directory, a 'scale' factor for its weights,
+a 'density' module defining its number_density_Nd function (instead of
+distributions/dN.py) and any other option of main.py. For example:
+
+    dimensions = 1
+    xmin = -3e-6
+    xmax = 2e-6
+    nx = 300
+    ppc = 8
+    seed = 1
+    outdir = "run"
+
+    [[species]]
+    name = "electron"
+
+    [[species]]
+    name = "carbon"
+    scale = 0.1667
+
+Species with the same density module and options form one job: the grid is
+sampled once and every species of the job gets the same particle positions,
+with the weights scaled by its factor (see save_data.save_species). Particles
+are kept where the shared number density is at least nmin. Jobs are
+independent and can be run in parallel by a pool of processes.
+"""
+import json
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.api import generate, load_distribution
+from epoch_generate_particles_files.cache import (
+    is_complete, remove_manifest, run_key, write_manifest)
+from epoch_generate_particles_files.gridded import grid_distribution
+from epoch_generate_particles_files.ordering import OFFSETS_NAME
+from epoch_generate_particles_files.parse_args import (
+    check_valid_args, create_parser)
+from epoch_generate_particles_files.sampling import (
+    AXES, map_batches, random_seed)
+from epoch_generate_particles_files.thermal import (
+    MOMENTUM_KEYS, thermal_momentum)
+from epoch_generate_particles_files.validation import validate_files
+
+
+# keys of a species entry that are not options of main.py
+SPECIES_KEYS = ('name', 'scale', 'density', 'outdir')
+
+# options of main.py the species runner does not support
+UNSUPPORTED_OPTIONS = ('two_pass', 'checkpoint', 'resume', 'plot', 'profile',
+                       'stats', 'dry_run')
+
+
+def load_config(path):
+    '''Load a configuration file, in TOML if its name ends in .toml, or JSON.
+
+    Raises
+    ------
+    ImportError
+        If the file is TOML and neither tomllib nor tomli is available.
+    '''
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError(
+                    "Reading TOML needs Python 3.11 or tomli. Use JSON "
+                    "instead."
+                ) from None
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def to_argv(settings):
+    '''Convert a dictionary of options to command line arguments of main.py.
+
+    Names are the destinations of the options (e.g. 'cull_safety' for
+    --cull-safety). True adds a flag, False and None are left out and lists
+    give one value each. Numbers in lists are written without exponent, so
+    that argparse does not take negative ones (e.g. -1e5) for options.
+    '''
+    argv = []
+    for name, value in settings.items():
+        option = '--' + name.replace('_', '-')
+        if value is True:
+            argv.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            argv += [option] + [_list_value(v) for v in value]
+        else:
+            argv.append(f'{option}={value}')
+    return argv
+
+
+def _list_value(value):
+    '''Return a value of a list option as a command line argument.'''
+    if isinstance(value, float):
+        return np.format_float_positional(value, trim='-')
+    return str(value)
+
+
+def plan_jobs(config):
+    '''Group the species of a configuration into jobs.
+
+    Returns a list of jobs, each a dictionary with the parsed options ('args')
+    and 'density' module shared by its species, and the 'species', a list of
+    dictionaries with their 'name', 'outdir' and 'scale'. Output directories
+    are created if needed.
+
+    Raises
+    ------
+    ValueError
+        If there are no species, a species has no name, two species share an
+        output directory or the options of a species are invalid or not
+        supported (see UNSUPPORTED_OPTIONS).
+    '''
+    settings = {k: v for k, v in config.items() if k != 'species'}
+    base_dir = settings.pop('outdir', os.getcwd())
+    if not config.get('species'):
+        raise ValueError("The configuration lists no species.")
+
+    parser = create_parser()
+    jobs = {}
+    out_dirs = set()
+    for entry in config['species']:
+        if 'name' not in entry:
+            raise ValueError("Every species needs a name.")
+        name = entry['name']
+        out_dir = os.path.join(base_dir, entry.get('outdir', name))
+        if out_dir in out_dirs:
+            raise ValueError(f"Species '{name}' shares its output directory.")
+        out_dirs.add(out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+
+        options = dict(settings, **{k: v for k, v in entry.items()
+                                    if k not in SPECIES_KEYS})
+        unsupported = [k for k in UNSUPPORTED_OPTIONS
+                       if options.get(k) not in (None, False)]
+        if unsupported:
+            raise ValueError(
+                f"Species '{name}': options not supported with species: "
+                f"{', '.join(unsupported)}."
+            )
+        argv = to_argv(options)
+        group = (entry.get('density'), tuple(argv))
+        if group not in jobs:
+            try:
+                args = parser.parse_args(argv + [f'--outdir={out_dir}'])
+            except SystemExit:
+                raise ValueError(f"Invalid options for species '{name}'.")
+            valid, err_msg = check_valid_args(args)
+            if not valid:
+                raise ValueError(f"Species '{name}': {err_msg}")
+            jobs[group] = dict(args=args, density=entry.get('density'),
+                               species=[])
+        jobs[group]['species'].append(
+            dict(name=name, outdir=out_dir,
+                 scale=float(entry.get('scale', 1.0)))
+        )
+    return list(jobs.values())
+
+
+def run_job(job):
+    '''Generate and save the particles of every species of a job.
+
+    Species whose output directory already holds the result of an identical
+    run (see cache.py) are not generated again, unless the force option is
+    set. Returns a dictionary with the names of the species, the seed, the
+    number of particles per species (None if every species was reused) and,
+    with the validate option, the 'validation' of each species (see
+    validation.validate_files), keyed by name.
+    '''
+    args = job['args']
+    dim = args.dimensions
+    distribution = grid_distribution(args)
+    if distribution is None:
+        distribution = load_distribution(dim, job['density'])
+    momentum = thermal_momentum(args, distribution)
+    seed = random_seed() if args.seed is None else args.seed
+    keys = {}
+    for species in job['species']:
+        run = dict(vars(args), seed=seed, scale=species['scale'],
+                   density=job['density'])
+        keys[species['outdir']] = (run_key(distribution['density'], run), run)
+    result = dict(species=[s['name'] for s in job['species']], seed=seed,
+                  particles=None)
+    bounds = [(args.xmin, args.xmax), (args.ymin, args.ymax),
+              (args.zmin, args.zmax)][:dim]
+    cells = [args.nx, args.ny, args.nz][:dim]
+    if args.force or any(is_complete(out_dir, key) is None
+                         for out_dir, (key, _) in keys.items()):
+        result['particles'] = _generate(job, distribution, momentum, seed,
+                                        bounds, cells, keys)
+    if args.validate:
+        result['validation'] = {
+            s['name']: validate_files(distribution['density'], bounds, cells,
+                                      s['outdir'], args.nmin,
+                                      batch_size=args.batch,
+                                      scale=s['scale'])
+            for s in job['species']
+        }
+    return result
+
+
+def _generate(job, distribution, momentum, seed, bounds, cells, keys):
+    '''Generate the particles of a job and write the manifest of each
+    species. Returns the number of particles per species.
+    '''
+    args = job['args']
+    dim = args.dimensions
+    for out_dir in keys:
+        remove_manifest(out_dir)
+    particles = generate(
+        dim, distribution['density'], bounds, cells, args.ppc,
+        n_min=args.nmin, progress=args.progress, batch_size=args.batch,
+        workers=args.workers, seed=seed, cull=args.cull,
+        cull_safety=args.cull_safety, table=args.tabulate,
+        table_cache=args.table_cache, sampling=args.sampling,
+        ppc_min=args.ppc_min, budget=args.budget,
+        max_density=distribution['max_density'],
+        importance=distribution['importance'],
+        factors=distribution['factors'], jit=args.jit,
+        species=[(s['outdir'], s['scale']) for s in job['species']],
+        momentum=momentum, order=args.order, nproc=args.nproc,
+        offsets=args.offsets
+    )
+    names = AXES[:dim] + ('w',)
+    if momentum is not None:
+        names += MOMENTUM_KEYS
+    for out_dir, (key, run) in keys.items():
+        write_manifest(out_dir, key, run, particles, names,
+                       (OFFSETS_NAME,) if args.offsets else ())
+    return particles
+
+
+def run_config(config, jobs=1):
+    '''Generate every species of a configuration, yielding job results.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration, e.g. from load_config.
+    jobs : int, optional
+        Number of jobs run in parallel by a pool of processes. Defaults to 1.
+    '''
+    yield from map_batches(run_job, plan_jobs(config), jobs)
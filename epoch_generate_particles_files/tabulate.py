@@ -0,0 +1,142 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Tabulation of expensive number density functions.
+
+The density is evaluated once on a regular lattice of points spanning the
+domain and the table is cached on disk, keyed by a hash of the source code of
+the function's module and the lattice parameters. Particles (and the
+visualisation grid) are then given densities by vectorised multilinear
+interpolation from the table, which is memory-mapped rather than loaded.
+"""
+import hashlib
+import inspect
+import os
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'epoch_generate_particles_files'
+)
+
+
+def source_hash(function):
+    '''Return a hash of the source code that defines a function.
+
+    The source of the whole module is used where available, so that changes to
+    helper functions are also picked up. Densities read from data files (see
+    gridded.GridDensity) are identified by their fingerprint instead.
+    '''
+    fingerprint = getattr(function, 'fingerprint', None)
+    if fingerprint is not None:
+        return fingerprint()
+    try:
+        source = inspect.getsource(inspect.getmodule(function))
+    except (OSError, TypeError):
+        try:
+            source = inspect.getsource(function)
+        except (OSError, TypeError):
+            source = f'{function.__module__}.{function.__qualname__}'
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def interpolate(table, bounds, *coords):
+    '''Multilinearly interpolate a table of values on a regular lattice.
+
+    Parameters
+    ----------
+    table : array
+        Values on a lattice spanning bounds, including the boundaries.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    *coords : array
+        One array of coordinates per dimension, broadcastable to each other.
+        Coordinates outside the lattice take the value at its edge.
+    '''
+    coords = np.broadcast_arrays(*coords)
+    index = []
+    frac = []
+    for (lo, hi), n, c in zip(bounds, table.shape, coords):
+        u = (c - lo) / (hi - lo) * (n - 1)
+        i = np.clip(np.floor(u), 0, n - 2).astype(np.intp)
+        index.append(i)
+        frac.append(np.clip(u - i, 0, 1))
+
+    # sum the contributions of the 2^ndim corners surrounding each point
+    result = np.zeros(coords[0].shape)
+    for corner in np.ndindex(*(2,) * len(coords)):
+        weight = np.ones(coords[0].shape)
+        for f, c in zip(frac, corner):
+            weight *= f if c else 1 - f
+        result += weight * table[tuple(i + c for i, c in zip(index, corner))]
+    return result
+
+
+def tabulate(density, bounds, points, cache_dir=DEFAULT_CACHE_DIR):
+    '''Return the path of a cached table of a density function, creating it.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function taking one coordinate array per dimension.
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    points : sequence of int
+        Number of lattice points in each direction (at least 2).
+    cache_dir : str, optional
+        Directory in which tables are stored. Defaults to DEFAULT_CACHE_DIR.
+    '''
+    # wrappers (e.g. profiling.TimedDensity) set __wrapped__
+    original = inspect.unwrap(density)
+    key = hashlib.sha256(repr((
+        source_hash(original), original.__qualname__,
+        [(float(lo), float(hi)) for lo, hi in bounds],
+        [int(n) for n in points]
+    )).encode()).hexdigest()
+    path = os.path.join(cache_dir, f'table-{key[:32]}.npy')
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    axes = [np.linspace(lo, hi, n) for (lo, hi), n in zip(bounds, points)]
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                      shape=tuple(points))
+    # evaluate a few x-planes at a time to bound the memory use
+    step = max(1, 2 ** 20 // int(np.prod(points[1:], dtype=np.int64)))
+    for start in range(0, points[0], step):
+        grids = np.meshgrid(axes[0][start:start + step], *axes[1:],
+                            indexing='ij', sparse=True)
+        table[start:start + step] = density(*grids)
+    table.flush()
+    del table
+    os.replace(tmp_path, path)
+    return path
+
+
+class TabulatedDensity:
+    '''Number density function interpolated from a cached table.
+
+    Instances are called like the function they replace. Only the path of the
+    table is pickled, so they can be passed cheaply to worker processes, which
+    memory-map the table on first use.
+    '''
+
+    def __init__(self, density, bounds, points, cache_dir=DEFAULT_CACHE_DIR):
+        self.bounds = [tuple(b) for b in bounds]
+        self.path = tabulate(density, bounds, points, cache_dir)
+        self._table = None
+
+    def __call__(self, *coords):
+        if self._table is None:
+            self._table = np.load(self.path, mmap_mode='r')
+        return interpolate(self._table, self.bounds, *coords)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = None
+        return state
@@ -0,0 +1,232 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Thermal momenta of the particles.
+
+Momenta are drawn from a drifting Maxwellian (non-relativistic) or a drifting
+Maxwell-Juttner (relativistic) distribution, whose temperature and drift
+velocity may depend on position. They are generated batch by batch together
+with the positions, from four random numbers per particle that only depend on
+the seed, the particle's cell and its slot within the cell, so the momenta
+are reproducible whatever the batch size or number of workers.
+
+The magnitude of a Maxwell-Juttner momentum is found by interpolating its
+quantile function, tabulated once over a range of temperatures, and a drift is
+applied by a Lorentz boost with the flipping method of Zenitani (Phys.
+Plasmas 22, 042116, 2015).
+"""
+import functools
+
+import numpy as np
+
+from epoch_generate_particles_files.tabulate import interpolate
+
+
+SPEED_OF_LIGHT = 2.99792458e8
+ELECTRON_MASS = 9.1093837015e-31
+BOLTZMANN_CONSTANT = 1.380649e-23
+
+THERMAL_MODES = ('maxwellian', 'juttner')
+
+MOMENTUM_KEYS = ('px', 'py', 'pz')
+
+# random numbers used by each particle
+MOMENTUM_UNIFORMS = 4
+
+# offset of the Philox key of the momenta from that of the positions
+MOMENTUM_STREAM = 2 ** 64
+
+# range of the quantile table, in ln(kT / mc^2) and logit(quantile)
+_LN_THETA = (np.log(1e-4), np.log(1e4))
+_LOGIT = (-20.0, 20.0)
+
+
+def _juttner_momenta(theta, points=8193):
+    '''Return momenta u = p / mc and the log-odds of their Juttner CDF.'''
+    u_max = 12 * np.sqrt(theta) + 80 * theta
+    # cubic spacing resolves the u^2 rise at small momenta
+    u = u_max * np.linspace(0, 1, points) ** 3
+    # gamma - 1, avoiding cancellation at small u
+    energy = u ** 2 / (np.sqrt(1 + u ** 2) + 1)
+    f = u ** 2 * np.exp(-energy / theta)
+    steps = 0.5 * (f[1:] + f[:-1]) * np.diff(u)
+    cdf = np.concatenate(([0.0], np.cumsum(steps)))
+    ccdf = np.concatenate((np.cumsum(steps[::-1])[::-1], [0.0]))
+    with np.errstate(divide='ignore'):
+        logit = np.log(cdf) - np.log(ccdf)
+    ok = np.isfinite(logit) & (u > 0)
+    return u[ok], logit[ok]
+
+
+@functools.lru_cache(maxsize=None)
+def juttner_table(n_theta=129, n_logit=513):
+    '''Return the tabulated quantile function of the Juttner distribution.
+
+    The table holds ln(u / sqrt(theta (1 + theta))), where u = p / mc is the
+    magnitude of the momentum and theta = kT / mc^2, on a regular lattice of
+    ln(theta) and of the log-odds of the quantile. The scaling makes the
+    table tend to constants in the non-relativistic and ultra-relativistic
+    limits, so temperatures outside its range are still sampled correctly.
+    '''
+    table = np.empty((n_theta, n_logit))
+    targets = np.linspace(*_LOGIT, n_logit)
+    for i, ln_theta in enumerate(np.linspace(*_LN_THETA, n_theta)):
+        theta = np.exp(ln_theta)
+        u, logit = _juttner_momenta(theta)
+        table[i] = (np.interp(targets, logit, np.log(u))
+                    - 0.5 * np.log(theta * (1 + theta)))
+    return table
+
+
+def juttner_magnitude(theta, q):
+    '''Return Juttner momenta u = p / mc at quantiles q for temperatures
+    theta = kT / mc^2.
+    '''
+    with np.errstate(divide='ignore'):
+        logit = np.log(q) - np.log1p(-q)
+    scaled = interpolate(juttner_table(), [_LN_THETA, _LOGIT],
+                         np.log(theta), logit)
+    return np.exp(scaled) * np.sqrt(theta * (1 + theta))
+
+
+def _normals(uniforms):
+    '''Return three standard normal deviates per row of four uniforms.'''
+    r1 = np.sqrt(-2 * np.log1p(-uniforms[:, 0]))
+    r2 = np.sqrt(-2 * np.log1p(-uniforms[:, 2]))
+    return np.array([r1 * np.cos(2 * np.pi * uniforms[:, 1]),
+                     r1 * np.sin(2 * np.pi * uniforms[:, 1]),
+                     r2 * np.cos(2 * np.pi * uniforms[:, 3])])
+
+
+def maxwellian(uniforms, temperature, drift, mass):
+    '''Return momenta drawn from drifting Maxwellian distributions.
+
+    Parameters
+    ----------
+    uniforms : array
+        Uniform random numbers in [0, 1), of shape (n, 4).
+    temperature : array
+        Temperature (K) of each particle.
+    drift : array
+        Drift velocity (m/s) of each particle, of shape (3, n).
+    mass : float
+        Particle mass (kg).
+
+    Returns
+    -------
+    Array of shape (3, n) of momenta (kg m/s).
+    '''
+    spread = np.sqrt(BOLTZMANN_CONSTANT * temperature / mass)
+    return mass * (drift + spread * _normals(uniforms))
+
+
+def juttner(uniforms, temperature, drift, mass):
+    '''Return momenta drawn from drifting Maxwell-Juttner distributions.
+
+    Takes the same parameters as maxwellian. The drift speed must be below
+    the speed of light.
+    '''
+    theta = BOLTZMANN_CONSTANT * temperature / (mass * SPEED_OF_LIGHT ** 2)
+    u = juttner_magnitude(theta, uniforms[:, 0])
+    cos_polar = 2 * uniforms[:, 1] - 1
+    sin_polar = np.sqrt(np.maximum(0, 1 - cos_polar ** 2))
+    azimuth = 2 * np.pi * uniforms[:, 2]
+    u = u * np.array([sin_polar * np.cos(azimuth),
+                      sin_polar * np.sin(azimuth), cos_polar])
+
+    # boost along the drift, flipping the parallel momentum of a fraction of
+    # the particles so that the boosted distribution is a Juttner one
+    beta = drift / SPEED_OF_LIGHT
+    speed = np.sqrt(np.sum(beta ** 2, axis=0))
+    axis = np.divide(beta, speed, out=np.zeros_like(beta), where=speed > 0)
+    gamma = np.sqrt(1 + np.sum(u ** 2, axis=0))
+    parallel = np.sum(u * axis, axis=0)
+    flip = -speed * parallel / gamma > uniforms[:, 3]
+    boosted = np.where(flip, -parallel, parallel)
+    boosted = (boosted + speed * gamma) / np.sqrt(1 - speed ** 2)
+    u = u + (boosted - parallel) * axis
+    return mass * SPEED_OF_LIGHT * u
+
+
+class ThermalMomentum:
+    '''Momentum distribution of the particles.
+
+    Parameters
+    ----------
+    mode : str
+        'maxwellian' or 'juttner'.
+    mass : float
+        Particle mass (kg).
+    temperature : callable or float
+        Temperature (K), or a function of the particle coordinates (one array
+        per dimension) returning it.
+    drift : callable or sequence of float, optional
+        Drift velocity (vx, vy, vz) in m/s, or a function of the particle
+        coordinates returning it. Defaults to no drift.
+
+    Calling an instance raises ValueError if a Maxwell-Juttner drift reaches
+    the speed of light at any of the particles.
+    '''
+
+    def __init__(self, mode, mass, temperature, drift=(0.0, 0.0, 0.0)):
+        if mode not in THERMAL_MODES:
+            raise ValueError(f"Unknown thermal distribution '{mode}'.")
+        self.mode = mode
+        self.mass = mass
+        self.temperature = temperature
+        self.drift = drift
+
+    def __call__(self, coords, uniforms):
+        '''Return the momenta of particles at coords, as a dictionary keyed
+        by 'px', 'py' and 'pz', from MOMENTUM_UNIFORMS uniforms per particle.
+        '''
+        shape = uniforms.shape[:1]
+        temperature = self.temperature
+        if callable(temperature):
+            temperature = temperature(*coords)
+        temperature = np.broadcast_to(
+            np.asarray(temperature, dtype=np.float64), shape)
+        drift = self.drift(*coords) if callable(self.drift) else self.drift
+        drift = np.array([np.broadcast_to(np.asarray(v, dtype=np.float64),
+                                          shape) for v in drift])
+        if (self.mode == 'juttner'
+                and np.any(np.sum(drift ** 2, axis=0) >= SPEED_OF_LIGHT ** 2)):
+            name = getattr(self.drift, '__name__', 'drift')
+            raise ValueError(
+                f"The drift given by '{name}' must be below the speed of "
+                "light."
+            )
+        sample = maxwellian if self.mode == 'maxwellian' else juttner
+        momenta = sample(uniforms, temperature, drift, self.mass)
+        return dict(zip(MOMENTUM_KEYS, momenta))
+
+
+def thermal_momentum(args, distribution):
+    '''Return the ThermalMomentum requested by parsed arguments, if any.
+
+    The temperature and drift functions of the distribution (see
+    api.load_distribution) take precedence over the --temperature and
+    --drift options.
+
+    Raises
+    ------
+    ValueError
+        If momenta are requested without a temperature.
+    '''
+    if args.thermal is None:
+        return None
+    temperature = distribution['temperature']
+    if temperature is None:
+        temperature = args.temperature
+    if temperature is None:
+        raise ValueError(
+            "Thermal momenta need --temperature or a temperature function."
+        )
+    drift = distribution['drift']
+    if drift is None:
+        drift = args.drift
+    return ThermalMomentum(args.thermal, args.mass * ELECTRON_MASS,
+                           temperature, drift)
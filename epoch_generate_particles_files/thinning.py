@@ -0,0 +1,346 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Reduction of the number of particles in existing particle files.
+
+The files are read in chunks through np.memmap and the reduced particles are
+streamed to new files (see save_data.save_stream), so memory use is bounded by
+the chunk size however many particles there are. Two methods are available.
+
+Thinning keeps each particle with a probability growing with its weight,
+min(1, w / W), and gives the particles kept the weight max(w, W), so light
+particles are thinned out while heavy ones are all kept. The threshold W is
+found from a histogram of the weights so that the expected number of
+particles kept is the target. The weights are finally rescaled by a common
+factor so that the total weight is conserved exactly; the weight in any region
+is conserved on average.
+
+Merging groups the particles of each cell of a grid (by default the grid they
+were generated on, read from the manifest) and replaces every group by one
+particle carrying the group's total weight, at its weighted mean position and
+with its weighted mean momentum. The total weight and the first moments of the
+positions and momenta are therefore conserved exactly within every cell.
+Every occupied cell keeps at least one particle.
+"""
+import os
+
+import numpy as np
+
+from epoch_generate_particles_files.binning import (
+    DEFAULT_CHUNK_SIZE, bin_index, iter_chunks)
+from epoch_generate_particles_files.cache import read_manifest
+from epoch_generate_particles_files.sampling import (
+    AXES, cell_uniforms, random_seed)
+from epoch_generate_particles_files.save_data import save_stream
+from epoch_generate_particles_files.thermal import MOMENTUM_KEYS
+
+
+THINNING_METHODS = ('thin', 'merge')
+
+# name of the subdirectory the reduced files are written to by default
+DEFAULT_THINNED_DIR = 'thinned'
+
+# offset of the Philox key of the thinning from that of the positions
+THINNING_STREAM = 2 * 2 ** 64
+
+# number of bins of the histogram of the logarithm of the weights
+_WEIGHT_BINS = 4096
+
+
+def particle_keys(directory):
+    '''Return the names of the quantities with a file in directory.
+
+    Raises
+    ------
+    ValueError
+        If there are no coordinate or weight files.
+    '''
+    keys = tuple(key for key in AXES + ('w',) + MOMENTUM_KEYS
+                 if os.path.isfile(os.path.join(directory, f'{key}_data.dat')))
+    if 'x' not in keys or 'w' not in keys:
+        raise ValueError(f"No particle files in '{directory}'.")
+    return keys
+
+
+def weight_threshold(directory, target, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Return the weight W for which sum(min(1, w / W)) is target.
+
+    The sum is the expected number of particles kept by thinning. It is
+    evaluated exactly at the edges of a fine histogram of the logarithm of the
+    weights and interpolated in between.
+    '''
+    low, high, total = np.inf, 0.0, 0.0
+    for (w,) in iter_chunks(directory, ['w'], chunk_size):
+        w = w[w > 0]
+        if w.size:
+            low = min(low, w.min())
+            high = max(high, w.max())
+            total += w.sum()
+    if high == 0:
+        # only weightless particles, none of which need be kept
+        return np.inf
+    if total / high >= target:
+        # even the heaviest particle is thinned
+        return total / target
+
+    edges = np.geomspace(low, high, _WEIGHT_BINS + 1)
+    counts = np.zeros(_WEIGHT_BINS)
+    sums = np.zeros(_WEIGHT_BINS)
+    scale = _WEIGHT_BINS / np.log(high / low)
+    for (w,) in iter_chunks(directory, ['w'], chunk_size):
+        w = w[w > 0]
+        index = np.clip((np.log(w / low) * scale).astype(np.int64), 0,
+                        _WEIGHT_BINS - 1)
+        counts += np.bincount(index, minlength=_WEIGHT_BINS)
+        sums += np.bincount(index, weights=w, minlength=_WEIGHT_BINS)
+    # particles at or above each edge count one, lighter ones w / W
+    above = np.append(np.cumsum(counts[::-1])[::-1], 0.0)
+    below = np.concatenate(([0.0], np.cumsum(sums)))
+    kept = above + below / edges
+    k = np.flatnonzero(kept >= target)[-1]
+    frac = (kept[k] - target) / (kept[k] - kept[k + 1])
+    return edges[k] + frac * (edges[k + 1] - edges[k])
+
+
+def thin_chunks(directory, keys, target, seed, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yield chunks of particles thinned to about target particles.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the particle files.
+    keys : sequence of str
+        Names of the quantities read and yielded, including 'w'.
+    target : int
+        Expected number of particles kept.
+    seed : int
+        Seed of the random numbers. The particle kept only depend on the seed
+        and the index of the particle, not on chunk_size.
+    chunk_size : int, optional
+        Number of particles read at a time. Defaults to DEFAULT_CHUNK_SIZE.
+    '''
+    threshold = weight_threshold(directory, target, chunk_size)
+    key = seed + THINNING_STREAM
+
+    def select(w, start):
+        u = cell_uniforms(key, start, start + w.size, 1)[:, 0]
+        return u * threshold < w
+
+    # the total weight before and after thinning, to rescale the weights
+    before, after = 0.0, 0.0
+    start = 0
+    for (w,) in iter_chunks(directory, ['w'], chunk_size):
+        before += w.sum()
+        after += np.maximum(w, threshold)[select(w, start)].sum()
+        start += w.size
+    factor = before / after if after else 1.0
+
+    w_index = list(keys).index('w')
+    start = 0
+    for chunk in iter_chunks(directory, keys, chunk_size):
+        w = chunk[w_index]
+        keep = select(w, start)
+        start += w.size
+        data = {k: values[keep] for k, values in zip(keys, chunk)}
+        data['w'] = np.maximum(w[keep], threshold) * factor
+        yield data
+
+
+def _cell_index(chunk, bounds, cells):
+    '''Return the flat index of the cell of each particle of a chunk.'''
+    cell = np.zeros(chunk[0].shape, dtype=np.int64)
+    for d in range(len(cells)):
+        cell = cell * cells[d] + bin_index(chunk[d], *bounds[d], cells[d])
+    return cell
+
+
+def _group_uniforms(key, cell):
+    '''Return one uniform random number per cell of the sorted, distinct
+    flat indices cell, depending only on key and the index (see
+    sampling.cell_uniforms).
+    '''
+    breaks = np.flatnonzero(np.diff(cell) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.append(breaks, cell.size)
+    return np.concatenate(
+        [cell_uniforms(key, cell[a], cell[b - 1] + 1, 1)[:, 0]
+         for a, b in zip(starts, stops)] + [np.empty(0)]
+    )
+
+
+def _merge_cells(keys, chunk, cell, ratio, key):
+    '''Return the particles of whole cells merged into groups (see
+    merge_chunks), as a dictionary of arrays.
+    '''
+    # groups are runs of particles of a cell, ordered along x
+    order = np.lexsort((chunk[0], cell))
+    cell = cell[order]
+    starts = np.flatnonzero(np.diff(cell, prepend=-1))
+    sizes = np.diff(np.append(starts, cell.size))
+    u = _group_uniforms(key, cell[starts])
+    groups = np.clip(np.floor(sizes * ratio + u).astype(np.int64), 1, sizes)
+    rank = np.arange(cell.size) - np.repeat(starts, sizes)
+    group = (np.repeat(np.cumsum(groups) - groups, sizes)
+             + rank * np.repeat(groups, sizes) // np.repeat(sizes, sizes))
+
+    w = chunk[list(keys).index('w')][order]
+    weight = np.bincount(group, weights=w)
+    members = np.bincount(group)
+    data = {'w': weight}
+    for name, values in zip(keys, chunk):
+        if name == 'w':
+            continue
+        values = values[order]
+        mean = np.bincount(group, weights=values) / members
+        data[name] = np.divide(np.bincount(group, weights=w * values),
+                               weight, out=mean, where=weight > 0)
+    # the cells keep the order they have in the files
+    first = np.minimum.reduceat(order, starts)
+    keep = np.argsort(np.repeat(first, groups), kind='stable')
+    return {name: values[keep] for name, values in data.items()}
+
+
+def merge_chunks(directory, keys, bounds, cells, target, total, seed,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yield chunks of particles merged within cells to about target.
+
+    The particles of the last cell of a chunk are carried over to the next
+    one, so a cell is merged as a whole as long as its particles are
+    contiguous in the files, as for any order written by main.py. The number
+    of groups of a cell is rounded with a random number keyed by the seed and
+    the cell, so the result does not depend on chunk_size.
+
+    Parameters
+    ----------
+    directory, keys, seed, chunk_size
+        See thin_chunks.
+    bounds : sequence of (float, float)
+        Lower and upper boundary of the grid in each direction.
+    cells : sequence of int
+        Number of cells of the grid in each direction.
+    target : int
+        Number of particles wanted. The particles of a cell are merged into
+        about target / total as many groups, rounded randomly, and at least
+        one.
+    total : int
+        Number of particles in the files.
+    '''
+    ratio = target / total
+    key = seed + THINNING_STREAM
+    carry = None
+    for chunk in iter_chunks(directory, keys, chunk_size):
+        if carry is not None:
+            chunk = [np.concatenate((a, b)) for a, b in zip(carry, chunk)]
+        cell = _cell_index(chunk, bounds, cells)
+        if cell.size == 0:
+            continue
+        # the last cell may go on in the next chunk
+        last = cell == cell[-1]
+        carry = [values[last] for values in chunk]
+        done = ~last
+        if np.any(done):
+            yield _merge_cells(keys, [values[done] for values in chunk],
+                               cell[done], ratio, key)
+    if carry is not None:
+        yield _merge_cells(keys, carry, _cell_index(carry, bounds, cells),
+                           ratio, key)
+
+
+def merge_grid(directory, keys, cells=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Return the bounds and cells of the grid particles are merged on.
+
+    The bounds and, unless given, the cells are those of the run recorded in
+    the manifest of directory. Without a manifest the bounds are the range of
+    the particle coordinates.
+
+    Raises
+    ------
+    ValueError
+        If there is no manifest and cells is not given.
+    '''
+    ndim = sum(key in AXES for key in keys)
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        args = manifest['arguments']
+        bounds = [(args['xmin'], args['xmax']), (args['ymin'], args['ymax']),
+                  (args['zmin'], args['zmax'])][:ndim]
+        if cells is None:
+            cells = [args['nx'], args['ny'], args['nz']][:ndim]
+    elif cells is None:
+        raise ValueError(
+            f"No manifest in '{directory}': give the cells to merge on."
+        )
+    else:
+        low = np.full(ndim, np.inf)
+        high = np.full(ndim, -np.inf)
+        for chunk in iter_chunks(directory, AXES[:ndim], chunk_size):
+            low = np.minimum(low, [c.min() for c in chunk])
+            high = np.maximum(high, [c.max() for c in chunk])
+        bounds = list(zip(low, high))
+    if len(cells) == 1:
+        cells = list(cells) * ndim
+    if len(cells) != ndim:
+        raise ValueError("Need one number of cells or one per dimension.")
+    return bounds, cells
+
+
+def reduce_particles(directory, target, method='thin', out_dir=None,
+                     seed=None, cells=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Reduce the particles in directory to about target particles.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the particle files, e.g. written by main.py.
+    target : int
+        Number of particles wanted.
+    method : str, optional
+        'thin' or 'merge' (see above). Defaults to 'thin'.
+    out_dir : str, optional
+        Directory the reduced files are written to, created if needed.
+        Defaults to the subdirectory DEFAULT_THINNED_DIR of directory.
+    seed : int, optional
+        Seed of the random numbers. Defaults to a fresh random seed.
+    cells : sequence of int, optional
+        Only used when merging. Number of cells to merge on (one value, or
+        one per dimension). Defaults to the cells of the run (see
+        merge_grid).
+    chunk_size : int, optional
+        Number of particles read at a time. Defaults to DEFAULT_CHUNK_SIZE.
+
+    Returns
+    -------
+    Number of particles before and after the reduction.
+
+    Raises
+    ------
+    ValueError
+        If the method is unknown, the output directory is directory itself,
+        there are no particle files or they already hold at most target
+        particles.
+    '''
+    if method not in THINNING_METHODS:
+        raise ValueError(f"Unknown reduction method '{method}'.")
+    if out_dir is None:
+        out_dir = os.path.join(directory, DEFAULT_THINNED_DIR)
+    if os.path.realpath(out_dir) == os.path.realpath(directory):
+        raise ValueError("The reduced files cannot replace the originals.")
+    keys = particle_keys(directory)
+    total = os.path.getsize(os.path.join(directory, 'w_data.dat')) // 8
+    if total <= target:
+        raise ValueError(
+            f"'{directory}' already holds {total} particles, at most {target}."
+        )
+    if seed is None:
+        seed = random_seed()
+    if method == 'thin':
+        chunks = thin_chunks(directory, keys, target, seed, chunk_size)
+    else:
+        bounds, cells = merge_grid(directory, keys, cells, chunk_size)
+        chunks = merge_chunks(directory, keys, bounds, cells, target, total,
+                              seed, chunk_size)
+    os.makedirs(out_dir, exist_ok=True)
+    return total, save_stream(chunks, keys, out_dir)
@@ -0,0 +1,219 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Checks that the weights of the particles reproduce the number density.
+
+The weights are deposited onto the cells of the grid in a single pass over
+the particles, chunk by chunk, with np.bincount. The weight of the particles
+in a cell estimates the number of real particles in it, i.e. the integral of
+the number density over the cell, which is computed independently by
+Gauss-Legendre quadrature of the density function, a batch of cells at a
+time. Since samples below nmin are dropped, the quadrature also separates the
+part of the integral where the density is at least nmin (which the weights
+should reproduce) from the part lost to the cut.
+
+Memory use is a few arrays of one float per cell, whatever the number of
+particles.
+"""
+import numpy as np
+
+from epoch_generate_particles_files.binning import (
+    DEFAULT_CHUNK_SIZE, bin_index, iter_chunks)
+from epoch_generate_particles_files.sampling import (
+    AXES, DEFAULT_BATCH_SIZE, iter_batches)
+
+
+# Gauss-Legendre points per direction and cell
+DEFAULT_QUADRATURE_POINTS = 4
+
+
+def deposit(chunks, bounds, cells):
+    '''Return the total weight of the particles in each cell.
+
+    Parameters
+    ----------
+    chunks : iterable of list of array
+        Chunks of particles, each a list of the coordinates in each direction
+        followed by the weights (see binning.iter_chunks).
+    bounds : sequence of (float, float)
+        Lower and upper boundary in each direction.
+    cells : sequence of int
+        Number of cells in each direction.
+
+    Returns
+    -------
+    Array of the weight in each cell, of shape cells. Particles outside the
+    grid are counted in its edge cells.
+    '''
+    ndim = len(cells)
+    total = np.zeros(int(np.prod(cells, dtype=np.int64)))
+    for chunk in chunks:
+        index = np.zeros(chunk[0].shape, dtype=np.int64)
+        for d in range(ndim):
+            index = index * cells[d] + bin_index(chunk[d], *bounds[d],
+                                                 cells[d])
+        total += np.bincount(index, weights=chunk[ndim],
+                             minlength=total.size)
+    return total.reshape(cells)
+
+
+def cell_integrals(density, bounds, cells, n_min=0,
+                   points=DEFAULT_QUADRATURE_POINTS,
+                   batch_size=DEFAULT_BATCH_SIZE):
+    '''Return the integral of the number density over each cell.
+
+    Parameters
+    ----------
+    density : callable
+        Number density function of the coordinates.
+    bounds, cells
+        See deposit.
+    n_min : float, optional
+        Density below which particles are dropped. Defaults to 0.
+    points : int, optional
+        Number of quadrature points per direction and cell. Defaults to
+        DEFAULT_QUADRATURE_POINTS.
+    batch_size : int, optional
+        Number of points evaluated at a time. Defaults to DEFAULT_BATCH_SIZE.
+
+    Returns
+    -------
+    Arrays of shape cells of the integral of the density and of the part of
+    it where the density is at least n_min.
+    '''
+    ndim = len(cells)
+    nodes, weights = np.polynomial.legendre.leggauss(points)
+    nodes = 0.5 * (nodes + 1)
+    sizes = np.array([(hi - lo) / n for (lo, hi), n in zip(bounds, cells)])
+    lows = np.array([lo for lo, _ in bounds])
+    # offsets and weights of the points of a cell, as fractions of the cell
+    frac = np.stack(np.meshgrid(*[nodes] * ndim, indexing='ij'),
+                    axis=-1).reshape(-1, ndim)
+    weight = np.prod(np.stack(np.meshgrid(*[weights] * ndim, indexing='ij'),
+                              axis=-1).reshape(-1, ndim), axis=1)
+    weight *= np.prod(sizes) / 2 ** ndim
+
+    n_cells = int(np.prod(cells, dtype=np.int64))
+    full = np.empty(n_cells)
+    kept = np.empty(n_cells)
+    for first, last in iter_batches(cells, len(weight), batch_size):
+        idx = np.unravel_index(np.arange(first, last), cells)
+        coords = [(lows[d] + (idx[d][:, np.newaxis] + frac[:, d]) * sizes[d])
+                  .ravel() for d in range(ndim)]
+        n = np.broadcast_to(density(*coords), coords[0].shape)
+        n = n.reshape(last - first, len(weight))
+        full[first:last] = n @ weight
+        kept[first:last] = np.where(n >= n_min, n, 0.0) @ weight
+    return full.reshape(cells), kept.reshape(cells)
+
+
+def compare(weights, full, kept):
+    '''Return statistics of deposited weights against cell integrals.
+
+    Parameters
+    ----------
+    weights : array
+        Weight in each cell (see deposit).
+    full, kept : array
+        Integral of the density over each cell, and of the part of it above
+        nmin (see cell_integrals).
+
+    Returns
+    -------
+    Dictionary with the total 'weight', the integrals 'expected' (above nmin)
+    and 'integral' (all of it), the part 'lost' to the nmin cut, the relative
+    'total_error' of the weight against the expected integral, and the
+    relative deviation of the weight in each cell with particles expected:
+    its 'mean', 'rms', integral-weighted rms ('weighted_rms') and largest
+    magnitude ('max'), with the number of 'cells' compared and the 'stray'
+    weight found in cells where none is expected.
+    '''
+    weight = float(weights.sum())
+    expected = float(kept.sum())
+    integral = float(full.sum())
+    compared = kept > 0
+    deviation = weights[compared] / kept[compared] - 1
+    result = dict(
+        weight=weight, expected=expected, integral=integral,
+        lost=integral - expected,
+        total_error=weight / expected - 1 if expected else np.nan,
+        cells=int(deviation.size),
+        stray=float(weights[~compared].sum()),
+        mean=np.nan, rms=np.nan, weighted_rms=np.nan, max=np.nan,
+    )
+    if deviation.size:
+        result.update(
+            mean=float(np.mean(deviation)),
+            rms=float(np.sqrt(np.mean(deviation ** 2))),
+            weighted_rms=float(np.sqrt(np.sum(kept[compared] * deviation ** 2)
+                                       / expected)),
+            max=float(np.max(np.abs(deviation))),
+        )
+    return result
+
+
+def validate(density, bounds, cells, chunks, n_min=0,
+             points=DEFAULT_QUADRATURE_POINTS, batch_size=DEFAULT_BATCH_SIZE):
+    '''Compare the weights of particles with the integral of the density.
+
+    Parameters
+    ----------
+    density, n_min, points, batch_size
+        See cell_integrals.
+    bounds, cells, chunks
+        See deposit.
+
+    Returns
+    -------
+    See compare.
+    '''
+    weights = deposit(chunks, bounds, cells)
+    full, kept = cell_integrals(density, bounds, cells, n_min, points,
+                                batch_size)
+    return compare(weights, full, kept)
+
+
+def validate_files(density, bounds, cells, out_dir, n_min=0,
+                   points=DEFAULT_QUADRATURE_POINTS,
+                   batch_size=DEFAULT_BATCH_SIZE,
+                   chunk_size=DEFAULT_CHUNK_SIZE, scale=1.0):
+    '''Validate the particle files in out_dir (see validate), reading them
+    in chunks of chunk_size particles. The weights are divided by scale,
+    the factor of a species (see save_data.save_species).
+    '''
+    keys = AXES[:len(cells)] + ('w',)
+    chunks = (chunk[:-1] + [chunk[-1] / scale]
+              for chunk in iter_chunks(out_dir, keys, chunk_size))
+    return validate(density, bounds, cells, chunks, n_min, points,
+                    batch_size)
+
+
+def validate_arrays(density, bounds, cells, data, n_min=0,
+                    points=DEFAULT_QUADRATURE_POINTS,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    '''Validate particles held in a dictionary of arrays, as returned by
+    api.generate (see validate).
+    '''
+    keys = AXES[:len(cells)] + ('w',)
+    return validate(density, bounds, cells, [[data[k] for k in keys]], n_min,
+                    points, batch_size)
+
+
+def format_validation(result):
+    '''Return a human readable report of the result of validate.'''
+    lost = result['lost'] / result['integral'] if result['integral'] else 0.0
+    lines = [
+        f"Total weight: {result['weight']:.6g}, expected "
+        f"{result['expected']:.6g} (relative error "
+        f"{result['total_error']:.3e})",
+        f"Lost to nmin: {result['lost']:.6g} of {result['integral']:.6g} "
+        f"({lost:.3%})",
+        f"Per-cell relative deviation over {result['cells']} cells: mean "
+        f"{result['mean']:.3e}, rms {result['rms']:.3e}, weighted rms "
+        f"{result['weighted_rms']:.3e}, max {result['max']:.3e}",
+        f"Weight in cells where none is expected: {result['stray']:.6g}",
+    ]
+    return '\n'.join(lines)
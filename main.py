@@ -7,8 +7,7 @@ Part of EPOCH Generate Particles Files.
 This is the main file, used to generate the particles binary files to be passed
 to EPOCH.
 """
-import numpy as np
-import matplotlib.pyplot as plt
+import os
 
 from epoch_generate_particles_files.parse_args import (
     create_parser, check_valid_args)
@@ -21,56 +20,183 @@ if __name__ == "__main__":
     if not valid:
         raise SystemExit(err_msg)
     
-    # generate, save, and (optionally) plot the distributions.
-    if args.dimensions == 1:
-        print("Generating 1D particle distribution.")
-        
-        from epoch_generate_particles_files.generate_1d import generate_1d
-        from epoch_generate_particles_files.save_data import save_1d
-        
-        x_vis, n_vis, x_list, n_list, w_list = generate_1d(
-            args.xmin, args.xmax, args.nx, args.ppc, args.progress, args.nmin,
-            args.visx
+    from epoch_generate_particles_files.api import (
+        check_density_options, load_distribution)
+    from epoch_generate_particles_files.gridded import grid_distribution
+    try:
+        # a gridded density replaces the functions of distributions/dX.py
+        distribution = grid_distribution(args)
+        if distribution is None:
+            distribution = load_distribution(args.dimensions)
+        check_density_options(distribution['factors'], args.tabulate,
+                              args.jit)
+    except (ImportError, OSError, ValueError) as err:
+        raise SystemExit(str(err))
+    
+    # momenta of the particles, if requested
+    from epoch_generate_particles_files.thermal import (
+        MOMENTUM_KEYS, thermal_momentum)
+    try:
+        momentum = thermal_momentum(args, distribution)
+    except ValueError as err:
+        raise SystemExit(str(err))
+    
+    checkpoint = None
+    if args.resume:
+        from epoch_generate_particles_files.save_data import read_checkpoint
+        checkpoint = read_checkpoint(args.outdir)
+        if checkpoint is None:
+            print("No checkpoint found, starting from the beginning.")
+        if args.checkpoint is None:
+            from epoch_generate_particles_files.save_data import (
+                DEFAULT_CHECKPOINT_INTERVAL)
+            args.checkpoint = DEFAULT_CHECKPOINT_INTERVAL
+    
+    if args.seed is None and checkpoint is not None:
+        args.seed = checkpoint['seed']
+        print(f"Using seed {args.seed} of the checkpoint.")
+    elif args.seed is None:
+        from epoch_generate_particles_files.sampling import random_seed
+        args.seed = random_seed()
+        print(f"Using random seed {args.seed}.")
+    
+    # time the phases of the run if requested
+    from epoch_generate_particles_files.profiling import phase
+    profile = None
+    if args.profile or args.stats:
+        from epoch_generate_particles_files.profiling import Profile
+        profile = Profile()
+    
+    bounds = [(args.xmin, args.xmax), (args.ymin, args.ymax),
+              (args.zmin, args.zmax)][:args.dimensions]
+    cells = [args.nx, args.ny, args.nz][:args.dimensions]
+    
+    # only estimate the particles and the cost of the run, if requested
+    if args.dry_run is not None:
+        from epoch_generate_particles_files.estimate import (
+            estimate, format_estimate)
+        result = estimate(
+            args.dimensions, distribution['density'], bounds, cells, args.ppc,
+            n_min=args.nmin, batch_size=args.batch, workers=args.workers,
+            seed=args.seed, cull=args.cull, cull_safety=args.cull_safety,
+            table=args.tabulate, table_cache=args.table_cache,
+            sampling=args.sampling, ppc_min=args.ppc_min, budget=args.budget,
+            max_density=distribution['max_density'],
+            importance=distribution['importance'],
+            factors=distribution['factors'], jit=args.jit, momentum=momentum,
+            samples=args.dry_run
         )
-        
-        save_1d(x_list, w_list, args.outdir)
-        
-        if args.plot:
-            from epoch_generate_particles_files.plot_distributions import plot_1d
-            plot_1d(x_vis, n_vis, x_list, n_list, args.outdir)
-        
-    elif args.dimensions == 2:
-        print("Generating 2D particle distribution.")
-        
-        from epoch_generate_particles_files.generate_2d import generate_2d
-        from epoch_generate_particles_files.save_data import save_2d
-        
-        x_vis, y_vis, n_vis, x_list, y_list, n_list, w_list = generate_2d(
-            args.xmin, args.xmax, args.ymin, args.ymax, args.nx, args.ny,
-            args.ppc, args.progress, args.nmin, args.visx, args.visy
+        print(format_estimate(result))
+        raise SystemExit()
+    
+    # reuse the particles of an identical earlier run, if there is one
+    from epoch_generate_particles_files.cache import (
+        find_result, remove_manifest, run_key, store_result, write_manifest)
+    key = run_key(distribution['density'], vars(args))
+    if checkpoint is not None and checkpoint['tag'] != key:
+        raise SystemExit(
+            f"Checkpoint in '{args.outdir}' was saved by a different run."
         )
-        
-        save_2d(x_list, y_list, w_list, args.outdir)
-        
-        if args.plot:
-            print("Plotting.")
-            from epoch_generate_particles_files.plot_distributions import plot_2d
-            plot_2d(x_vis, y_vis, n_vis, x_list, y_list, n_list, args.outdir)
-            
+    manifest, found = None, None
+    if not args.force:
+        manifest, found = find_result(key, args.outdir,
+                                      args.cache_dir if args.cache else None)
+    
+    # options shared by all of the generators
+    options = dict(
+        batch_size=args.batch, workers=args.workers, seed=args.seed,
+        cull=args.cull, cull_safety=args.cull_safety, table=args.tabulate,
+        table_cache=args.table_cache, sampling=args.sampling,
+        ppc_min=args.ppc_min, budget=args.budget, jit=args.jit,
+        profile=profile, checkpoint=args.checkpoint, resume=args.resume,
+        checkpoint_tag=key, momentum=momentum, order=args.order,
+        nproc=args.nproc, offsets=args.offsets,
+        density=distribution['density'] if args.grid else None
+    )
+    
+    if manifest is not None:
+        print(f"Reusing {manifest['particles']} particles cached in "
+              f"'{found}'.")
     else:
-        print("Generating 3D particle distribution.")
-        
-        from epoch_generate_particles_files.generate_3d import generate_3d
-        from epoch_generate_particles_files.save_data import save_3d
-        
-        x_list, y_list, z_list, n_list, w_list = generate_3d(
-            args.xmin, args.xmax, args.ymin, args.ymax, args.zmin, args.zmax,
-            args.nx, args.ny, args.nz, args.ppc, args.progress, args.nmin
-        )
+        remove_manifest(args.outdir)
         
-        save_3d(x_list, y_list, z_list, w_list, args.outdir)
+        # generate and save the distributions, streaming them to file.
+        if args.dimensions == 1:
+            print("Generating 1D particle distribution.")
+            
+            from epoch_generate_particles_files.generate_1d import stream_1d
+            
+            n_particles = stream_1d(
+                args.xmin, args.xmax, args.nx, args.ppc, args.outdir,
+                args.progress, args.nmin, two_pass=args.two_pass, **options
+            )
+            
+        elif args.dimensions == 2:
+            print("Generating 2D particle distribution.")
+            
+            from epoch_generate_particles_files.generate_2d import stream_2d
+            
+            n_particles = stream_2d(
+                args.xmin, args.xmax, args.ymin, args.ymax, args.nx, args.ny,
+                args.ppc, args.outdir, args.progress, args.nmin,
+                two_pass=args.two_pass, **options
+            )
+            
+        else:
+            print("Generating 3D particle distribution.")
+            
+            from epoch_generate_particles_files.generate_3d import stream_3d
+            
+            n_particles = stream_3d(
+                args.xmin, args.xmax, args.ymin, args.ymax, args.zmin,
+                args.zmax, args.nx, args.ny, args.nz, args.ppc, args.outdir,
+                args.progress, args.nmin, two_pass=args.two_pass, **options
+            )
         
-        if args.plot:
-            print("Visualisation not currently implemented for 3D.")
+        from epoch_generate_particles_files.sampling import AXES
+        keys = AXES[:args.dimensions] + ('w',)
+        if momentum is not None:
+            keys += MOMENTUM_KEYS
+        from epoch_generate_particles_files.ordering import OFFSETS_NAME
+        extra = (OFFSETS_NAME,) if args.offsets else ()
+        write_manifest(args.outdir, key, vars(args), n_particles, keys,
+                       extra)
+        if args.cache:
+            store_result(args.outdir, args.cache_dir,
+                         int(args.cache_size * 2 ** 30))
+    
+    # (optionally) check the weights against the number density.
+    if args.validate:
+        print("Validating.")
+        with phase(profile, 'validating'):
+            from epoch_generate_particles_files.validation import (
+                format_validation, validate_files)
+            result = validate_files(distribution['density'], bounds, cells,
+                                    args.outdir, args.nmin,
+                                    batch_size=args.batch)
+        print(format_validation(result))
+    
+    # (optionally) plot the distributions, binning the particles from file.
+    if args.plot:
+        print("Plotting.")
+        with phase(profile, 'plotting'):
+            from epoch_generate_particles_files.plot_distributions import (
+                plot_files)
+            # compare with the density actually sampled, i.e. the table
+            density = distribution['density']
+            if args.tabulate:
+                from epoch_generate_particles_files.api import resolve_density
+                density = resolve_density(density, bounds, cells,
+                                          args.tabulate, args.table_cache)
+            plot_files(density, bounds, cells, args.outdir,
+                       (args.visx, args.visy), args.bins)
+    
+    if profile is not None:
+        from epoch_generate_particles_files.profiling import (
+            format_summary, save_summary)
+        summary = profile.summary(args.outdir)
+        print(format_summary(summary))
+        if args.stats:
+            save_summary(summary, os.path.join(args.outdir, 'stats.json'))
     
     print("Done.")
\ No newline at end of file
@@ -0,0 +1,122 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Inspects, crops, merges and indexes existing particle files, reading them
+through memory maps so that files of any size can be handled.
+"""
+import argparse
+
+from epoch_generate_particles_files.binning import DEFAULT_CHUNK_SIZE
+from epoch_generate_particles_files.regions import (
+    crop_files, file_info, format_info, index_files, merge_files)
+
+
+def create_parser():
+    '''Create argparse parser.'''
+    parser = argparse.ArgumentParser(
+        prog='EPOCH Generate Particles Files particles',
+        description="Inspect, crop, merge or index existing particle files."
+    )
+    parser.add_argument(
+        '--chunk', type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Number of particles read at a time, bounding the memory used. "
+             f"Defaults to {DEFAULT_CHUNK_SIZE}."
+    )
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+    box_help = ("Region given as XMIN,XMAX[,YMIN,YMAX[,ZMIN,ZMAX]], holding "
+                "the particles with XMIN <= x < XMAX and so on. Write "
+                "--box=... if XMIN is negative.")
+
+    info = commands.add_parser(
+        'info', help="Report the number of particles, total weight and range "
+                     "of every quantity."
+    )
+    info.add_argument('directory', help="Directory of the particle files.")
+    info.add_argument('--box', help=box_help + " Defaults to every particle.")
+
+    crop = commands.add_parser(
+        'crop', help="Write the particles in a region to new files."
+    )
+    crop.add_argument('directory', help="Directory of the particle files.")
+    crop.add_argument('--box', required=True, help=box_help)
+    crop.add_argument('-o', '--outdir', required=True,
+                      help="Directory the cropped files are written to.")
+
+    merge = commands.add_parser(
+        'merge', help="Concatenate the particle files of several directories, "
+                      "e.g. generated separately for adjacent regions."
+    )
+    merge.add_argument('directories', nargs='+',
+                       help="Directories of the particle files.")
+    merge.add_argument('-o', '--outdir', required=True,
+                       help="Directory the merged files are written to.")
+
+    index = commands.add_parser(
+        'index', help="Sort the particle files in place into blocks of cells "
+                      "and write offsets.json, so that queries on a region "
+                      "only read the blocks overlapping it."
+    )
+    index.add_argument('directory', help="Directory of the particle files.")
+    index.add_argument(
+        '--blocks', type=int, nargs='+', required=True, metavar='N',
+        help="Number of blocks in each direction."
+    )
+    index.add_argument(
+        '--cells', type=int, nargs='+', metavar='N',
+        help="Number of cells in each direction, if the directory has no "
+             "manifest. Defaults to the blocks."
+    )
+    return parser
+
+
+def parse_box(text):
+    '''Return a box from comma separated bounds, or None.
+
+    Raises
+    ------
+    ValueError
+        If the bounds are not pairs of increasing numbers.
+    '''
+    if text is None:
+        return None
+    try:
+        bounds = [float(value) for value in text.split(',')]
+    except ValueError:
+        raise ValueError(f"Invalid box '{text}'.") from None
+    if len(bounds) % 2 or len(bounds) > 6:
+        raise ValueError("box needs a lower and upper bound per dimension.")
+    box = list(zip(bounds[::2], bounds[1::2]))
+    if any(lo >= hi for lo, hi in box):
+        raise ValueError("box bounds must be increasing.")
+    return box
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.chunk < 1:
+        raise SystemExit("chunk must be positive.")
+    try:
+        if args.command == 'info':
+            print(format_info(file_info(args.directory, parse_box(args.box),
+                                        args.chunk)))
+        elif args.command == 'crop':
+            n = crop_files(args.directory, parse_box(args.box), args.outdir,
+                           args.chunk)
+            print(f"Wrote {n} particles to '{args.outdir}'.")
+        elif args.command == 'merge':
+            n = merge_files(args.directories, args.outdir, args.chunk)
+            print(f"Wrote {n} particles to '{args.outdir}'.")
+        else:
+            if min(args.blocks) < 1 or (args.cells and min(args.cells) < 1):
+                raise ValueError("blocks and cells must be positive.")
+            sidecar = index_files(args.directory, args.blocks, args.cells,
+                                  args.chunk)
+            print(f"Indexed {sidecar['particles']} particles in "
+                  f"{len(sidecar['ranks'])} blocks.")
+    except (OSError, ValueError) as err:
+        raise SystemExit(str(err))
+    print("Done.")
@@ -0,0 +1,55 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Generates the particle files of several species, listed in a JSON or TOML
+configuration file, sampling each shared density only once.
+"""
+import argparse
+
+from epoch_generate_particles_files.species import load_config, run_config
+from epoch_generate_particles_files.validation import format_validation
+
+
+def create_parser():
+    '''Create argparse parser.'''
+    parser = argparse.ArgumentParser(
+        prog='EPOCH Generate Particles Files species',
+        description="Generate binary files of several species of particles, "
+                    "as listed in a configuration file."
+    )
+    parser.add_argument(
+        'config',
+        help="JSON or TOML (.toml) file with the options of main.py shared by "
+             "all species and a list of species. See "
+             "epoch_generate_particles_files/species.py for the format."
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help="Number of independent jobs (groups of species sharing a "
+             "density and options) run in parallel. Defaults to 1."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.jobs < 1:
+        raise SystemExit("jobs must be positive.")
+    try:
+        config = load_config(args.config)
+        for result in run_config(config, args.jobs):
+            names = ', '.join(result['species'])
+            if result['particles'] is None:
+                print(f"Reusing cached particles of {names}.")
+            else:
+                print(f"Generated {result['particles']} particles for "
+                      f"{names} with seed {result['seed']}.")
+            for name, validation in result.get('validation', {}).items():
+                print(f"Validation of {name}:")
+                print(format_validation(validation))
+    except (ImportError, OSError, ValueError) as err:
+        raise SystemExit(str(err))
+    print("Done.")
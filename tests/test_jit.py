@@ -0,0 +1,43 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Tests that --jit compiles the density functions of the shipped examples.
+"""
+import pytest
+
+from epoch_generate_particles_files.api import generate, prepare
+from epoch_generate_particles_files.jit import JitDensity
+
+
+pytest.importorskip('numba')
+
+BOUNDS = (-3e-6, 2e-6)
+
+
+@pytest.mark.parametrize('dim', [1, 2, 3])
+def test_examples_use_jit(dim):
+    density, _, _ = prepare(dim, None, [BOUNDS] * dim, [4] * dim, 2,
+                            jit=True)
+    assert isinstance(density, JitDensity)
+
+
+@pytest.mark.parametrize('dim', [1, 2, 3])
+def test_examples_generate_with_jit(dim):
+    data = generate(dim, None, [BOUNDS] * dim, [4] * dim, 2, seed=1,
+                    jit=True)
+    assert data['w'].size > 0
+
+
+def test_factors_refuse_jit():
+    factors = [lambda x: x * 0 + 1.0] * 2
+    with pytest.raises(ValueError):
+        prepare(2, None, [BOUNDS] * 2, [4] * 2, 2, factors=factors,
+                jit=True)
+
+
+def test_table_refuses_jit():
+    with pytest.raises(ValueError):
+        prepare(2, None, [BOUNDS] * 2, [4] * 2, 2, table=[8], jit=True)
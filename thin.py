@@ -0,0 +1,81 @@
+# Author: George K. Holt
+# License: MIT
+# Version: 0.1
+"""
+Part of EPOCH Generate Particles Files.
+
+Reduces the number of particles in existing particle files, by weight-aware
+thinning or by merging particles within cells, writing new files next to the
+originals.
+"""
+import argparse
+
+from epoch_generate_particles_files.binning import DEFAULT_CHUNK_SIZE
+from epoch_generate_particles_files.sampling import SEED_LIMIT
+from epoch_generate_particles_files.thinning import (
+    DEFAULT_THINNED_DIR, THINNING_METHODS, reduce_particles)
+
+
+def create_parser():
+    '''Create argparse parser.'''
+    parser = argparse.ArgumentParser(
+        prog='EPOCH Generate Particles Files thin',
+        description="Reduce the number of particles in existing particle "
+                    "files."
+    )
+    parser.add_argument(
+        'directory',
+        help="Directory holding the x/y/z/w (and px/py/pz) particle files."
+    )
+    parser.add_argument(
+        '-n', '--target', type=float, required=True,
+        help="Number of particles wanted, e.g. 1e8."
+    )
+    parser.add_argument(
+        '-m', '--method', choices=THINNING_METHODS, default='thin',
+        help="'thin' keeps particles with a probability growing with their "
+             "weight and conserves the total weight. 'merge' merges "
+             "particles within each cell, conserving the weight and the mean "
+             "position and momentum of every cell. Defaults to 'thin'."
+    )
+    parser.add_argument(
+        '-o', '--outdir',
+        help="Directory the reduced files are written to. Defaults to the "
+             f"subdirectory '{DEFAULT_THINNED_DIR}' of the input directory."
+    )
+    parser.add_argument(
+        '--seed', type=int,
+        help="Seed of the random numbers. Defaults to a fresh random seed."
+    )
+    parser.add_argument(
+        '--cells', type=int, nargs='+', metavar='N',
+        help="Number of cells to merge on (one value, or one per dimension). "
+             "Defaults to the cells of the run, read from its manifest."
+    )
+    parser.add_argument(
+        '--chunk', type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Number of particles read at a time, bounding the memory used. "
+             f"Defaults to {DEFAULT_CHUNK_SIZE}."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.target < 1:
+        raise SystemExit("target must be positive.")
+    if args.chunk < 1:
+        raise SystemExit("chunk must be positive.")
+    if args.cells is not None and min(args.cells) < 1:
+        raise SystemExit("cells must be positive.")
+    if args.seed is not None and not 0 <= args.seed < SEED_LIMIT:
+        raise SystemExit("seed must be between 0 and 2**64 - 1.")
+    try:
+        before, after = reduce_particles(
+            args.directory, int(args.target), args.method, args.outdir,
+            args.seed, args.cells, args.chunk
+        )
+    except (OSError, ValueError) as err:
+        raise SystemExit(str(err))
+    print(f"Reduced {before} particles to {after}.")
+    print("Done.")